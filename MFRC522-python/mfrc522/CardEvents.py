@@ -0,0 +1,62 @@
+import time
+
+
+class CardEvents:
+    """Turns repeated reads of a reader into card transitions.
+
+    update() is fed with the ids seen by one poll (an empty list when no
+    tag answered) and returns events as dicts:
+
+        {"event": "present", "reader": name, "id": id, "ts": first_seen}
+        {"event": "removed", "reader": name, "id": id, "ts": last_seen,
+         "dwell_s": last_seen - first_seen}
+
+    A tag left on the reader gives a single "present". It is considered gone
+    after miss_threshold polls in a row without it (a held tag does not
+    answer every request), and the "removed" is only emitted once it has
+    stayed away for dedup_s: a tag coming back within that window, e.g.
+    at the edge of the field, continues the same presence.
+    """
+
+    def __init__(self, name="reader", miss_threshold=3, dedup_s=1.0):
+        self.name = name
+        self.miss_threshold = miss_threshold
+        self.dedup_s = dedup_s
+        # id -> [first_seen, last_seen, misses]
+        self.present = {}
+        # id -> [first_seen, last_seen] of tags that left, not yet reported
+        self.leaving = {}
+
+    def update(self, ids, now=None):
+        if now is None:
+            now = time.time()
+        events = []
+        for id in ids:
+            entry = self.present.get(id)
+            if entry is not None:
+                entry[1] = now
+                entry[2] = 0
+                continue
+            back = self.leaving.pop(id, None)
+            if back is not None:
+                self.present[id] = [back[0], now, 0]
+                continue
+            self.present[id] = [now, now, 0]
+            events.append({"event": "present", "reader": self.name, "id": id, "ts": now})
+
+        seen = set(ids)
+        for id in [i for i in self.present if i not in seen]:
+            entry = self.present[id]
+            entry[2] += 1
+            if entry[2] >= self.miss_threshold:
+                del self.present[id]
+                self.leaving[id] = entry[:2]
+
+        for id in [i for i, e in self.leaving.items() if now - e[1] >= self.dedup_s]:
+            first, last = self.leaving.pop(id)
+            events.append({"event": "removed", "reader": self.name, "id": id, "ts": last,
+                           "dwell_s": round(last - first, 3)})
+        return events
+
+    def is_present(self, id):
+        return id in self.present or id in self.leaving
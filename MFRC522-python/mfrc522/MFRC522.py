@@ -20,11 +20,35 @@
 #    You should have received a copy of the GNU Lesser General Public License
 #    along with MFRC522-Python.  If not, see <http://www.gnu.org/licenses/>.
 #
-import RPi.GPIO as GPIO
-import spidev
 import signal
 import time
 import logging
+import threading
+
+from .Transport import SpiTransport
+
+
+def _crc_a_table():
+    # ISO 14443-A CRC: reflected CCITT polynomial 0x8408, preset 0x6363
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+CRC_A_TABLE = _crc_a_table()
+
+
+def crc_a(data):
+    """CRC_A of a frame, low byte first as appended on air"""
+    crc = 0x6363
+    table = CRC_A_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return [crc & 0xFF, crc >> 8]
+
 
 class MFRC522:
     MAX_LEN = 16
@@ -50,6 +74,8 @@ class MFRC522:
     PICC_RESTORE = 0xC2
     PICC_TRANSFER = 0xB0
     PICC_HALT = 0x50
+    PICC_CASCADE = [0x93, 0x95, 0x97]
+    PICC_CT = 0x88
 
     MI_OK = 0
     MI_NOTAGERR = 1
@@ -125,46 +151,98 @@ class MFRC522:
 
     serNum = []
 
-    def __init__(self, bus=0, device=0, spd=1000000, pin_mode=10, pin_rst=-1, debugLevel='WARNING'):
-        self.spi = spidev.SpiDev()
-        self.spi.open(bus, device)
-        self.spi.max_speed_hz = spd
+    # Registers only ever modified by the host, never by the chip itself.
+    # Their last written value is kept in a shadow cache so that reads and
+    # read-modify-write cycles on them need no SPI round trip.
+    SHADOW_REGS = frozenset([
+        CommIEnReg, DivlEnReg, BitFramingReg, ModeReg, TxModeReg, RxModeReg,
+        TxControlReg, TxAutoReg, TModeReg, TPrescalerReg, TReloadRegH, TReloadRegL,
+    ])
+
+    def __init__(self, bus=0, device=0, spd=1000000, pin_mode=10, pin_rst=-1, debugLevel='WARNING',
+                 pin_irq=None, timeout_ms=15, pin_cs=None, transport=None, crc_mode='software'):
+        # transport defaults to spidev/RPi.GPIO; pass a Simulator (or any
+        # Transport) to run without hardware
+        if transport is None:
+            transport = SpiTransport(bus, device, spd, pin_mode, pin_rst, pin_cs, pin_irq)
+        self.transport = transport
+
+        # 'software': CRC_A computed on the host from a lookup table;
+        # 'hardware': the chip's coprocessor (FIFO load + CalcCRC + polling)
+        if crc_mode not in ('software', 'hardware'):
+            raise ValueError("crc_mode must be 'software' or 'hardware'")
+        self.crc_mode = crc_mode
+
+        self.shadow = {}
+        self.spi_calls = 0
+        self.last_xfer_count = 0
+        self.last_error = 0
+        self.last_coll = 0
+
+        # Receive timeout of the chip timer (TAuto starts it at the end of
+        # each transmission); one timer tick is ~0.5 ms with the prescaler below
+        self.timeout_ms = timeout_ms
+        self.irq = None
 
         self.logger = logging.getLogger('mfrc522Logger')
-        self.logger.addHandler(logging.StreamHandler())
+        if not self.logger.handlers:
+            self.logger.addHandler(logging.StreamHandler())
         level = logging.getLevelName(debugLevel)
         self.logger.setLevel(level)
 
-        gpioMode = GPIO.getmode()
-        
-        if gpioMode is None:
-            GPIO.setmode(pin_mode)
-        else:
-            pin_mode = gpioMode
-            
-        if pin_rst == -1:
-            if pin_mode == 11:
-                pin_rst = 15
-            else:
-                pin_rst = 22
-            
-        GPIO.setup(pin_rst, GPIO.OUT)
-        GPIO.output(pin_rst, 1)
+        if transport.has_irq:
+            self.irq = threading.Event()
+            transport.set_irq_callback(self._irq_callback)
+
         self.MFRC522_Init()
 
+    def _irq_callback(self, channel):
+        self.irq.set()
+
     def MFRC522_Reset(self):
         self.Write_MFRC522(self.CommandReg, self.PCD_RESETPHASE)
+        # Registers are back to their power-on values
+        self.shadow.clear()
+
+    def _xfer(self, data):
+        self.spi_calls += 1
+        return self.transport.xfer(data)
 
     def Write_MFRC522(self, addr, val):
-        val = self.spi.xfer2([(addr << 1) & 0x7E, val])
+        if addr in self.SHADOW_REGS:
+            if self.shadow.get(addr) == val:
+                return
+            self.shadow[addr] = val
+        self._xfer([(addr << 1) & 0x7E, val])
 
     def Read_MFRC522(self, addr):
-        val = self.spi.xfer2([((addr << 1) & 0x7E) | 0x80, 0])
-        return val[1]
+        if addr in self.shadow:
+            return self.shadow[addr]
+        val = self._xfer([((addr << 1) & 0x7E) | 0x80, 0])[1]
+        if addr in self.SHADOW_REGS:
+            self.shadow[addr] = val
+        return val
+
+    def Write_MFRC522_Burst(self, addr, data):
+        # All bytes following the address byte go to the same register,
+        # which for FIFODataReg fills the FIFO in a single transfer.
+        if len(data):
+            self._xfer([(addr << 1) & 0x7E] + list(data))
+
+    def Read_MFRC522_Burst(self, addr, count):
+        # Repeating the address byte reads the same register `count` times.
+        return self.Read_MFRC522_Regs([addr] * count)
+
+    def Read_MFRC522_Regs(self, addrs):
+        # One address byte per register, the answer to each one is clocked
+        # out while the next address is sent.
+        if not addrs:
+            return []
+        out = [((addr << 1) & 0x7E) | 0x80 for addr in addrs]
+        return self._xfer(out + [0])[1:]
 
     def Close_MFRC522(self):
-        self.spi.close()
-        GPIO.cleanup()
+        self.transport.close()
 
     def SetBitMask(self, reg, mask):
         tmp = self.Read_MFRC522(reg)
@@ -198,56 +276,93 @@ class MFRC522:
             irqEn = 0x77
             waitIRq = 0x30
 
-        self.Write_MFRC522(self.CommIEnReg, irqEn | 0x80)
-        self.ClearBitMask(self.CommIrqReg, 0x80)
-        self.SetBitMask(self.FIFOLevelReg, 0x80)
+        calls = self.spi_calls
+        self.last_error = 0
+        self.last_coll = 0
+
+        if self.irq is not None:
+            # Only raise the IRQ line for completion, error and timer timeout;
+            # LoAlert/TxIRq would wake us while the frame is still in flight
+            self.Write_MFRC522(self.CommIEnReg, (irqEn & (waitIRq | 0x03)) | 0x81)
+        else:
+            self.Write_MFRC522(self.CommIEnReg, irqEn | 0x80)
+        # Set1 = 0: every bit written as 1 is cleared, so no read is needed
+        self.Write_MFRC522(self.CommIrqReg, 0x7F)
+        # FlushBuffer; the level bits are read-only
+        self.Write_MFRC522(self.FIFOLevelReg, 0x80)
 
         self.Write_MFRC522(self.CommandReg, self.PCD_IDLE)
+        if self.irq is not None:
+            self.irq.clear()
 
-        for i in range(len(sendData)):
-            self.Write_MFRC522(self.FIFODataReg, sendData[i])
+        self.Write_MFRC522_Burst(self.FIFODataReg, sendData)
 
         self.Write_MFRC522(self.CommandReg, command)
 
         if command == self.PCD_TRANSCEIVE:
             self.SetBitMask(self.BitFramingReg, 0x80)
 
-        i = 2000
-        while True:
+        if self.irq is not None:
+            i = self._wait_irq(waitIRq)
             n = self.Read_MFRC522(self.CommIrqReg)
-            i -= 1
-            if ~((i != 0) and ~(n & 0x01) and ~(n & waitIRq)):
-                break
+        else:
+            # Stop on completion or on the chip timer (no answer in time)
+            i = 2000
+            while True:
+                n = self.Read_MFRC522(self.CommIrqReg)
+                i -= 1
+                if not ((i != 0) and not (n & 0x01) and not (n & waitIRq)):
+                    break
 
         self.ClearBitMask(self.BitFramingReg, 0x80)
 
         if i != 0:
-            if (self.Read_MFRC522(self.ErrorReg) & 0x1B) == 0x00:
+            (error, level, control, coll) = self.Read_MFRC522_Regs(
+                [self.ErrorReg, self.FIFOLevelReg, self.ControlReg, self.CollReg])
+            self.last_error = error
+            self.last_coll = coll
+            if (error & 0x1B) == 0x00:
                 status = self.MI_OK
 
                 if n & irqEn & 0x01:
                     status = self.MI_NOTAGERR
-
-                if command == self.PCD_TRANSCEIVE:
-                    n = self.Read_MFRC522(self.FIFOLevelReg)
-                    lastBits = self.Read_MFRC522(self.ControlReg) & 0x07
-                    if lastBits != 0:
-                        backLen = (n - 1) * 8 + lastBits
-                    else:
-                        backLen = n * 8
-
-                    if n == 0:
-                        n = 1
-                    if n > self.MAX_LEN:
-                        n = self.MAX_LEN
-
-                    for i in range(n):
-                        backData.append(self.Read_MFRC522(self.FIFODataReg))
             else:
                 status = self.MI_ERR
 
+            # On a bit collision (CollErr only) the bits received up to the
+            # collision are valid and needed by the anticollision loop
+            if command == self.PCD_TRANSCEIVE and (status != self.MI_ERR or (error & 0x1B) == 0x08):
+                n = level
+                lastBits = control & 0x07
+                if lastBits != 0:
+                    backLen = (n - 1) * 8 + lastBits
+                else:
+                    backLen = n * 8
+
+                if n == 0:
+                    n = 1
+                if n > self.MAX_LEN:
+                    n = self.MAX_LEN
+
+                backData = self.Read_MFRC522_Burst(self.FIFODataReg, n)
+
+        self.last_xfer_count = self.spi_calls - calls
         return (status, backData, backLen)
 
+    def _wait_irq(self, waitIRq):
+        # Block on the IRQ edge instead of polling CommIrqReg; the timer IRQ
+        # bounds the wait, the software deadline only covers a lost edge.
+        # Returns 0 on timeout, like the polling loop's counter.
+        deadline = time.time() + self.timeout_ms * 4 / 1000.0 + 0.02
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.irq.wait(remaining):
+                return 0
+            self.irq.clear()
+            n = self.Read_MFRC522(self.CommIrqReg)
+            if n & (waitIRq | 0x03):
+                return 1
+
     def MFRC522_Request(self, reqMode):
         status = None
         backBits = None
@@ -288,12 +403,123 @@ class MFRC522:
 
         return (status, backData)
 
+    def _Collided(self):
+        # Bit collision: CollErr set and no other receive error
+        return (self.last_error & 0x1B) == 0x08
+
+    def MFRC522_AnticollLevel(self, level):
+        # Bit-oriented anticollision (ISO 14443-3) on one cascade level.
+        # On a collision the colliding bit is taken as 1 and the loop
+        # continues with the longer known prefix, so exactly one card is
+        # left answering. Returns (status, CLn + BCC).
+        sel = self.PICC_CASCADE[level]
+        cl = [0] * 5
+        known = 0
+        for _ in range(33):
+            nbytes, nbits = known >> 3, known & 7
+            frame = [sel, ((2 + nbytes) << 4) | nbits] + cl[:nbytes + (1 if nbits else 0)]
+            # RxAlign = TxLastBits: the answer continues the partial byte
+            self.Write_MFRC522(self.BitFramingReg, (nbits << 4) | nbits)
+            (status, backData, backLen) = self.MFRC522_ToCard(self.PCD_TRANSCEIVE, frame)
+            collided = self._Collided()
+            if status != self.MI_OK and not collided:
+                break
+            for i, b in enumerate(backData):
+                idx = nbytes + i
+                if idx >= 5:
+                    break
+                if i == 0 and nbits:
+                    keep = (1 << nbits) - 1
+                    cl[idx] = (cl[idx] & keep) | (b & ~keep & 0xFF)
+                else:
+                    cl[idx] = b
+            if not collided:
+                self.Write_MFRC522(self.BitFramingReg, 0x00)
+                if cl[0] ^ cl[1] ^ cl[2] ^ cl[3] != cl[4]:
+                    return (self.MI_ERR, cl)
+                return (self.MI_OK, cl)
+            # CollPos counts from the first received bit including RxAlign,
+            # 1-based, 0 meaning 32
+            pos = (self.last_coll & 0x1F) or 32
+            bit = nbytes * 8 + pos - 1
+            if bit < known or bit >= 32:
+                break
+            idx = bit >> 3
+            cl[idx] = (cl[idx] & ((1 << (bit & 7)) - 1)) | (1 << (bit & 7))
+            for j in range(idx + 1, 5):
+                cl[j] = 0
+            known = bit + 1
+        self.Write_MFRC522(self.BitFramingReg, 0x00)
+        return (self.MI_ERR, cl)
+
+    def MFRC522_SelectLevel(self, level, cl):
+        # SELECT one cascade level; returns the SAK or None
+        buf = [self.PICC_CASCADE[level], 0x70] + list(cl[:5])
+        buf += self.CalulateCRC(buf)
+        self.Write_MFRC522(self.BitFramingReg, 0x00)
+        (status, backData, backLen) = self.MFRC522_ToCard(self.PCD_TRANSCEIVE, buf)
+        if status == self.MI_OK and backLen == 0x18:
+            return backData[0]
+        return None
+
+    def MFRC522_AnticollCascade(self, select=True):
+        # Resolves and selects one card over all cascade levels (4, 7 or 10
+        # byte UIDs). Returns (status, uid, sak). A 4-byte UID is returned
+        # with its BCC byte, as MFRC522_Anticoll does, so that IDs built from
+        # it stay the same. With select=False a single-size UID is returned
+        # right after anticollision, without the SELECT frame.
+        uid = []
+        for level in range(3):
+            (status, cl) = self.MFRC522_AnticollLevel(level)
+            if status != self.MI_OK:
+                return (self.MI_ERR, None, None)
+            if level == 0 and cl[0] != self.PICC_CT and not select:
+                return (self.MI_OK, cl, None)
+            sak = self.MFRC522_SelectLevel(level, cl)
+            if sak is None:
+                return (self.MI_ERR, None, None)
+            if cl[0] == self.PICC_CT and sak & 0x04:
+                uid += cl[1:4]
+                continue
+            uid = cl if level == 0 else uid + cl[:4]
+            return (self.MI_OK, uid, sak)
+        return (self.MI_ERR, None, None)
+
+    def MFRC522_Halt(self):
+        buf = [self.PICC_HALT, 0]
+        buf += self.CalulateCRC(buf)
+        self.Write_MFRC522(self.BitFramingReg, 0x00)
+        self.MFRC522_ToCard(self.PCD_TRANSCEIVE, buf)
+
+    def MFRC522_Inventory(self, max_cards=16):
+        # Enumerates every card in the field: WUPA (halted cards from a
+        # previous inventory included), resolve and select one card, HALT
+        # it so it stops answering, REQA for the next one.
+        # Returns a list of (uid, sak).
+        cards = []
+        reqMode = self.PICC_REQALL
+        while len(cards) < max_cards:
+            (status, backBits) = self.MFRC522_Request(reqMode)
+            # Different ATQAs collide too; the cards are still there
+            if status != self.MI_OK and not self._Collided():
+                break
+            reqMode = self.PICC_REQIDL
+            (status, uid, sak) = self.MFRC522_AnticollCascade()
+            if status != self.MI_OK:
+                break
+            cards.append((uid, sak))
+            self.MFRC522_Halt()
+        return cards
+
     def CalulateCRC(self, pIndata):
-        self.ClearBitMask(self.DivIrqReg, 0x04)
-        self.SetBitMask(self.FIFOLevelReg, 0x80)
+        if self.crc_mode == 'software':
+            return crc_a(pIndata)
+
+        # Clear CRCIRq (Set2 = 0) and flush the FIFO without read-modify-write
+        self.Write_MFRC522(self.DivIrqReg, 0x04)
+        self.Write_MFRC522(self.FIFOLevelReg, 0x80)
 
-        for i in range(len(pIndata)):
-            self.Write_MFRC522(self.FIFODataReg, pIndata[i])
+        self.Write_MFRC522_Burst(self.FIFODataReg, pIndata)
 
         self.Write_MFRC522(self.CommandReg, self.PCD_CALCCRC)
         i = 0xFF
@@ -302,10 +528,7 @@ class MFRC522:
             i -= 1
             if not ((i != 0) and not (n & 0x04)):
                 break
-        pOutData = []
-        pOutData.append(self.Read_MFRC522(self.CRCResultRegL))
-        pOutData.append(self.Read_MFRC522(self.CRCResultRegM))
-        return pOutData
+        return self.Read_MFRC522_Regs([self.CRCResultRegL, self.CRCResultRegM])
 
     def MFRC522_SelectTag(self, serNum):
         backData = []
@@ -384,10 +607,12 @@ class MFRC522:
         buff.append(crc[0])
         buff.append(crc[1])
         (status, backData, backLen) = self.MFRC522_ToCard(self.PCD_TRANSCEIVE, buff)
-        if not (status == self.MI_OK) or not (backLen == 4) or not ((backData[0] & 0x0F) == 0x0A):
+        # the card may have left the field: no ACK, and no backData to look at
+        if backData:
+            self.logger.debug("%s backdata &0x0F == 0x0A %s" % (backLen, backData[0] & 0x0F))
+        if not (status == self.MI_OK and backLen == 4 and (backData[0] & 0x0F) == 0x0A):
             status = self.MI_ERR
 
-        self.logger.debug("%s backdata &0x0F == 0x0A %s" % (backLen, backData[0] & 0x0F))
         if status == self.MI_OK:
             buf = []
             for i in range(16):
@@ -397,28 +622,70 @@ class MFRC522:
             buf.append(crc[0])
             buf.append(crc[1])
             (status, backData, backLen) = self.MFRC522_ToCard(self.PCD_TRANSCEIVE, buf)
-            if not (status == self.MI_OK) or not (backLen == 4) or not ((backData[0] & 0x0F) == 0x0A):
+            if not (status == self.MI_OK and backLen == 4 and (backData[0] & 0x0F) == 0x0A):
                 self.logger.error("Error while writing")
+                status = self.MI_ERR
             if status == self.MI_OK:
                 self.logger.debug("Data written")
+        return status
 
+    @staticmethod
+    def SectorTrailer(blockAddr):
+        # 4 blocks per sector up to block 127, 16 blocks per sector above (4K)
+        if blockAddr < 128:
+            return (blockAddr // 4) * 4 + 3
+        return ((blockAddr - 128) // 16) * 16 + 128 + 15
+
+    def _group_by_sector(self, blockAddrs):
+        sectors = {}
+        for addr in blockAddrs:
+            sectors.setdefault(self.SectorTrailer(addr), []).append(addr)
+        return sectors.items()
+
+    def MFRC522_ReadBlocks(self, key, uid, blockAddrs, authMode=PICC_AUTHENT1A):
+        # Reads blocks of a selected tag with one authentication per sector.
+        # Returns {blockAddr: data}; blocks that could not be read are left out.
+        data = {}
+        for trailer, addrs in self._group_by_sector(blockAddrs):
+            if self.MFRC522_Auth(authMode, trailer, key, uid) != self.MI_OK:
+                self.logger.error("Authentication error for sector trailer " + str(trailer))
+                continue
+            for addr in addrs:
+                block = self.MFRC522_Read(addr)
+                if block is not None:
+                    data[addr] = block
+        return data
+
+    def MFRC522_WriteBlocks(self, key, uid, blocks, authMode=PICC_AUTHENT1A):
+        # Writes {blockAddr: 16 bytes} with one authentication per sector.
+        # Returns the list of blocks written successfully.
+        written = []
+        for trailer, addrs in self._group_by_sector(blocks):
+            if self.MFRC522_Auth(authMode, trailer, key, uid) != self.MI_OK:
+                self.logger.error("Authentication error for sector trailer " + str(trailer))
+                continue
+            for addr in addrs:
+                if self.MFRC522_Write(addr, blocks[addr]) == self.MI_OK:
+                    written.append(addr)
+        return written
 
     def MFRC522_DumpClassic1K(self, key, uid):
-        for i in range(64):
-            status = self.MFRC522_Auth(self.PICC_AUTHENT1A, i, key, uid)
-            # Check if authenticated
-            if status == self.MI_OK:
-                self.MFRC522_Read(i)
-            else:
-                self.logger.error("Authentication error")
+        # 16 authentications, one per sector, instead of one per block
+        return self.MFRC522_ReadBlocks(key, uid, range(64))
 
     def MFRC522_Init(self):
         self.MFRC522_Reset()
 
+        # TAuto, prescaler 0xD3E: 13.56 MHz / (2 * 3390 + 1) ~ 2 kHz
+        reload = max(1, min(0xFFFF, int(self.timeout_ms * 2)))
         self.Write_MFRC522(self.TModeReg, 0x8D)
         self.Write_MFRC522(self.TPrescalerReg, 0x3E)
-        self.Write_MFRC522(self.TReloadRegL, 30)
-        self.Write_MFRC522(self.TReloadRegH, 0)
+        self.Write_MFRC522(self.TReloadRegL, reload & 0xFF)
+        self.Write_MFRC522(self.TReloadRegH, reload >> 8)
+
+        if self.irq is not None:
+            # IRQPushPull, so the line does not depend on an external pull-up
+            self.Write_MFRC522(self.DivlEnReg, 0x80)
 
         self.Write_MFRC522(self.TxAutoReg, 0x40)
         self.Write_MFRC522(self.ModeReg, 0x3D)
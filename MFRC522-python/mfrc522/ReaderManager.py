@@ -0,0 +1,137 @@
+import threading
+import time
+
+from .SimpleMFRC522 import SimpleMFRC522
+from .CardEvents import CardEvents
+
+
+class ReaderManager:
+    """Polls several MFRC522 readers sharing one SPI bus.
+
+    Readers are polled one at a time following a precomputed weighted
+    round-robin schedule: a reader with priority 3 gets three polls per
+    cycle, spread over the cycle. Each step touches a single reader, so the
+    cost of polling one reader does not grow with the number of readers.
+
+    Every reader has its own CardEvents tracker. on_card(name, id) is called
+    when a tag arrives on a reader and on_event(event) for every present /
+    removed transition. A tag that stays on the same reader is reported
+    again only once it has been gone for hold_s seconds, and is considered
+    gone after miss_threshold polls of that reader without it. With
+    inventory=True every tag in the field is reported (anticollision + HALT
+    inventory) instead of a single one.
+
+    A reader is polled while holding its own lock, which remove_reader takes
+    before closing it, so a reader is never closed in the middle of a poll.
+    """
+
+    def __init__(self, on_card=None, hold_s=1.0, cycle_s=0.05, inventory=False,
+                 on_event=None, miss_threshold=3):
+        self.on_card = on_card
+        self.on_event = on_event
+        self.inventory = inventory
+        self.hold_s = hold_s
+        self.miss_threshold = miss_threshold
+        self.cycle_s = cycle_s
+        self.readers = {}
+        self.priorities = {}
+        self.polls = 0
+        self._schedule = []
+        self._pos = 0
+        self.events = {}
+        self._reader_locks = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_reader(self, name, priority=1, reader=None, **kwargs):
+        """Add a reader; kwargs go to SimpleMFRC522/MFRC522 (bus, device, pin_cs, pin_irq...)"""
+        if reader is None:
+            reader = SimpleMFRC522(**kwargs)
+        with self._lock:
+            self.readers[name] = reader
+            self.priorities[name] = max(1, int(priority))
+            self.events[name] = CardEvents(name, self.miss_threshold, self.hold_s)
+            self._reader_locks[name] = threading.Lock()
+            self._build_schedule()
+        return reader
+
+    def remove_reader(self, name):
+        with self._lock:
+            reader = self.readers.pop(name)
+            del self.priorities[name]
+            self.events.pop(name, None)
+            reader_lock = self._reader_locks.pop(name)
+            self._build_schedule()
+        # Waits for a poll of this reader in progress
+        with reader_lock:
+            reader.READER.Close_MFRC522()
+
+    def _build_schedule(self):
+        # Smooth weighted round-robin: priorities are interleaved rather
+        # than polled in bursts
+        total = sum(self.priorities.values())
+        current = dict((name, 0) for name in self.priorities)
+        schedule = []
+        for _ in range(total):
+            for name, weight in self.priorities.items():
+                current[name] += weight
+            best = max(current, key=current.get)
+            current[best] -= total
+            schedule.append(best)
+        self._schedule = schedule
+        self._pos = 0
+
+    def poll_once(self):
+        """Poll the next reader of the schedule; returns its present/removed events"""
+        with self._lock:
+            if not self._schedule:
+                return []
+            name = self._schedule[self._pos]
+            self._pos = (self._pos + 1) % len(self._schedule)
+            reader = self.readers[name]
+            tracker = self.events[name]
+            reader_lock = self._reader_locks[name]
+        with reader_lock:
+            if self.readers.get(name) is not reader:
+                return []   # removed (and closed) since it was picked
+            self.polls += 1
+            if self.inventory:
+                ids = reader.read_ids_no_block()
+            else:
+                id = reader.read_id_no_block()
+                ids = [id] if id else []
+        # Misses are fed too: they are what ends a presence
+        events = tracker.update(ids, time.time())
+        for event in events:
+            if self.on_card and event["event"] == "present":
+                self.on_card(name, event["id"])
+            if self.on_event:
+                self.on_event(event)
+        return events
+
+    def run(self):
+        self._stop.clear()
+        while not self._stop.is_set():
+            if not self._schedule:
+                self._stop.wait(self.cycle_s)
+                continue
+            self.poll_once()
+            if self._pos == 0:
+                self._stop.wait(self.cycle_s)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        for name in list(self.readers):
+            self.remove_reader(name)
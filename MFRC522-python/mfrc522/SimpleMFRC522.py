@@ -1,7 +1,10 @@
 # Code by Simon Monk https://github.com/simonmonk/
 
 from . import MFRC522
-import RPi.GPIO as GPIO
+import asyncio
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
   
 class SimpleMFRC522:
 
@@ -10,50 +13,70 @@ class SimpleMFRC522:
   KEY = [0xFF,0xFF,0xFF,0xFF,0xFF,0xFF]
   BLOCK_ADDRS = [8, 9, 10]
   
-  def __init__(self):
-    self.READER = MFRC522()
+  # Pause between two card requests while no tag is present. Each request
+  # already waits for the chip timer (on the IRQ pin when pin_irq is given),
+  # so the loop no longer keeps a core busy.
+  POLL_INTERVAL = 0.05
+
+  # Number of tags whose block contents are remembered by read_blocks
+  CACHE_SIZE = 32
+
+  def __init__(self, poll_interval=None, **kwargs):
+    self.READER = MFRC522(**kwargs)
+    if poll_interval is not None:
+      self.POLL_INTERVAL = poll_interval
+    self._executor = None
+    self._cache = OrderedDict()
   
   def read(self):
       id, text = self.read_no_block()
       while not id:
+          time.sleep(self.POLL_INTERVAL)
           id, text = self.read_no_block()
       return id, text
 
   def read_id(self):
     id = self.read_id_no_block()
     while not id:
+      time.sleep(self.POLL_INTERVAL)
       id = self.read_id_no_block()
     return id
 
+  async def wait_for_card(self, read_text=False):
+    """Wait for a tag without blocking the event loop.
+
+    Returns the id, or (id, text) with read_text=True. Reader access runs on
+    a single worker thread so it is never used from two threads at once;
+    wrap in asyncio.wait_for() for a timeout.
+    """
+    if self._executor is None:
+      self._executor = ThreadPoolExecutor(max_workers=1)
+    loop = asyncio.get_running_loop()
+    read = self.read_no_block if read_text else self.read_id_no_block
+    while True:
+      result = await loop.run_in_executor(self._executor, read)
+      if (result[0] if read_text else result):
+        return result
+      await asyncio.sleep(self.POLL_INTERVAL)
+
   def read_id_no_block(self):
-      (status, TagType) = self.READER.MFRC522_Request(self.READER.PICC_REQIDL)
-      if status != self.READER.MI_OK:
-          return None
-      (status, uid) = self.READER.MFRC522_Anticoll()
-      if status != self.READER.MI_OK:
+      uid, sak = self._request_uid()
+      if uid is None:
           return None
       return self.uid_to_num(uid)
+
+  def read_ids_no_block(self):
+    """IDs of every tag in the field (anticollision + HALT inventory)"""
+    return [self.uid_to_num(uid) for uid, sak in self.READER.MFRC522_Inventory()]
   
   def read_no_block(self):
-    (status, TagType) = self.READER.MFRC522_Request(self.READER.PICC_REQIDL)
-    if status != self.READER.MI_OK:
+    id, blocks = self.read_blocks(self.BLOCK_ADDRS)
+    if not id:
         return None, None
-    (status, uid) = self.READER.MFRC522_Anticoll()
-    if status != self.READER.MI_OK:
-        return None, None
-    id = self.uid_to_num(uid)
-    self.READER.MFRC522_SelectTag(uid)
-    status = self.READER.MFRC522_Auth(self.READER.PICC_AUTHENT1A, 11, self.KEY, uid)
     data = []
-    text_read = ''
-    if status == self.READER.MI_OK:
-        for block_num in self.BLOCK_ADDRS:
-            block = self.READER.MFRC522_Read(block_num) 
-            if block:
-            		data += block
-        if data:
-             text_read = ''.join(chr(i) for i in data)
-    self.READER.MFRC522_StopCrypto1()
+    for block_num in self.BLOCK_ADDRS:
+        data += blocks.get(block_num, [])
+    text_read = ''.join(chr(i) for i in data)
     return id, text_read
     
   def write(self, text):
@@ -63,28 +86,99 @@ class SimpleMFRC522:
       return id, text_in
 
   def write_no_block(self, text):
-      (status, TagType) = self.READER.MFRC522_Request(self.READER.PICC_REQIDL)
-      if status != self.READER.MI_OK:
-          return None, None
-      (status, uid) = self.READER.MFRC522_Anticoll()
-      if status != self.READER.MI_OK:
+      data = bytearray(text.ljust(len(self.BLOCK_ADDRS) * 16).encode('ascii'))
+      blocks = {}
+      for i, block_num in enumerate(self.BLOCK_ADDRS):
+        blocks[block_num] = data[(i*16):(i+1)*16]
+      id, written = self.write_blocks(blocks)
+      if not id:
           return None, None
-      id = self.uid_to_num(uid)
-      self.READER.MFRC522_SelectTag(uid)
-      status = self.READER.MFRC522_Auth(self.READER.PICC_AUTHENT1A, 11, self.KEY, uid)
-      self.READER.MFRC522_Read(11)
-      if status == self.READER.MI_OK:
-          data = bytearray()
-          data.extend(bytearray(text.ljust(len(self.BLOCK_ADDRS) * 16).encode('ascii')))
-          i = 0
-          for block_num in self.BLOCK_ADDRS:
-            self.READER.MFRC522_Write(block_num, data[(i*16):(i+1)*16])
-            i += 1
-      self.READER.MFRC522_StopCrypto1()
       return id, text[0:(len(self.BLOCK_ADDRS) * 16)]
+
+  def read_blocks(self, block_addrs, use_cache=True):
+    """Read arbitrary blocks of the tag in the field.
+
+    Each sector is authenticated once, and blocks already read from the same
+    tag are served from a per-UID cache. Returns (id, {block: data}) or
+    (None, None) when no tag answers.
+    """
+    uid, sak = self._request_uid()
+    if uid is None:
+      return None, None
+    id = self.uid_to_num(uid)
+    cached = self._cache_for(id) if use_cache else {}
+    missing = [b for b in block_addrs if b not in cached]
+    if missing and self._select(uid, sak):
+      cached.update(self.READER.MFRC522_ReadBlocks(self.KEY, self._auth_uid(uid), missing))
+      self.READER.MFRC522_StopCrypto1()
+    return id, dict((b, cached[b]) for b in block_addrs if b in cached)
+
+  def write_blocks(self, blocks):
+    """Write {block: 16 bytes}, one authentication per sector.
+
+    The cache entry of the tag is updated with what was written and drops
+    the blocks whose write failed. Returns (id, written blocks).
+    """
+    uid, sak = self._request_uid()
+    if uid is None:
+      return None, None
+    id = self.uid_to_num(uid)
+    written = []
+    if self._select(uid, sak):
+      written = self.READER.MFRC522_WriteBlocks(self.KEY, self._auth_uid(uid), blocks)
+      self.READER.MFRC522_StopCrypto1()
+    cached = self._cache_for(id)
+    for block_num in blocks:
+      if block_num in written:
+        cached[block_num] = list(blocks[block_num])
+      else:
+        cached.pop(block_num, None)
+    return id, written
+
+  def invalidate(self, id=None):
+    """Forget cached contents of one tag, or of all tags"""
+    if id is None:
+      self._cache.clear()
+    else:
+      self._cache.pop(id, None)
+
+  def _cache_for(self, id):
+    cached = self._cache.get(id)
+    if cached is None:
+      cached = self._cache[id] = {}
+      while len(self._cache) > self.CACHE_SIZE:
+        self._cache.popitem(last=False)
+    else:
+      self._cache.move_to_end(id)
+    return cached
+
+  def _request_uid(self):
+    # Full anticollision cascade; a single-size UID is not selected yet
+    # (sak is None) so an ID-only read costs no SELECT frame
+    (status, TagType) = self.READER.MFRC522_Request(self.READER.PICC_REQIDL)
+    if status != self.READER.MI_OK and not self.READER._Collided():
+        return None, None
+    (status, uid, sak) = self.READER.MFRC522_AnticollCascade(select=False)
+    if status != self.READER.MI_OK:
+        return None, None
+    return uid, sak
+
+  def _select(self, uid, sak):
+    if sak is not None:
+      return True
+    return self.READER.MFRC522_SelectLevel(0, uid) is not None
+
+  def _auth_uid(self, uid):
+    # 4-byte UIDs come with their BCC; longer UIDs authenticate with the
+    # last four bytes (last cascade level)
+    return uid[:4] if len(uid) == 5 else uid[-4:]
       
   def uid_to_num(self, uid):
+      # All bytes. 4-byte UIDs keep their BCC, so their 40-bit IDs are
+      # unchanged. 7- and 10-byte UIDs give 56- and 80-bit IDs; they used to
+      # be cut to the first cascade level (0x88 + 3 UID bytes + BCC), so IDs
+      # stored for those cards (e.g. in access_control's ACL file) change.
       n = 0
-      for i in range(0, 5):
-          n = n * 256 + uid[i]
+      for b in uid:
+          n = n * 256 + b
       return n
@@ -0,0 +1,480 @@
+"""Software MFRC522 for running the RFID path without hardware.
+
+Simulator is a Transport that decodes SPI transactions into register
+accesses of a model of the chip: FIFO, IRQ flags, CRC coprocessor, the
+Transceive / MFAuthent / CalcCRC commands and the receive timer. Virtual
+cards in the field answer ISO 14443-3 frames (REQA/WUPA, bit-oriented
+anticollision on all cascade levels, SELECT, HLTA) and MIFARE Classic
+READ/WRITE. Authentication checks the sector key but Crypto1 itself is not
+modelled: frames stay in clear text after MFAuthent.
+
+Nothing runs in real time. Each transaction advances a virtual clock
+(clock_us) by its SPI time plus the RF time of the frames, so throughput
+numbers do not depend on the machine running the simulation. With irq the
+host sleeps until the end of a command; without it the command completes
+only once the host's own transactions have advanced the clock that far, so
+polling CommIrqReg costs what it does on a real chip.
+
+    python -m mfrc522.Simulator [reads]
+"""
+
+import random
+
+from .Transport import Transport
+
+
+def crc_a(data):
+    # ISO 14443-A CRC, bit by bit (reference implementation)
+    crc = 0x6363
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+    return [crc & 0xFF, crc >> 8]
+
+
+def _bits(data, nbits):
+    # LSB first, as sent on air
+    return [(data[i >> 3] >> (i & 7)) & 1 for i in range(nbits)]
+
+
+def _pack(bits, align=0):
+    # Pack bits starting at bit `align` of the first byte; returns
+    # (bytes, number of valid bits in the last byte or 0 for a full byte)
+    out = []
+    pos = align
+    for bit in bits:
+        if pos >> 3 >= len(out):
+            out.append(0)
+        out[pos >> 3] |= bit << (pos & 7)
+        pos += 1
+    return out, pos & 7
+
+
+class VirtualCard(object):
+    """MIFARE Classic 1K style card with a 4, 7 or 10 byte UID"""
+
+    IDLE, READY, ACTIVE, AUTH, HALT = range(5)
+
+    DEFAULT_KEY = [0xFF] * 6
+    DEFAULT_ACCESS = [0xFF, 0x07, 0x80, 0x69]
+
+    def __init__(self, uid, blocks=None, sak=0x08, atqa=None, key_a=None, key_b=None):
+        self.uid = list(uid)
+        if len(self.uid) not in (4, 7, 10):
+            raise ValueError("UID must be 4, 7 or 10 bytes")
+        self.sak = sak
+        if atqa is None:
+            atqa = [{4: 0x04, 7: 0x44, 10: 0x84}[len(self.uid)], 0x00]
+        self.atqa = atqa
+        self.blocks = [[0] * 16 for _ in range(64)]
+        key_a = list(key_a or self.DEFAULT_KEY)
+        key_b = list(key_b or self.DEFAULT_KEY)
+        for trailer in range(3, 64, 4):
+            self.blocks[trailer] = key_a + self.DEFAULT_ACCESS + key_b
+        self.blocks[0][:4] = self.uid[:4]
+        for addr, data in (blocks or {}).items():
+            self.blocks[addr] = list(data)
+        self.state = self.IDLE
+        self.halted = False
+        self.level = 0
+        self.auth_sector = None
+        self.pending_write = None
+
+    def cascade(self, level):
+        # CLn bytes (4) + BCC for cascade level 0, 1 or 2
+        uid = self.uid
+        levels = len(uid) // 3
+        if level >= levels:
+            return None
+        if level == levels - 1:
+            part = uid[-4:]
+        else:
+            part = [0x88] + uid[3 * level:3 * level + 3]
+        return part + [part[0] ^ part[1] ^ part[2] ^ part[3]]
+
+    def _reset(self):
+        self.state = self.HALT if self.halted else self.IDLE
+        self.level = 0
+        self.auth_sector = None
+        self.pending_write = None
+
+    def frame(self, data, nbits, crypto):
+        """Handle one frame from the reader; returns response bits or None"""
+        if nbits == 7:
+            cmd = data[0] & 0x7F
+            if cmd == 0x26 and self.state == self.IDLE or cmd == 0x52 and self.state in (self.IDLE, self.HALT):
+                self.state = self.READY
+                self.level = 0
+                return _bits(self.atqa, 16)
+            if self.state != self.HALT:
+                self._reset()
+            return None
+
+        if self.state == self.READY and data[0] in (0x93, 0x95, 0x97):
+            return self._anticoll(data, nbits)
+
+        if self.state in (self.ACTIVE, self.AUTH):
+            nbytes = nbits >> 3
+            if nbytes >= 3 and crc_a(data[:nbytes - 2]) == data[nbytes - 2:nbytes]:
+                return self._command(data[:nbytes - 2], crypto)
+            if self.pending_write is None:
+                self._reset()
+            return None
+
+        if self.state != self.HALT:
+            self._reset()
+        return None
+
+    def _anticoll(self, data, nbits):
+        level = (data[0] - 0x93) // 2
+        if level != self.level:
+            return None
+        cl = self.cascade(level)
+        nvb = data[1]
+        if nvb == 0x70:
+            # SELECT: full CLn + BCC + CRC
+            if nbits != 72 or crc_a(data[:7]) != data[7:9] or data[2:7] != cl:
+                return None
+            if level == len(self.uid) // 3 - 1:
+                self.state = self.ACTIVE
+                sak = self.sak
+            else:
+                self.level += 1
+                sak = 0x04
+            return _bits([sak] + crc_a([sak]), 24)
+        known = ((nvb >> 4) - 2) * 8 + (nvb & 0x0F)
+        if known < 0 or known > 32 or nbits < 16 + known:
+            return None
+        cl_bits = _bits(cl, 40)
+        if _bits(data[2:], known) != cl_bits[:known]:
+            return None
+        return cl_bits[known:]
+
+    def _command(self, cmd, crypto):
+        if self.pending_write is not None:
+            addr = self.pending_write
+            self.pending_write = None
+            if len(cmd) == 16:
+                self.blocks[addr] = list(cmd)
+                return _bits([0x0A], 4)
+            self._reset()
+            return None
+        op = cmd[0]
+        if op == 0x50 and len(cmd) == 2:
+            self.halted = True
+            self._reset()
+            return None
+        if op in (0x30, 0xA0) and len(cmd) == 2:
+            addr = cmd[1]
+            if not crypto or self.state != self.AUTH or addr >= 64 or addr // 4 != self.auth_sector:
+                self._reset()
+                return None
+            if op == 0x30:
+                block = self.blocks[addr]
+                return _bits(block + crc_a(block), 18 * 8)
+            self.pending_write = addr
+            return _bits([0x0A], 4)
+        self._reset()
+        return None
+
+    def authenticate(self, mode, addr, key, uid):
+        if self.state not in (self.ACTIVE, self.AUTH) or addr >= 64:
+            return False
+        trailer = self.blocks[(addr // 4) * 4 + 3]
+        expected = trailer[:6] if mode == 0x60 else trailer[10:16]
+        if list(key) != expected or list(uid) != self.uid[-4:] and list(uid) != self.uid[:4]:
+            self._reset()
+            return False
+        self.state = self.AUTH
+        self.auth_sector = addr // 4
+        return True
+
+
+class Simulator(Transport):
+    """Register-level MFRC522 model, usable as MFRC522(transport=Simulator())"""
+
+    # Register addresses (same as MFRC522)
+    CommandReg, CommIEnReg, DivlEnReg, CommIrqReg, DivIrqReg, ErrorReg = 0x01, 0x02, 0x03, 0x04, 0x05, 0x06
+    Status2Reg, FIFODataReg, FIFOLevelReg, ControlReg, BitFramingReg, CollReg = 0x08, 0x09, 0x0A, 0x0C, 0x0D, 0x0E
+    CRCResultRegM, CRCResultRegL = 0x21, 0x22
+    TModeReg, TPrescalerReg, TReloadRegH, TReloadRegL = 0x2A, 0x2B, 0x2C, 0x2D
+    VersionReg = 0x37
+
+    IDLE, TRANSMIT, RECEIVE, TRANSCEIVE, CALCCRC, AUTHENT, SOFTRESET = 0x00, 0x04, 0x08, 0x0C, 0x03, 0x0E, 0x0F
+
+    RF_BIT_US = 9.44        # 106 kbit/s
+    FRAME_DELAY_US = 86     # PICC frame delay time
+    XFER_OVERHEAD_US = 25   # ioctl + chip-select per transaction on a Pi
+
+    def __init__(self, cards=None, spd=1000000, frame_loss=0.0, seed=None, irq=False):
+        self.cards = list(cards or [])
+        self.spd = spd
+        self.frame_loss = frame_loss
+        self.rng = random.Random(seed)
+        self.has_irq = irq
+        self._irq_callback = None
+        self.clock_us = 0.0
+        self.xfers = 0
+        self.xfer_bytes = 0
+        self.frames = 0
+        self.timeouts = 0
+        self._leaving = {}
+        self._reset_chip()
+
+    # ===== field =====
+    def add_card(self, card):
+        self.cards.append(card)
+        return card
+
+    def remove_card(self, card):
+        self.cards.remove(card)
+        card.halted = False
+        card.state = card.IDLE
+        self._leaving.pop(card, None)
+
+    def remove_card_during(self, card, frames=0):
+        """Remove the card while it answers, after `frames` more answered frames.
+
+        The reader receives the first half of that answer with a parity
+        error, as when a card leaves the field mid-transaction.
+        """
+        self._leaving[card] = frames
+
+    # ===== Transport =====
+    def set_irq_callback(self, callback):
+        self._irq_callback = callback
+
+    def xfer(self, data):
+        data = list(data)
+        self.xfers += 1
+        self.xfer_bytes += len(data)
+        self.clock_us += len(data) * 8 * 1e6 / self.spd + self.XFER_OVERHEAD_US
+        if self._done is not None and self.clock_us >= self._done[0]:
+            comm = self._done[1]
+            self._done = None
+            self._raise(comm=comm)
+        out = [0]
+        if data[0] & 0x80:
+            for byte in data[:-1]:
+                out.append(self._read((byte >> 1) & 0x3F))
+        else:
+            addr = (data[0] >> 1) & 0x3F
+            for byte in data[1:]:
+                self._write(addr, byte)
+            out += [0] * (len(data) - 1)
+        return out
+
+    # ===== registers =====
+    def _reset_chip(self):
+        self.regs = [0] * 64
+        self.regs[self.CommandReg] = 0x20
+        self.regs[self.CommIEnReg] = 0x80
+        self.regs[self.DivIrqReg] = 0x00
+        self.regs[self.CommIrqReg] = 0x14
+        self.regs[0x11] = 0x3F          # ModeReg
+        self.regs[0x14] = 0x80          # TxControlReg
+        self.regs[self.CollReg] = 0xA0
+        self.regs[self.VersionReg] = 0x92
+        self.fifo = []
+        self.command = self.IDLE
+        self.crypto = False
+        self._irq_line = False
+        self._done = None               # (clock_us, CommIrqReg bits) of the running command
+
+    def _read(self, addr):
+        if addr == self.FIFODataReg:
+            return self.fifo.pop(0) if self.fifo else 0
+        if addr == self.FIFOLevelReg:
+            return len(self.fifo)
+        if addr == self.CommandReg:
+            return (self.regs[addr] & 0xF0) | self.command
+        if addr == self.Status2Reg:
+            return (self.regs[addr] & ~0x08) | (0x08 if self.crypto else 0)
+        return self.regs[addr]
+
+    def _write(self, addr, val):
+        if addr == self.FIFODataReg:
+            if len(self.fifo) < 64:
+                self.fifo.append(val)
+            else:
+                self.regs[self.ErrorReg] |= 0x10    # BufferOvfl
+        elif addr == self.FIFOLevelReg:
+            if val & 0x80:
+                self.fifo = []
+                self.regs[self.ErrorReg] &= ~0x10
+        elif addr in (self.CommIrqReg, self.DivIrqReg):
+            # bit 7 selects whether the marked bits are set or cleared
+            if val & 0x80:
+                self.regs[addr] |= val & 0x7F
+            else:
+                self.regs[addr] &= ~val
+            self._update_irq()
+        elif addr == self.Status2Reg:
+            self.regs[addr] = val & ~0x08
+            if not val & 0x08:
+                self.crypto = False
+        elif addr == self.CommandReg:
+            self.regs[addr] = val & 0xF0
+            self._done = None
+            self._command(val & 0x0F)
+        elif addr == self.BitFramingReg:
+            self.regs[addr] = val
+            if val & 0x80 and self.command == self.TRANSCEIVE:
+                self._transceive()
+        else:
+            self.regs[addr] = val
+            if addr in (self.CommIEnReg, self.DivlEnReg):
+                self._update_irq()
+
+    def _raise(self, comm=0, div=0):
+        self.regs[self.CommIrqReg] |= comm
+        self.regs[self.DivIrqReg] |= div
+        self._update_irq()
+
+    def _update_irq(self):
+        # The IRQ line is level driven; the host only sees its active edge
+        line = bool(self.regs[self.CommIrqReg] & self.regs[self.CommIEnReg] & 0x7F or
+                    self.regs[self.DivIrqReg] & self.regs[self.DivlEnReg] & 0x14)
+        if line and not self._irq_line and self._irq_callback is not None:
+            self._irq_callback(None)
+        self._irq_line = line
+
+    def _complete(self, comm, us):
+        # The command ends `us` from now
+        if self.has_irq:
+            self.clock_us += us
+            self._raise(comm=comm)
+        else:
+            self._done = (self.clock_us + us, comm)
+
+    def _timer_us(self):
+        prescaler = ((self.regs[self.TModeReg] & 0x0F) << 8) | self.regs[self.TPrescalerReg]
+        reload = (self.regs[self.TReloadRegH] << 8) | self.regs[self.TReloadRegL]
+        return (reload + 1) * (2 * prescaler + 1) / 13.56
+
+    # ===== commands =====
+    def _command(self, cmd):
+        if cmd == self.SOFTRESET:
+            self._reset_chip()
+            return
+        self.command = cmd
+        if cmd == self.CALCCRC:
+            crc = crc_a(self.fifo)
+            self.fifo = []
+            self.regs[self.CRCResultRegL], self.regs[self.CRCResultRegM] = crc
+            self.command = self.IDLE
+            self._raise(div=0x04)
+        elif cmd == self.AUTHENT:
+            self._authenticate()
+        elif cmd == self.IDLE:
+            pass
+
+    def _authenticate(self):
+        buf, self.fifo = self.fifo, []
+        self.regs[self.ErrorReg] = 0
+        self.command = self.IDLE
+        if len(buf) < 12:
+            self.regs[self.ErrorReg] |= 0x01
+            self._raise(comm=0x12)
+            return
+        mode, addr, key, uid = buf[0], buf[1], buf[2:8], buf[8:12]
+        self.frames += 1
+        us = 4 * 8 * self.RF_BIT_US + self.FRAME_DELAY_US
+        for card in self.cards:
+            if card.state in (card.ACTIVE, card.AUTH) and card.authenticate(mode, addr, key, uid):
+                self.crypto = True
+                self._complete(0x10, us)
+                return
+        # no answer: the timer expires, ProtocolErr
+        self.timeouts += 1
+        self.regs[self.ErrorReg] |= 0x01
+        self._complete(0x13, us + self._timer_us())
+
+    def _transceive(self):
+        framing = self.regs[self.BitFramingReg]
+        tx_last = framing & 0x07
+        rx_align = (framing >> 4) & 0x07
+        data, self.fifo = self.fifo, []
+        nbits = (len(data) - 1) * 8 + tx_last if tx_last else len(data) * 8
+        self.regs[self.ErrorReg] = 0
+        self.regs[self.CollReg] = (self.regs[self.CollReg] & 0x80) | 0x20
+        self.frames += 1
+        us = nbits * self.RF_BIT_US
+
+        answers = []
+        broken = False
+        if self.frame_loss and self.rng.random() < self.frame_loss:
+            pass
+        else:
+            for card in list(self.cards):
+                bits = card.frame(data, nbits, self.crypto)
+                if bits is None:
+                    continue
+                if card in self._leaving:
+                    if self._leaving[card] == 0:
+                        self.remove_card(card)
+                        bits = bits[:len(bits) // 2]
+                        broken = True
+                    else:
+                        self._leaving[card] -= 1
+                answers.append(bits)
+
+        if not answers:
+            self.timeouts += 1
+            self._complete(0x41, us + self._timer_us())     # TxIRq | TimerIRq
+            return
+
+        # Combine the answers bit by bit, recording the first collision
+        length = max(len(a) for a in answers)
+        bits = []
+        coll = None
+        for i in range(length):
+            column = set(a[i] for a in answers if i < len(a))
+            if len(column) > 1 and coll is None:
+                coll = i
+            bits.append(1 if 1 in column else 0)
+        us += self.FRAME_DELAY_US + length * self.RF_BIT_US
+
+        out, last = _pack(bits, rx_align)
+        self.fifo = out[:64]
+        self.regs[self.ControlReg] = (self.regs[self.ControlReg] & 0xF8) | last
+        if coll is not None:
+            # CollPos counts from the first bit of the received frame, 1-based
+            # and including the rx_align offset; 0 stands for 32
+            pos = coll + rx_align + 1
+            self.regs[self.ErrorReg] |= 0x08
+            self.regs[self.CollReg] = (self.regs[self.CollReg] & 0x80) | (pos & 0x1F if pos < 32 else 0)
+        if broken:
+            self.regs[self.ErrorReg] |= 0x02    # ParityErr
+        self._complete(0x70, us)        # TxIRq | RxIRq | IdleIRq
+
+    def stats(self):
+        return {"xfers": self.xfers, "xfer_bytes": self.xfer_bytes, "frames": self.frames,
+                "timeouts": self.timeouts, "clock_ms": round(self.clock_us / 1000.0, 3)}
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    from .SimpleMFRC522 import SimpleMFRC522
+
+    reads = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    for irq in (False, True):
+        sim = Simulator(irq=irq, seed=1)
+        sim.add_card(VirtualCard([0x12, 0x34, 0x56, 0x78], blocks={8: list(b"hello simulator!")}))
+        reader = SimpleMFRC522(transport=sim)
+        reader.READER.spi_calls = 0
+        base = sim.stats()
+        ok = 0
+        t0 = time.time()
+        for _ in range(reads):
+            reader.invalidate()
+            id, text = reader.read_no_block()
+            ok += bool(id)
+        wall = time.time() - t0
+        st = sim.stats()
+        print("irq=%s reads=%d ok=%d spi/read=%.1f bytes/read=%.1f sim ms/read=%.2f wall ms/read=%.3f" % (
+            irq, reads, ok, (st["xfers"] - base["xfers"]) / float(reads),
+            (st["xfer_bytes"] - base["xfer_bytes"]) / float(reads),
+            (st["clock_ms"] - base["clock_ms"]) / reads, wall * 1000 / reads))
@@ -0,0 +1,143 @@
+import threading
+
+
+class Transport(object):
+    """Link between MFRC522 and a chip.
+
+    xfer() performs one SPI transaction (chip select held for the whole
+    list) and returns the bytes clocked in. Transports that can signal the
+    chip's IRQ line set has_irq and call the registered callback on it.
+    """
+
+    has_irq = False
+
+    def xfer(self, data):
+        raise NotImplementedError
+
+    def set_irq_callback(self, callback):
+        pass
+
+    def close(self):
+        pass
+
+
+class SpiTransport(Transport):
+    """spidev + RPi.GPIO link to a real MFRC522.
+
+    spidev handles are shared by every reader on the same bus/device, and
+    transfers are serialised with one lock per SPI bus. With pin_cs several
+    readers share one spidev device and are selected through their own GPIO
+    chip-select line instead of CE0/CE1; either every reader on a spidev
+    device has a pin_cs or none does.
+    """
+
+    _spi_handles = {}
+    _bus_locks = {}
+    _rst_users = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, bus=0, device=0, spd=1000000, pin_mode=10, pin_rst=-1, pin_cs=None, pin_irq=None):
+        # Imported here so that the package can be used without a Raspberry Pi
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+
+        self.bus = bus
+        self.device = device
+        self.spd = spd
+        self.pin_cs = pin_cs
+        self.pin_irq = pin_irq
+        self.has_irq = pin_irq is not None
+        self.spi, self.bus_lock = self._open_spi(bus, device, spd, pin_cs is not None)
+
+        gpioMode = GPIO.getmode()
+
+        if gpioMode is None:
+            GPIO.setmode(pin_mode)
+        else:
+            pin_mode = gpioMode
+
+        if pin_rst == -1:
+            if pin_mode == 11:
+                pin_rst = 15
+            else:
+                pin_rst = 22
+
+        GPIO.setup(pin_rst, GPIO.OUT)
+        GPIO.output(pin_rst, 1)
+        self.pin_rst = pin_rst
+        with self._registry_lock:
+            self._rst_users[pin_rst] = self._rst_users.get(pin_rst, 0) + 1
+
+        if pin_cs is not None:
+            GPIO.setup(pin_cs, GPIO.OUT, initial=1)
+
+        if pin_irq is not None:
+            GPIO.setup(pin_irq, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+
+    def set_irq_callback(self, callback):
+        # IRQ is driven push-pull and inverted (active low) by MFRC522_Init
+        if self.pin_irq is not None:
+            self.GPIO.add_event_detect(self.pin_irq, self.GPIO.FALLING, callback=callback)
+
+    @classmethod
+    def _open_spi(cls, bus, device, spd, no_cs):
+        # The chip-select mode belongs to the spidev device rather than to
+        # a handle, so every reader sharing it must use the same mode
+        import spidev
+        with cls._registry_lock:
+            entry = cls._spi_handles.get((bus, device))
+            if entry is None:
+                spi = spidev.SpiDev()
+                spi.open(bus, device)
+                spi.max_speed_hz = spd
+                if no_cs:
+                    try:
+                        spi.no_cs = True
+                    except (IOError, OSError):
+                        pass
+                entry = cls._spi_handles[(bus, device)] = [spi, 0, no_cs]
+            elif entry[2] != no_cs:
+                raise ValueError("readers on SPI %d.%d must all use pin_cs, or none of them" % (bus, device))
+            entry[1] += 1
+            lock = cls._bus_locks.setdefault(bus, threading.RLock())
+            return entry[0], lock
+
+    @classmethod
+    def _release_spi(cls, bus, device):
+        with cls._registry_lock:
+            entry = cls._spi_handles.get((bus, device))
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0:
+                entry[0].close()
+                del cls._spi_handles[(bus, device)]
+
+    def xfer(self, data):
+        with self.bus_lock:
+            if self.pin_cs is None:
+                return self.spi.xfer2(data, self.spd)
+            self.GPIO.output(self.pin_cs, 0)
+            try:
+                return self.spi.xfer2(data, self.spd)
+            finally:
+                self.GPIO.output(self.pin_cs, 1)
+
+    def close(self):
+        # Only release what this reader owns; other readers may still be
+        # using the bus and their own pins
+        GPIO = self.GPIO
+        pins = []
+        with self._registry_lock:
+            self._rst_users[self.pin_rst] -= 1
+            if self._rst_users[self.pin_rst] <= 0:
+                del self._rst_users[self.pin_rst]
+                pins.append(self.pin_rst)
+        if self.pin_irq is not None:
+            GPIO.remove_event_detect(self.pin_irq)
+            pins.append(self.pin_irq)
+        if self.pin_cs is not None:
+            pins.append(self.pin_cs)
+        self._release_spi(self.bus, self.device)
+        if pins:
+            GPIO.cleanup(pins)
@@ -1,4 +1,6 @@
 from .MFRC522 import MFRC522
 from .SimpleMFRC522 import SimpleMFRC522
+from .ReaderManager import ReaderManager
+from .CardEvents import CardEvents
 
 name = "mfrc522"
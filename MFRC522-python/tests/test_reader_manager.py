@@ -0,0 +1,61 @@
+import threading
+
+from mfrc522 import ReaderManager, SimpleMFRC522
+from mfrc522.Simulator import Simulator, VirtualCard
+
+
+class SlowSimulator(Simulator):
+    """Holds every transfer until `release` is set"""
+
+    def __init__(self, *args, **kwargs):
+        Simulator.__init__(self, *args, **kwargs)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.closed = False
+
+    def xfer(self, data):
+        assert not self.closed, "transfer on a closed reader"
+        self.started.set()
+        self.release.wait()
+        return Simulator.xfer(self, data)
+
+    def close(self):
+        self.closed = True
+
+
+def test_poll_and_events():
+    sim = Simulator(cards=[VirtualCard([0x12, 0x34, 0x56, 0x78])])
+    cards = []
+    manager = ReaderManager(on_card=lambda name, id: cards.append((name, id)))
+    manager.add_reader("gate", reader=SimpleMFRC522(transport=sim))
+
+    events = manager.poll_once()
+    assert [event["event"] for event in events] == ["present"]
+    assert cards == [("gate", 0x1234567808)]
+
+
+def test_remove_reader_during_poll():
+    sim = SlowSimulator(cards=[VirtualCard([0x12, 0x34, 0x56, 0x78])])
+    manager = ReaderManager()
+    manager.add_reader("gate", reader=SimpleMFRC522(transport=sim))
+
+    sim.release.clear()
+    sim.started.clear()
+    poll = threading.Thread(target=manager.poll_once, daemon=True)
+    poll.start()
+    try:
+        assert sim.started.wait(5)
+
+        # the reader is closed only once the poll has finished with it
+        remove = threading.Thread(target=manager.remove_reader, args=("gate",), daemon=True)
+        remove.start()
+        remove.join(0.2)
+        assert remove.is_alive()
+        assert not sim.closed
+    finally:
+        sim.release.set()
+    poll.join(5)
+    remove.join(5)
+    assert sim.closed
+    assert manager.poll_once() == []
@@ -0,0 +1,246 @@
+# access_control.py — Quyết định cho phép/từ chối thẻ RFID ngay trên Pi (không phụ thuộc server)
+#   python access_control.py compile users.json acl.bin      # JSON → file nhị phân gọn
+#   python access_control.py check acl.bin 4328719364        # thử một UID
+#
+# users.json:
+#   {"rules": {"staff": [{"days": "mon-fri", "start": "07:00", "end": "19:00"}],
+#              "admin": []},                                  # [] = mọi lúc
+#    "cards": {"4328719364": "admin", "1234567890": "staff"}}
+#
+# UID là SimpleMFRC522.uid_to_num: thẻ 4 byte → 40 bit (kèm BCC, như trước),
+# thẻ 7/10 byte → 56/80 bit (trước đây chỉ lấy 5 byte đầu: cần cấp lại các thẻ này)
+import os, sys, json, math, time, struct, threading
+
+MAGIC    = b"ACL2"
+_MAGICS  = {b"ACL1": struct.Struct("<QH"),   # bản cũ: uid tối đa 64 bit, chỉ số rule
+            b"ACL2": struct.Struct("<QQH")}  # uid 128 bit (64 thấp, 64 cao), chỉ số rule
+_HDR  = struct.Struct("<4sI")   # magic, độ dài header JSON
+_REC  = _MAGICS[MAGIC]
+_MASK64 = (1 << 64) - 1
+
+DAY_NAMES = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+# ===== KHUNG GIỜ =====
+def _parse_days(spec):
+    """ "mon-fri", "sat,sun", ["mon", "wed"] hoặc None (mọi ngày) → bitmask"""
+    if spec is None:
+        return 0x7F
+    parts = spec.split(",") if isinstance(spec, str) else spec
+    mask = 0
+    for p in parts:
+        p = p.strip().lower()
+        if "-" in p:
+            a, b = (DAY_NAMES.index(x) for x in p.split("-"))
+            for d in range(a, b + 1):
+                mask |= 1 << d
+        else:
+            mask |= 1 << DAY_NAMES.index(p)
+    return mask
+
+def _parse_hhmm(s):
+    h, m = str(s).split(":")
+    return int(h) * 60 + int(m)
+
+class TimeWindow:
+    __slots__ = ("days", "start", "end")
+
+    def __init__(self, days=None, start="00:00", end="24:00"):
+        self.days = _parse_days(days)
+        self.start = _parse_hhmm(start)
+        self.end = _parse_hhmm(end)
+
+    def contains(self, tm):
+        minute = tm.tm_hour * 60 + tm.tm_min
+        if self.start <= self.end:
+            return bool(self.days >> tm.tm_wday & 1) and self.start <= minute < self.end
+        # qua nửa đêm (22:00-06:00): phần sau 0h thuộc ngày hôm trước
+        if minute >= self.start:
+            return bool(self.days >> tm.tm_wday & 1)
+        return minute < self.end and bool(self.days >> ((tm.tm_wday - 1) % 7) & 1)
+
+
+# ===== BLOOM FILTER =====
+class BloomFilter:
+    """Lọc trước: UID chắc chắn không có trong danh sách thì từ chối ngay"""
+
+    def __init__(self, n, fp_rate=0.01):
+        n = max(1, n)
+        self.m = max(64, int(-n * math.log(fp_rate) / (math.log(2) ** 2)))
+        self.k = max(1, round(self.m / n * math.log(2)))
+        self.bits = bytearray((self.m + 7) // 8)
+
+    def _positions(self, x):
+        # double hashing từ hai hàm trộn 64 bit; UID dài hơn 64 bit gộp phần cao vào trước
+        x = (x & _MASK64) ^ ((x >> 64) * 0xD6E8FEB86659FD93 & _MASK64)
+        h1 = (x * 0x9E3779B97F4A7C15) & _MASK64
+        h2 = (((x ^ (x >> 31)) * 0xBF58476D1CE4E5B9) & _MASK64) | 1
+        m = self.m
+        for i in range(self.k):
+            yield (h1 + i * h2) % m
+
+    def add(self, x):
+        for p in self._positions(x):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, x):
+        bits = self.bits
+        return all(bits[p >> 3] >> (p & 7) & 1 for p in self._positions(x))
+
+
+# ===== FILE NHỊ PHÂN =====
+def save(path, cards, rules):
+    """cards: {uid(int): tên rule}; rules: {tên: [ {days,start,end}, ... ]}"""
+    names = sorted(rules)
+    index = {n: i for i, n in enumerate(names)}
+    header = json.dumps({"rules": [rules[n] for n in names], "names": names,
+                         "ts": int(time.time())}, ensure_ascii=False).encode("utf-8")
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(_HDR.pack(MAGIC, len(header)))
+            f.write(header)
+            for uid in sorted(cards):
+                n = int(uid)
+                f.write(_REC.pack(n & _MASK64, n >> 64, index[cards[uid]]))
+    except BaseException:
+        if os.path.exists(tmp):  # không để lại file dở dang
+            os.remove(tmp)
+        raise
+    os.replace(tmp, path)  # thay thế nguyên tử, service đang đọc không thấy file dở dang
+
+def load(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, hlen = _HDR.unpack_from(data)
+    rec = _MAGICS.get(magic)
+    if rec is None:
+        raise ValueError(f"{path}: không phải file ACL")
+    header = json.loads(data[_HDR.size:_HDR.size + hlen].decode("utf-8"))
+    names = header["names"]
+    rules = dict(zip(names, header["rules"]))
+    cards = {}
+    for r in rec.iter_unpack(data[_HDR.size + hlen:]):
+        uid = r[0] if len(r) == 2 else r[0] | r[1] << 64
+        cards[uid] = names[r[-1]]
+    return cards, rules
+
+def load_json(path):
+    with open(path, "r", encoding="utf-8") as f:
+        src = json.load(f)
+    return {int(uid): rule for uid, rule in src["cards"].items()}, src.get("rules", {})
+
+
+# ===== ACCESS CONTROL =====
+class _Index:
+    """Ảnh bất biến của danh sách; reload dựng ảnh mới rồi đổi tham chiếu"""
+    __slots__ = ("cards", "rules", "windows", "bloom")
+
+    def __init__(self, cards, rules):
+        self.cards = dict(cards)
+        self.rules = dict(rules)
+        self.windows = {n: [TimeWindow(**w) for w in ws] for n, ws in rules.items()}
+        self.bloom = BloomFilter(len(self.cards))
+        for uid in self.cards:
+            self.bloom.add(uid)
+
+class AccessControl:
+    def __init__(self, path=None, cards=None, rules=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.denied = 0
+        self.loaded_at = None
+        if path and os.path.exists(path):
+            self.reload()
+        else:
+            self._set(cards or {}, rules or {})
+
+    def _set(self, cards, rules, persist=False):
+        unknown = set(cards.values()) - set(rules)
+        if unknown:
+            raise ValueError(f"rule không tồn tại: {', '.join(sorted(unknown))}")
+        index = _Index(cards, rules)
+        # ghi file trước khi đổi: lỗi ghi thì danh sách đang dùng vẫn khớp với file
+        if persist and self.path:
+            save(self.path, cards, rules)
+        self.index = index
+        self.loaded_at = time.time()
+
+    def reload(self):
+        self._set(*load(self.path))
+        print(f"ACL loaded: {len(self.index.cards)} cards, {len(self.index.rules)} rules")
+
+    def check(self, uid, now=None):
+        """→ (allowed, reason); reason: ok | unknown | outside_window"""
+        idx = self.index
+        uid = int(uid)
+        self.lookups += 1
+        if uid not in idx.bloom:
+            self.denied += 1
+            return False, "unknown"
+        rule = idx.cards.get(uid)
+        if rule is None:
+            self.denied += 1
+            return False, "unknown"
+        windows = idx.windows[rule]
+        if windows:
+            tm = time.localtime(now)
+            if not any(w.contains(tm) for w in windows):
+                self.denied += 1
+                return False, "outside_window"
+        return True, "ok"
+
+    def update(self, add=None, remove=None, rules=None):
+        """Sửa danh sách tại chỗ rồi ghi lại file (nếu có)"""
+        with self._lock:
+            cards = dict(self.index.cards)
+            new_rules = dict(self.index.rules)
+            new_rules.update(rules or {})
+            for uid in remove or []:
+                cards.pop(int(uid), None)
+            for uid, rule in (add or {}).items():
+                cards[int(uid)] = rule
+            self._set(cards, new_rules, persist=True)
+
+    # ===== MQTT hot reload =====
+    def on_reload_message(self, c, udata, msg):
+        """Payload rỗng/"reload": đọc lại file.
+        JSON {"add": {uid: rule}, "remove": [uid], "rules": {...}}: cập nhật từng phần.
+        JSON {"cards": {...}, "rules": {...}}: thay toàn bộ."""
+        try:
+            text = msg.payload.decode("utf-8").strip()
+            if not text or text == "reload":
+                with self._lock:
+                    self.reload()
+                return
+            data = json.loads(text)
+            if "cards" in data:
+                cards = {int(u): r for u, r in data["cards"].items()}
+                with self._lock:
+                    self._set(cards, data.get("rules", {}), persist=True)
+            else:
+                self.update(data.get("add"), data.get("remove"), data.get("rules"))
+            print(f"ACL updated: {len(self.index.cards)} cards")
+        except Exception as e:
+            print("ACL reload error:", e)
+
+    def stats(self):
+        return {"cards": len(self.index.cards), "lookups": self.lookups,
+                "denied": self.denied, "loaded_at": self.loaded_at}
+
+
+if __name__ == "__main__":
+    cmd = sys.argv[1] if len(sys.argv) > 1 else ""
+    if cmd == "compile" and len(sys.argv) == 4:
+        cards, rules = load_json(sys.argv[2])
+        AccessControl(cards=cards, rules=rules)  # kiểm tra rule trước khi ghi
+        save(sys.argv[3], cards, rules)
+        print(f"{sys.argv[3]}: {len(cards)} cards, {os.path.getsize(sys.argv[3])} bytes")
+    elif cmd == "check" and len(sys.argv) == 4:
+        acl = AccessControl(sys.argv[2])
+        t0 = time.perf_counter()
+        result = acl.check(sys.argv[3])
+        print(result, f"{(time.perf_counter() - t0) * 1e6:.1f} µs")
+    else:
+        print("usage: access_control.py compile users.json acl.bin | check acl.bin UID")
@@ -1,10 +1,13 @@
 # alert_service.py — Cảnh báo khí (Vout) + RFID xâm nhập
-import time, json, ssl, smtplib
+import os, time, json, ssl, signal, smtplib
 from email.message import EmailMessage
 import paho.mqtt.client as mqtt
 import config_alert as cfg
 
+AVAIL_TOPIC = "devices/alert/availability"
+
 # ===== STATE =====
+client = None    # mqtt.Client, tạo trong main()
 last_over_ts   = {}
 alert_active   = {}
 last_email_ts  = 0
@@ -150,6 +153,7 @@ def on_connect(c, udata, flags, rc):
     if rc == 0:
         for t in cfg.TOPICS_IN: c.subscribe(t, qos=1)
         c.subscribe(cfg.TOPIC_RFID_RESULT, qos=1)
+        c.publish(AVAIL_TOPIC, "online", qos=1, retain=True)
         print("MQTT connected & subscribed.")
     else:
         print("MQTT connect failed:", rc)
@@ -165,12 +169,30 @@ def on_message(c, udata, msg):
         handle_rfid(msg.topic, data)
 
 # ===== MAIN =====
-client = mqtt.Client(client_id="alert_service", protocol=mqtt.MQTTv311)
-client.username_pw_set(cfg.USER, cfg.PASSWORD)
-client.on_connect = on_connect
-client.on_message = on_message
-client.connect(cfg.BROKER, cfg.PORT, cfg.KEEPALIVE)
+def make_client():
+    c = mqtt.Client(client_id="alert_service", protocol=mqtt.MQTTv311)
+    c.username_pw_set(cfg.USER, getattr(cfg, "PASSWORD", getattr(cfg, "PASS", "")))
+    c.will_set(AVAIL_TOPIC, "offline", qos=1, retain=True)
+    c.on_connect = on_connect
+    c.on_message = on_message
+    return c
+
+def cleanup(*_):
+    try:
+        client.publish(AVAIL_TOPIC, "offline", qos=1, retain=True)
+        client.disconnect()
+    except Exception:
+        pass
+    os._exit(0)
 
-if __name__ == "__main__":
+def main():
+    global client
     print("Starting alert_service...")
-    client.loop_forever()
+    signal.signal(signal.SIGINT, cleanup)
+    signal.signal(signal.SIGTERM, cleanup)
+    client = make_client()
+    client.connect_async(cfg.BROKER, cfg.PORT, getattr(cfg, "KEEPALIVE", 60))
+    client.loop_forever(retry_first_connection=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+# bench_voice.py — đo độ trễ end-to-end của voice_service: uplink → STT → NLU → lệnh relay → TTS
+#   python bench_voice.py whisper/tests/jfk.flac samples/bat_den_hai.wav --repeat 10
+#   python bench_voice.py samples/*.wav --backend whisper --nlu-delay 0.4 --tts-stub --json out.json
+# Chạy trên Pi với config_mqtt thật; broker MQTT được thay bằng loopback trong process,
+# NLU mặc định trỏ tới nlu_mock_server (không gọi mạng).
+import sys, json, time, base64, argparse, threading, types
+import numpy as np
+import soundfile as sf
+import paho.mqtt.client as mqtt
+
+RATE = 16000
+STAGES = ["stt", "nlu", "cmd", "tts", "total"]
+
+
+class LoopbackBroker:
+    """Thay cho paho Client + broker: publish giao thẳng tới subscriber trong process."""
+
+    def __init__(self):
+        self._subs = []
+        self.published = 0
+
+    def subscribe(self, topic_filter, cb):
+        self._subs.append((topic_filter, cb))
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        now = time.monotonic()
+        self.published += 1
+        for flt, cb in self._subs:
+            if mqtt.topic_matches_sub(flt, topic):
+                cb(topic, payload, now)
+
+
+def load_pcm(path):
+    data, rate = sf.read(path, dtype="float32", always_2d=True)
+    x = data.mean(axis=1)
+    if rate != RATE:  # resample tuyến tính, đủ cho mục đích đo
+        n = int(round(len(x) * RATE / rate))
+        x = np.interp(np.linspace(0, len(x) - 1, n), np.arange(len(x)), x)
+    return (np.clip(x, -1, 1) * 32767).astype(np.int16).tobytes()
+
+
+def percentiles(xs):
+    if not xs:
+        return None
+    a = np.asarray(xs) * 1000
+    return {"n": len(xs), "mean": round(float(a.mean()), 1),
+            "p50": round(float(np.percentile(a, 50)), 1),
+            "p90": round(float(np.percentile(a, 90)), 1),
+            "p99": round(float(np.percentile(a, 99)), 1)}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("audio", nargs="*", default=["whisper/tests/jfk.flac"], help="file wav/flac (mono, mọi sample rate)")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--backend", choices=["vosk", "whisper"], default=None, help="ghi đè STT_BACKEND")
+    ap.add_argument("--nlu", choices=["mock", "real"], default="mock")
+    ap.add_argument("--nlu-delay", type=float, default=0.0, help="độ trễ giả lập của mock NLU (giây)")
+    ap.add_argument("--chunk-ms", type=int, default=100, help="kích thước mỗi gói uplink")
+    ap.add_argument("--tail-ms", type=int, default=1000, help="im lặng thêm sau câu để VAD chốt")
+    ap.add_argument("--fast", action="store_true", help="đẩy audio nhanh nhất có thể thay vì theo thời gian thực")
+    ap.add_argument("--tts-stub", action="store_true", help="bỏ espeak-ng, publish audio rỗng")
+    ap.add_argument("--timeout", type=float, default=30.0)
+    ap.add_argument("--json", default=None, help="ghi kết quả chi tiết ra file")
+    args = ap.parse_args()
+
+    # ===== ghi đè cấu hình trước khi import voice_service =====
+    import config_mqtt as cfg
+    if args.backend:
+        cfg.STT_BACKEND = args.backend
+    if args.nlu == "mock":
+        import nlu_mock_server
+        srv = nlu_mock_server.serve(port=0, delay_s=args.nlu_delay, background=True)
+        cfg.NLU_ENDPOINT = f"http://127.0.0.1:{srv.server_address[1]}"
+
+    t0 = time.monotonic()
+    import voice_service as vs
+    t_import = time.monotonic() - t0
+    times = vs.init_models()
+    print(f"voice_service import: {t_import * 1000:.0f} ms, init: {(time.monotonic() - t0 - t_import) * 1000:.0f} ms "
+          f"(nlu={times['nlu'] * 1000:.0f} ms, stt={times['stt'] * 1000:.0f} ms, backend={vs.STT_BACKEND})")
+
+    broker = LoopbackBroker()
+    vs.client = broker
+    marks, done = {}, threading.Event()
+
+    def mark(stage, now=None):
+        marks.setdefault(stage, now or time.monotonic())
+
+    stt_on_text = vs.stt.on_text
+    def on_text(stream, text):
+        mark("stt")
+        marks.setdefault("text", text)
+        stt_on_text(stream, text)
+    vs.stt.on_text = on_text
+
+    nlu_parse = vs.nlu.parse
+    def parse(text):
+        res = nlu_parse(text)
+        mark("nlu")
+        return res
+    vs.nlu.parse = parse
+
+    broker.subscribe(vs.TOPIC_CMD, lambda t, p, now: mark("cmd", now))
+    def on_tts(t, p, now):
+        mark("tts", now)
+        done.set()
+    broker.subscribe(vs.TOPIC_TTS_AUDIO, on_tts)
+    if args.tts_stub:
+        vs.tts_say = lambda text: vs.client.publish(vs.TOPIC_TTS_AUDIO, b"", qos=1)
+
+    threading.Thread(target=vs.stt_worker, daemon=True).start()
+
+    chunk = RATE * 2 * args.chunk_ms // 1000
+    topic = vs.TOPIC_AUDIO_UP.replace("+", "bench").replace("#", "bench")
+    tail = b"\x00\x00" * (RATE * args.tail_ms // 1000)
+
+    def send(buf):
+        for i in range(0, len(buf), chunk):
+            msg = types.SimpleNamespace(topic=topic, payload=base64.b64encode(buf[i:i + chunk]))
+            vs.on_message(broker, None, msg)
+            if not args.fast:
+                time.sleep(args.chunk_ms / 1000)
+
+    results = {s: [] for s in STAGES}
+    runs = []
+    clips = [(p, load_pcm(p)) for p in args.audio]
+    for r in range(args.repeat):
+        for path, pcm in clips:
+            marks.clear()
+            done.clear()
+            send(pcm)
+            speech_end = time.monotonic()
+            send(tail)
+            ok = done.wait(args.timeout)
+            time.sleep(0.2)  # chờ các sự kiện còn sót của câu trước
+
+            row = {"file": path, "run": r, "ok": ok, "text": marks.get("text")}
+            if "stt" in marks:
+                row["stt"] = marks["stt"] - speech_end
+                if "nlu" in marks:
+                    row["nlu"] = marks["nlu"] - marks["stt"]
+                    if "cmd" in marks:
+                        row["cmd"] = marks["cmd"] - marks["nlu"]
+                    if "tts" in marks:
+                        row["tts"] = marks["tts"] - max(marks["nlu"], marks.get("cmd", 0))
+                        row["total"] = marks["tts"] - speech_end
+            for s in STAGES:
+                if s in row:
+                    results[s].append(row[s])
+            runs.append(row)
+            print(f"[{r}] {path}: " + " ".join(f"{s}={row[s] * 1000:.0f}ms" for s in STAGES if s in row)
+                  + ("" if ok else "  (timeout)"))
+
+    summary = {s: percentiles(v) for s, v in results.items()}
+    print("\n stage      n     mean      p50      p90      p99   (ms)")
+    for s in STAGES:
+        p = summary[s]
+        if p:
+            print(f" {s:<6} {p['n']:>5} {p['mean']:>8} {p['p50']:>8} {p['p90']:>8} {p['p99']:>8}")
+    print("Queue:", vs.audio_q.stats())
+    print("NLU:", vs.nlu.stats())
+    print("VAD:", {k: v.stats() for k, v in vs.vads.items()})
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "runs": runs}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
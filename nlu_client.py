@@ -0,0 +1,128 @@
+# nlu_client.py — Gemini NLU dùng chung: giữ model/kết nối, JSON schema, timeout + fallback cục bộ
+import os, json, time, collections, threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+# Phần prompt tĩnh: dựng một lần, gửi dưới dạng system_instruction
+SYSTEM_PROMPT = """Hiểu lệnh tiếng Việt cho hệ thống nhà thông minh.
+Các thiết bị có thể điều khiển:
+- Đèn 1 (den1): ["đèn 1", "den 1", "den1", "đèn một", "đèn đầu"]
+- Đèn 2 (den2): ["đèn 2", "den 2", "den2", "đèn hai"]
+- Quạt 1 (quat1): ["quạt 1", "quat 1", "quat1", "quạt một"]
+- Quạt 2 (quat2): ["quạt 2", "quat 2", "quat2", "quạt hai"]
+- Tất cả (tatca): bật/tắt toàn bộ thiết bị.
+
+Trả về JSON đúng cấu trúc:
+{"intent":"DEVICE_CONTROL|STATUS_QUERY|UNKNOWN",
+  "device":"den1|den2|quat1|quat2|tatca|null",
+  "action":"ON|OFF|QUERY|null",
+  "confidence":0.0}"""
+
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "intent": {"type": "string", "format": "enum",
+                   "enum": ["DEVICE_CONTROL", "STATUS_QUERY", "UNKNOWN"]},
+        "device": {"type": "string", "format": "enum", "nullable": True,
+                   "enum": ["den1", "den2", "quat1", "quat2", "tatca"]},
+        "action": {"type": "string", "format": "enum", "nullable": True,
+                   "enum": ["ON", "OFF", "QUERY"]},
+        "confidence": {"type": "number"},
+    },
+    "required": ["intent", "device", "action", "confidence"],
+}
+
+# ===== Fallback cục bộ (không cần mạng) =====
+ALIASES = {
+    "den1":  ["đèn 1", "den 1", "den1", "đèn một", "đèn đầu"],
+    "den2":  ["đèn 2", "den 2", "den2", "đèn hai"],
+    "quat1": ["quạt 1", "quat 1", "quat1", "quạt một"],
+    "quat2": ["quạt 2", "quat 2", "quat2", "quạt hai"],
+    "tatca": ["tất cả", "tat ca", "tatca", "toàn bộ", "hết"],
+}
+ACTION_WORDS = [  # QUERY trước: "đang bật" không phải lệnh bật
+    ("QUERY", ["trạng thái", "đang bật", "đang tắt", "kiểm tra"]),
+    ("OFF",   ["tắt", "tat"]),
+    ("ON",    ["bật", "bat", "mở"]),
+]
+_ALIAS_INDEX = sorted(((a, d) for d, vs in ALIASES.items() for a in vs), key=lambda x: -len(x[0]))
+
+
+def parse_local(text):
+    """Hiểu lệnh bằng luật đơn giản theo ALIASES; dùng khi Gemini lỗi/timeout"""
+    low = " " + " ".join(str(text).lower().split()) + " "
+    device = next((d for a, d in _ALIAS_INDEX if f" {a} " in low), None)
+    action = next((act for act, ws in ACTION_WORDS if any(f" {w} " in low for w in ws)), None)
+    if device and action in ("ON", "OFF"):
+        return {"intent": "DEVICE_CONTROL", "device": device, "action": action, "confidence": 0.6}
+    if action == "QUERY":
+        return {"intent": "STATUS_QUERY", "device": device, "action": "QUERY", "confidence": 0.5}
+    return {"intent": "UNKNOWN", "device": None, "action": None, "confidence": 0.0}
+
+
+class GeminiNLU:
+    """Client NLU sống lâu: một GenerativeModel (và kết nối HTTP/gRPC bên dưới) dùng lại cho mọi lệnh."""
+
+    def __init__(self, model_name="models/gemini-2.5-flash", api_key=None, timeout_s=4.0,
+                 endpoint=None, local_first=False, history=200):
+        import google.generativeai as genai
+        kw = {"api_key": api_key or os.getenv("GOOGLE_API_KEY")}
+        if endpoint:  # ví dụ mock server cục bộ: "http://127.0.0.1:8765"
+            kw.update(transport="rest", client_options={"api_endpoint": endpoint})
+        genai.configure(**kw)
+        self.model = genai.GenerativeModel(
+            model_name,
+            system_instruction=SYSTEM_PROMPT,
+            generation_config=genai.GenerationConfig(
+                response_mime_type="application/json",
+                response_schema=RESPONSE_SCHEMA,
+                temperature=0.0,
+            ),
+        )
+        self.timeout_s = timeout_s
+        self.local_first = local_first      # lệnh khớp luật thì trả lời ngay, không gọi mạng
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="gemini")
+        self._lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=history)
+        self.calls = 0
+        self.fallbacks = 0
+        self.last_source = None
+
+    def _generate(self, text):
+        resp = self.model.generate_content(
+            f"Lệnh người dùng: {text}",
+            request_options={"timeout": self.timeout_s, "retry": None},
+        )
+        return json.loads(resp.text)
+
+    def parse(self, text):
+        t0 = time.monotonic()
+        data, source = None, "gemini"
+        if self.local_first:
+            local = parse_local(text)
+            if local["intent"] == "DEVICE_CONTROL":
+                data, source = local, "local"
+        if data is None:
+            try:
+                # chặn cứng thời gian chờ, kể cả khi transport tự retry/treo
+                data = self._pool.submit(self._generate, text).result(timeout=self.timeout_s)
+            except FutureTimeout:
+                print(f"NLU timeout ({self.timeout_s}s) → fallback cục bộ")
+            except Exception as e:
+                print("NLU error → fallback cục bộ:", e)
+            if not isinstance(data, dict):
+                data, source = parse_local(text), "fallback"
+
+        dt = time.monotonic() - t0
+        with self._lock:
+            self.calls += 1
+            self.fallbacks += source == "fallback"
+            self.latencies.append(dt)
+            self.last_source = source
+        return data
+
+    def stats(self):
+        with self._lock:
+            lat = sorted(self.latencies)
+        pick = lambda q: round(lat[min(len(lat) - 1, int(q * len(lat)))] * 1000, 1) if lat else None
+        return {"calls": self.calls, "fallbacks": self.fallbacks,
+                "p50_ms": pick(0.5), "p95_ms": pick(0.95), "last_source": self.last_source}
@@ -0,0 +1,70 @@
+# nlu_mock_server.py — giả lập REST generateContent của Gemini để chạy/bench NLU offline
+#   python nlu_mock_server.py --port 8765 --delay 0.3
+#   config_mqtt: NLU_ENDPOINT = "http://127.0.0.1:8765"
+import json, re, time, argparse, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from nlu_client import parse_local
+
+_PATH = re.compile(r"^/v1(beta)?/models/[^/:]+:generateContent$")
+
+
+class MockGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # giữ kết nối keep-alive như API thật
+    delay_s = 0.0
+    requests = 0
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0]
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if not _PATH.match(path):
+            return self._reply(404, {"error": {"code": 404, "message": f"unknown path {path}"}})
+        try:
+            req = json.loads(body or b"{}")
+            parts = req["contents"][-1]["parts"]
+            text = " ".join(p.get("text", "") for p in parts)
+            text = text.split("Lệnh người dùng:", 1)[-1].strip()
+        except Exception as e:
+            return self._reply(400, {"error": {"code": 400, "message": str(e)}})
+
+        type(self).requests += 1
+        if self.delay_s:
+            time.sleep(self.delay_s)
+        result = parse_local(text)
+        self._reply(200, {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"text": json.dumps(result, ensure_ascii=False)}]},
+                "finishReason": "STOP",
+                "index": 0,
+            }],
+            "usageMetadata": {"promptTokenCount": len(text.split()), "candidatesTokenCount": 20},
+        })
+
+    def _reply(self, code, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def serve(host="127.0.0.1", port=8765, delay_s=0.0, background=False):
+    handler = type("Handler", (MockGeminiHandler,), {"delay_s": delay_s})
+    server = ThreadingHTTPServer((host, port), handler)
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--delay", type=float, default=0.0, help="độ trễ giả lập mỗi request (giây)")
+    args = ap.parse_args()
+    srv = serve(args.host, args.port, args.delay)
+    print(f"Mock Gemini at http://{args.host}:{srv.server_address[1]} (delay={args.delay}s)")
+    srv.serve_forever()
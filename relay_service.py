@@ -3,7 +3,6 @@ import json
 import time
 import signal
 import threading
-import RPi.GPIO as GPIO
 import paho.mqtt.client as mqtt
 import config_mqtt as cfg
 
@@ -28,7 +27,6 @@ AVAIL_TOPIC     = "devices/relay/availability"
 # ===== GPIO cấu hình =====
 PIN_MODE = "BOARD"   # hoặc "BCM"
 if PIN_MODE.upper() == "BOARD":
-    GPIO.setmode(GPIO.BOARD)
     DEVICES = {
         "den1":  {"pin": 29, "active_high": False, "default": "OFF"},
         "den2":  {"pin": 31, "active_high": False, "default": "OFF"},
@@ -36,7 +34,6 @@ if PIN_MODE.upper() == "BOARD":
         "quat2": {"pin": 35, "active_high": False, "default": "OFF"},
     }
 else:
-    GPIO.setmode(GPIO.BCM)
     DEVICES = {
         "den1":  {"pin": 5,  "active_high": False, "default": "OFF"},
         "den2":  {"pin": 6,  "active_high": False, "default": "OFF"},
@@ -55,15 +52,23 @@ SCENES = {
     "all_off": [("den1", "OFF"), ("den2", "OFF"), ("quat1", "OFF"), ("quat2", "OFF")],
 }
 
-# ===== GPIO init =====
+# ===== GPIO init (trong main, không chạy khi import) =====
+GPIO = None
+ready = threading.Event()   # GPIO đã sẵn sàng → mới báo "online" và trạng thái thiết bị
+
 def _safe_init_level(d):
     if d["default"] == "OFF":
         return GPIO.LOW if d["active_high"] else GPIO.HIGH
     return GPIO.HIGH if d["active_high"] else GPIO.LOW
 
-for name, d in DEVICES.items():
-    GPIO.setup(d["pin"], GPIO.OUT, initial=_safe_init_level(d))
-_log("GPIO init done.")
+def init_gpio():
+    global GPIO
+    import RPi.GPIO as _GPIO
+    GPIO = _GPIO
+    GPIO.setmode(GPIO.BOARD if PIN_MODE.upper() == "BOARD" else GPIO.BCM)
+    for name, d in DEVICES.items():
+        GPIO.setup(d["pin"], GPIO.OUT, initial=_safe_init_level(d))
+    _log("GPIO init done.")
 
 def _set_device(name, action):
     d = DEVICES[name]
@@ -110,13 +115,20 @@ def _parse_duration(val):
     except:
         return 0
 
-def on_connect(cli, ud, flags, rc):
-    print("MQTT connected:", rc)
-    cli.subscribe([(TOPIC_CMD, 1)])  # Đảm bảo topic điều khiển được lắng nghe
+def _pub_online(cli):
+    # Chỉ nhận lệnh khi GPIO đã sẵn sàng: không giữ luồng mạng của paho để chờ
+    cli.subscribe([(TOPIC_CMD, 1)])
     cli.publish(AVAIL_TOPIC, "online", qos=1, retain=True)
     for name in DEVICES:
         _pub_state(cli, name, "ON" if _is_on(name) else "OFF")
 
+def on_connect(cli, ud, flags, rc):
+    print("MQTT connected:", rc)
+    if ready.is_set():
+        _pub_online(cli)
+    else:  # GPIO chưa init xong: main() sẽ subscribe và báo online
+        cli.publish(AVAIL_TOPIC, "starting", qos=1, retain=True)
+
 def on_message(cli, ud, msg):
     try:
         data = json.loads(msg.payload.decode())
@@ -152,7 +164,6 @@ if USER:
 client.will_set(AVAIL_TOPIC, "offline", qos=1, retain=True)
 client.on_connect = on_connect
 client.on_message = on_message
-client.connect(BROKER, PORT, KEEPALIVE)
 
 def cleanup(*_):
     try:
@@ -164,13 +175,25 @@ def cleanup(*_):
         client.disconnect()
     except:
         pass
-    GPIO.cleanup()
+    if GPIO is not None:
+        GPIO.cleanup()
     os._exit(0)
 
-import signal
-signal.signal(signal.SIGINT, cleanup)
-signal.signal(signal.SIGTERM, cleanup)
-
-client.loop_start()
-while True:
-    time.sleep(1)
+# ===== START SERVICE =====
+def main():
+    t0 = time.monotonic()
+    signal.signal(signal.SIGINT, cleanup)
+    signal.signal(signal.SIGTERM, cleanup)
+    # Kết nối broker chạy nền trong loop thread, song song với init GPIO
+    client.connect_async(BROKER, PORT, KEEPALIVE)
+    client.loop_start()
+    init_gpio()
+    ready.set()
+    if client.is_connected():
+        _pub_online(client)
+    _log(f"relay_service ready in {(time.monotonic() - t0) * 1000:.0f} ms")
+    while True:
+        time.sleep(1)
+
+if __name__ == "__main__":
+    main()
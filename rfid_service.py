@@ -0,0 +1,156 @@
+# rfid_service.py — Nhiều đầu đọc MFRC522 chung bus SPI (cổng trước, cổng sau...) → TOPIC_RFID_RESULT
+import os, json, time, signal, threading
+import paho.mqtt.client as mqtt
+from mfrc522 import ReaderManager
+from access_control import AccessControl
+import config_mqtt as cfg
+
+# ===== CẤU HÌNH =====
+TOPIC_RFID_RESULT = getattr(cfg, "TOPIC_RFID_RESULT", "access/rfid/result")
+TOPIC_ACL_RELOAD  = getattr(cfg, "TOPIC_ACL_RELOAD", "access/acl/reload")
+TOPIC_RFID_EVENTS = getattr(cfg, "TOPIC_RFID_EVENTS", "access/rfid/events")
+AVAIL_TOPIC       = "devices/rfid/availability"
+BASE_DIR          = os.path.dirname(os.path.abspath(__file__))
+ACL_PATH          = getattr(cfg, "ACL_PATH", os.path.join(BASE_DIR, "acl.bin"))
+
+# Mở khoá tại chỗ khi thẻ hợp lệ: {"gate": "khoa1"} → TOPIC_CMD ON trong UNLOCK_DURATION
+UNLOCK_DEVICES  = getattr(cfg, "RFID_UNLOCK_DEVICES", {})
+UNLOCK_DURATION = getattr(cfg, "RFID_UNLOCK_DURATION", "3s")
+
+# Mỗi đầu đọc: tên thiết bị (device trong payload), bus/device SPI,
+# pin_cs (GPIO chip-select riêng khi nhiều đầu đọc chung CE), pin_irq, priority
+READERS = getattr(cfg, "RFID_READERS", [
+    {"name": "gate", "bus": 0, "device": 0, "priority": 2},
+])
+HOLD_S  = getattr(cfg, "RFID_HOLD_S", 1.0)    # thẻ rời đi < HOLD_S rồi quay lại: vẫn tính là một lần
+MISS_THRESHOLD = getattr(cfg, "RFID_MISS_THRESHOLD", 3)  # số lần quét liên tiếp không thấy → thẻ đã rời
+CYCLE_S = getattr(cfg, "RFID_CYCLE_S", 0.05)  # nghỉ sau mỗi vòng quét
+INVENTORY = getattr(cfg, "RFID_INVENTORY", False)  # đọc mọi thẻ trong vùng (nhiều người quẹt cùng lúc)
+# Sự kiện present/removed gom thành lô → TOPIC_RFID_EVENTS (một mảng JSON)
+BATCH_MAX     = getattr(cfg, "RFID_BATCH_MAX", 20)
+BATCH_DELAY_S = getattr(cfg, "RFID_BATCH_DELAY_S", 0.5)
+
+
+# ===== ĐỐI TƯỢNG DỊCH VỤ (tạo trong main, không chạy khi import) =====
+acl = None       # AccessControl(ACL_PATH)
+client = None    # mqtt.Client
+manager = None   # ReaderManager
+ready = threading.Event()   # ACL + đầu đọc đã sẵn sàng → mới báo "online"
+
+# ===== QUYẾT ĐỊNH (cục bộ, không chờ server) =====
+
+def decide(device: str, uid: str):
+    """→ (status, reason); alert_service chỉ xử lý status "denied" """
+    allowed, reason = acl.check(uid)
+    return ("granted" if allowed else "denied"), reason
+
+# ===== PUBLISH =====
+def on_card(device, card_id):
+    uid = str(card_id)
+    status, reason = decide(device, uid)
+    lock = UNLOCK_DEVICES.get(device)
+    if status == "granted" and lock:
+        client.publish(cfg.TOPIC_CMD, json.dumps(
+            {"device": lock, "action": "ON", "duration": UNLOCK_DURATION}), qos=1)
+    payload = {"device": device, "uid": uid, "status": status,
+               "reason": reason, "ts": int(time.time())}
+    client.publish(TOPIC_RFID_RESULT, json.dumps(payload), qos=1)
+    print("RFID:", payload, flush=True)
+
+# ===== SỰ KIỆN (gom lô) =====
+class EventBatcher:
+    """Gom sự kiện, publish khi đủ max_batch hoặc sự kiện cũ nhất đã chờ max_delay_s"""
+    def __init__(self, publish, max_batch=20, max_delay_s=0.5):
+        self.publish = publish
+        self.max_batch = max_batch
+        self.max_delay_s = max_delay_s
+        self._buf = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def add(self, event):
+        with self._lock:
+            self._buf.append(event)
+            if len(self._buf) < self.max_batch:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.max_delay_s, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            batch, self._buf = self._buf, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if batch:
+            self.publish(batch)
+
+def publish_events(batch):
+    client.publish(TOPIC_RFID_EVENTS, json.dumps(batch), qos=1)
+
+batcher = EventBatcher(publish_events, BATCH_MAX, BATCH_DELAY_S)
+
+def on_event(event):
+    payload = {"event": event["event"], "device": event["reader"], "uid": str(event["id"]),
+               "ts": round(event["ts"], 3)}
+    if "dwell_s" in event:
+        payload["dwell_s"] = event["dwell_s"]
+    batcher.add(payload)
+
+# ===== MQTT =====
+def on_connect(c, udata, flags, rc):
+    print("MQTT connected:", rc)
+    c.subscribe(TOPIC_ACL_RELOAD, qos=1)
+    c.publish(AVAIL_TOPIC, "online" if ready.is_set() else "starting", qos=1, retain=True)
+
+def make_client():
+    c = mqtt.Client(client_id="rfid_service", protocol=mqtt.MQTTv311)
+    user = getattr(cfg, "USER", None)
+    if user:
+        c.username_pw_set(user, getattr(cfg, "PASSWORD", getattr(cfg, "PASS", "")))
+    c.will_set(AVAIL_TOPIC, "offline", qos=1, retain=True)
+    c.on_connect = on_connect
+    c.message_callback_add(TOPIC_ACL_RELOAD, acl.on_reload_message)
+    return c
+
+def cleanup(*_):
+    try:
+        batcher.flush()
+        client.publish(AVAIL_TOPIC, "offline", qos=1, retain=True)
+        client.loop_stop()
+        client.disconnect()
+    except Exception:
+        pass
+    if manager is not None:
+        manager.close()
+    os._exit(0)
+
+# ===== START SERVICE =====
+def main():
+    global acl, client, manager
+    t0 = time.monotonic()
+    signal.signal(signal.SIGINT, cleanup)
+    signal.signal(signal.SIGTERM, cleanup)
+    acl = AccessControl(ACL_PATH)
+    client = make_client()
+    # Kết nối broker chạy nền trong loop thread, song song với mở các đầu đọc
+    client.connect_async(cfg.BROKER, cfg.PORT, getattr(cfg, "KEEPALIVE", 60))
+    client.loop_start()
+
+    manager = ReaderManager(on_card=on_card, on_event=on_event, hold_s=HOLD_S, cycle_s=CYCLE_S,
+                            inventory=INVENTORY, miss_threshold=MISS_THRESHOLD)
+    for r in READERS:
+        r = dict(r)
+        manager.add_reader(r.pop("name"), priority=r.pop("priority", 1), **r)
+    print(f"RFID readers: {list(manager.readers)} schedule={manager._schedule}")
+
+    ready.set()
+    client.publish(AVAIL_TOPIC, "online", qos=1, retain=True)
+    print(f"rfid_service ready in {(time.monotonic() - t0) * 1000:.0f} ms", flush=True)
+    manager.run()
+
+if __name__ == "__main__":
+    main()
@@ -22,7 +22,11 @@ python voice_service.py &
 VOICE_PID=$!
 echo "voice_service PID=$VOICE_PID"
 
+python rfid_service.py &
+RFID_PID=$!
+echo "rfid_service PID=$RFID_PID"
+
 # Ghi PID ra file để dễ kill
-echo "$SENSOR_PID $RELAY_PID $ALERT_PID $VOICE_PID" > /tmp/smartaccess_pids.txt
+echo "$SENSOR_PID $RELAY_PID $ALERT_PID $VOICE_PID $RFID_PID" > /tmp/smartaccess_pids.txt
 echo "All services started. Use ./stop_all.sh to stop."
 wait
@@ -1,8 +1,8 @@
 #!/bin/bash
 if [ -f /tmp/smartaccess_pids.txt ]; then
     echo "Stopping all SmartAccess IoT services..."
-    while read -r SENSOR RELAY ALERT VOICE; do
-        kill $SENSOR $RELAY $ALERT $VOICE 2>/dev/null
+    while read -r SENSOR RELAY ALERT VOICE RFID; do
+        kill $SENSOR $RELAY $ALERT $VOICE $RFID 2>/dev/null
     done < /tmp/smartaccess_pids.txt
     rm -f /tmp/smartaccess_pids.txt
     echo "All services stopped."
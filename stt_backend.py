@@ -0,0 +1,235 @@
+# stt_backend.py — giao diện STT dùng chung: Vosk (streaming) và Whisper (theo câu, batch nhiều panel)
+import json, queue, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from dataclasses import replace
+import numpy as np
+
+SAMPLE_RATE = 16000
+
+# Từ vựng thiết bị làm initial_prompt cho Whisper (khớp ALIASES bên relay_service)
+DEVICE_PROMPT = ("Bật đèn 1, tắt đèn 2, bật quạt 1, tắt quạt 2, "
+                 "đèn một, đèn hai, quạt một, quạt hai, bật tất cả, tắt tất cả.")
+
+
+class STTBackend:
+    """Nhận PCM int16 đã qua VAD theo từng luồng (panel), gọi on_text(stream, text) khi có kết quả."""
+    name = "base"
+
+    def __init__(self, on_text):
+        self.on_text = on_text
+
+    def accept(self, stream, pcm):
+        """Đưa một đoạn PCM thuộc câu nói đang diễn ra của `stream`"""
+        raise NotImplementedError
+
+    def end_utterance(self, stream):
+        """VAD báo hết câu của `stream`"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# ===== Vosk =====
+class VoskBackend(STTBackend):
+    name = "vosk"
+
+    def __init__(self, on_text, model_path, rate=SAMPLE_RATE):
+        super().__init__(on_text)
+        from vosk import Model, KaldiRecognizer
+        self._recognizer = KaldiRecognizer
+        self.model = Model(model_path)
+        self.rate = rate
+        self._recs = {}  # mỗi panel một recognizer (có trạng thái)
+
+    def _rec(self, stream):
+        rec = self._recs.get(stream)
+        if rec is None:
+            rec = self._recs[stream] = self._recognizer(self.model, self.rate)
+        return rec
+
+    def _emit(self, stream, raw):
+        text = json.loads(raw).get("text", "").strip()
+        if text:
+            self.on_text(stream, text)
+
+    def accept(self, stream, pcm):
+        rec = self._rec(stream)
+        if rec.AcceptWaveform(pcm):
+            self._emit(stream, rec.Result())
+
+    def end_utterance(self, stream):
+        self._emit(stream, self._rec(stream).FinalResult())
+
+
+# ===== Whisper =====
+class WhisperBackend(STTBackend):
+    """Model load một lần và giữ thường trú; các câu kết thúc gần nhau (nhiều panel)
+    được gom trong `batch_window_s` rồi decode chung để dùng một lượt encoder.
+
+    dynamic_ctx: encoder chỉ chạy trên phần mel đủ cho câu dài nhất của batch (lệnh 2 s
+    → ~200 vị trí thay vì 1500); câu nào kết quả kém được decode lại với đủ 30 s."""
+    name = "whisper"
+
+    def __init__(self, on_text, model_name="base", device=None, language="vi",
+                 initial_prompt=DEVICE_PROMPT, batch_window_s=0.15, max_batch=8,
+                 download_root=None, dynamic_ctx=True,
+                 logprob_threshold=-1.0, compression_ratio_threshold=2.4):
+        super().__init__(on_text)
+        import torch
+        import whisper
+        self.torch = torch
+        self.whisper = whisper
+        self.model = whisper.load_model(model_name, device=device, download_root=download_root)
+        fp16 = self.model.device.type != "cpu"
+        self.options = whisper.DecodingOptions(
+            language=language, prompt=initial_prompt, without_timestamps=True, fp16=fp16,
+            static_kv_cache=True,
+        )
+        self.transcribe_kwargs = dict(language=language, initial_prompt=initial_prompt, fp16=fp16)
+        self.batch_window_s = batch_window_s
+        self.max_batch = max_batch
+        self.dynamic_ctx = dynamic_ctx
+        self.logprob_threshold = logprob_threshold
+        self.compression_ratio_threshold = compression_ratio_threshold
+        self.full_ctx_retries = 0
+
+        self._bufs = {}
+        self._pending = queue.Queue()
+        self.batches = 0
+        self.utterances = 0
+        self._thread = threading.Thread(target=self._decode_loop, daemon=True)
+        self._thread.start()
+
+    def accept(self, stream, pcm):
+        self._bufs.setdefault(stream, bytearray()).extend(pcm)
+
+    def end_utterance(self, stream):
+        buf = self._bufs.pop(stream, None)
+        if buf:
+            audio = np.frombuffer(bytes(buf), dtype=np.int16).astype(np.float32) / 32768.0
+            self._pending.put((stream, audio))
+
+    def close(self):
+        self._pending.put(None)
+
+    def _collect(self):
+        first = self._pending.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window_s
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._pending.put(None)  # để vòng sau thoát
+                break
+            batch.append(item)
+        return batch
+
+    def _decode_loop(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            try:
+                texts = self.transcribe_batch([audio for _, audio in batch])
+            except Exception as e:
+                print("Whisper error:", e)
+                continue
+            for (stream, _), text in zip(batch, texts):
+                if text:
+                    self.on_text(stream, text)
+
+    def transcribe_batch(self, audios):
+        w, n_samples = self.whisper, self.whisper.audio.N_SAMPLES
+        texts = [None] * len(audios)
+        short = [i for i, a in enumerate(audios) if len(a) <= n_samples]
+        if short:
+            mel = self.torch.stack([
+                w.log_mel_spectrogram(w.pad_or_trim(audios[i]), self.model.dims.n_mels)
+                for i in short
+            ]).to(self.model.device)
+            options = self.options
+            if self.dynamic_ctx:
+                n_frames = max(len(audios[i]) for i in short) // w.audio.HOP_LENGTH + 1
+                ctx = w.audio.audio_ctx_for(n_frames, self.model.dims.n_audio_ctx)
+                if ctx < self.model.dims.n_audio_ctx:
+                    options = replace(options, audio_ctx=ctx)
+            results = w.decode(self.model, mel, options)
+            if options.audio_ctx is not None:
+                # kết quả kém với context ngắn → decode lại các câu đó với đủ 30 s
+                retry = [k for k, res in enumerate(results) if self._poor(res)]
+                if retry:
+                    full = w.decode(self.model, mel[retry], self.options)
+                    for k, res in zip(retry, full):
+                        results[k] = res
+                    self.full_ctx_retries += len(retry)
+            for i, res in zip(short, results):
+                texts[i] = res.text.strip()
+            self.batches += 1
+        for i, a in enumerate(audios):
+            if texts[i] is None:  # câu dài hơn 30 s: để transcribe tự chia cửa sổ
+                texts[i] = self.model.transcribe(a, **self.transcribe_kwargs)["text"].strip()
+        self.utterances += len(audios)
+        return texts
+
+    def _poor(self, res):
+        return (res.avg_logprob < self.logprob_threshold
+                or res.compression_ratio > self.compression_ratio_threshold)
+
+
+# ===== Whisper server =====
+class WhisperServerBackend(STTBackend):
+    """Gửi từng câu tới `whisper.server` (model thường trú, continuous batching): câu của các
+    panel và job transcribe khác ghép vào cùng batch decode ngay ở bước kế tiếp, không cần
+    gom theo cửa sổ thời gian như WhisperBackend."""
+    name = "whisper_server"
+
+    def __init__(self, on_text, url="http://127.0.0.1:8766", language="vi",
+                 initial_prompt=DEVICE_PROMPT, timeout_s=30.0, max_inflight=8):
+        super().__init__(on_text)
+        params = {"language": language} if language else {}
+        if initial_prompt:
+            params["prompt"] = initial_prompt
+        self.url = url.rstrip("/") + "/transcribe?" + urlencode(params)
+        self.timeout_s = timeout_s
+        self._bufs = {}
+        self._pool = ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix="stt")
+
+    def accept(self, stream, pcm):
+        self._bufs.setdefault(stream, bytearray()).extend(pcm)
+
+    def end_utterance(self, stream):
+        buf = self._bufs.pop(stream, None)
+        if buf:
+            self._pool.submit(self._transcribe, stream, bytes(buf))
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+    def _transcribe(self, stream, pcm):
+        req = Request(self.url, data=pcm, headers={"Content-Type": "application/octet-stream"})
+        try:
+            with urlopen(req, timeout=self.timeout_s) as resp:
+                text = json.loads(resp.read()).get("text", "").strip()
+        except Exception as e:
+            print("Whisper server error:", e)
+            return
+        if text:
+            self.on_text(stream, text)
+
+
+def create_backend(name, on_text, **kwargs):
+    backends = {b.name: b for b in (VoskBackend, WhisperBackend, WhisperServerBackend)}
+    if name not in backends:
+        raise ValueError(f"Unknown STT backend: {name} (có: {', '.join(backends)})")
+    return backends[name](on_text, **kwargs)
@@ -0,0 +1,89 @@
+import random
+import struct
+import time
+
+import pytest
+
+import access_control
+from access_control import AccessControl, BloomFilter, TimeWindow, load, save
+
+# uid_to_num of 4- (with BCC), 7- and 10-byte UIDs
+UID4 = 0x12345678 << 8 | (0x12 ^ 0x34 ^ 0x56 ^ 0x78)
+UID7 = 0x04112233445566
+UID10 = 0x08010203040506070809
+RULES = {"admin": [], "night": [{"days": "fri", "start": "22:00", "end": "06:00"}]}
+
+
+def local(s):
+    return time.strptime(s, "%Y-%m-%d %H:%M")
+
+
+def test_save_load(tmp_path):
+    path = str(tmp_path / "acl.bin")
+    cards = {UID4: "admin", UID7: "night", UID10: "admin"}
+    save(path, cards, RULES)
+    assert load(path) == (cards, RULES)
+
+    acl = AccessControl(path)
+    assert acl.check(UID10) == (True, "ok")
+    assert acl.check(UID10 ^ 1 << 70) == (False, "unknown")
+
+
+def test_load_v1(tmp_path):
+    path = tmp_path / "acl.bin"
+    header = b'{"rules": [[]], "names": ["admin"], "ts": 0}'
+    rec = struct.Struct("<QH")
+    path.write_bytes(struct.pack("<4sI", b"ACL1", len(header)) + header + rec.pack(UID4, 0))
+    assert load(str(path)) == ({UID4: "admin"}, {"admin": []})
+
+
+def test_update_failed_save(tmp_path, monkeypatch):
+    path = str(tmp_path / "acl.bin")
+    save(path, {UID4: "admin"}, RULES)
+    acl = AccessControl(path)
+
+    def fail(*args):
+        raise OSError("disk full")
+
+    # the list in use keeps matching the file when the write fails
+    monkeypatch.setattr(access_control, "save", fail)
+    with pytest.raises(OSError):
+        acl.update(add={UID7: "admin"})
+    assert acl.check(UID7) == (False, "unknown")
+    assert load(path)[0] == {UID4: "admin"}
+
+    monkeypatch.undo()
+    with pytest.raises(ValueError):
+        acl.update(add={UID7: "missing"})
+    acl.update(add={UID7: "admin"}, remove=[UID4])
+    assert load(path)[0] == {UID7: "admin"}
+    assert acl.check(UID4) == (False, "unknown")
+
+
+def test_bloom_filter():
+    rng = random.Random(0)
+    members = [rng.getrandbits(80) for _ in range(1000)]
+    bloom = BloomFilter(len(members), fp_rate=0.01)
+    for uid in members:
+        bloom.add(uid)
+    assert all(uid in bloom for uid in members)
+
+    # UIDs that differ only above bit 64 are hashed apart too
+    others = [uid ^ 1 << 72 for uid in members] + [rng.getrandbits(40) for _ in range(1000)]
+    false_positives = sum(uid in bloom for uid in others)
+    assert false_positives < 0.03 * len(others)
+
+
+def test_time_window_past_midnight():
+    # 2026-10-16 is a Friday
+    window = TimeWindow(days="fri", start="22:00", end="06:00")
+    assert window.contains(local("2026-10-16 23:30"))
+    assert window.contains(local("2026-10-17 05:59"))      # Saturday morning, from Friday night
+    assert not window.contains(local("2026-10-17 06:00"))
+    assert not window.contains(local("2026-10-16 05:00"))  # Friday morning, from Thursday night
+    assert not window.contains(local("2026-10-17 23:00"))
+    assert not window.contains(local("2026-10-16 21:59"))
+
+    acl = AccessControl(cards={UID7: "night"}, rules=RULES)
+    assert acl.check(UID7, time.mktime(local("2026-10-17 01:00"))) == (True, "ok")
+    assert acl.check(UID7, time.mktime(local("2026-10-17 12:00"))) == (False, "outside_window")
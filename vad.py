@@ -0,0 +1,166 @@
+# vad.py — VAD năng lượng + zero-crossing cho luồng PCM 16 kHz mono int16
+import collections, time
+import numpy as np
+
+
+class EnergyVAD:
+    """Lọc các frame im lặng/nhiễu và cắt luồng PCM thành từng câu nói.
+
+    feed(pcm) trả về danh sách sự kiện:
+      ("audio", bytes) — đoạn PCM thuộc câu nói, đưa vào recognizer
+      ("end", None)    — câu nói vừa kết thúc
+    poll() gọi định kỳ: luồng ngừng gửi giữa câu (panel mất kết nối, nhả nút)
+    quá idle_timeout_s thì tự chốt câu, không để đoạn PCM nằm chờ mãi.
+    enabled=False: không lọc, mọi PCM đi thẳng, câu được cắt mỗi max_utterance_s
+    (và khi luồng ngừng) để các backend chỉ decode khi "end" vẫn có kết quả.
+    """
+
+    def __init__(self, rate=16000, frame_ms=20, energy_db=-45.0, snr_db=9.0,
+                 zcr_max=0.35, start_frames=3, hangover_frames=15,
+                 preroll_frames=10, max_utterance_s=15.0, noise_alpha=0.05,
+                 idle_timeout_s=1.0, enabled=True):
+        self.rate = rate
+        self.frame_len = rate * frame_ms // 1000          # số mẫu / frame
+        self.frame_bytes = self.frame_len * 2             # int16
+        self.energy_db = energy_db                        # ngưỡng năng lượng tuyệt đối (dBFS)
+        self.snr_db = snr_db                              # ngưỡng vượt nền nhiễu (dB)
+        self.zcr_max = zcr_max                            # ZCR cao + năng lượng thấp = nhiễu
+        self.start_frames = start_frames                  # số frame speech liên tiếp để bắt đầu câu
+        self.hangover_frames = hangover_frames            # số frame im lặng để kết thúc câu
+        self.max_frames = int(max_utterance_s * 1000 / frame_ms)
+        self.noise_alpha = noise_alpha
+        self.idle_timeout_s = idle_timeout_s
+        self.enabled = enabled
+
+        self._pending = b""
+        self._preroll = collections.deque(maxlen=max(preroll_frames, start_frames))
+        self._noise_db = None
+        self._speech_run = 0
+        self._silence_run = 0
+        self._utt_frames = 0
+        self._last_feed = time.monotonic()
+        self.triggered = False
+
+        # counters
+        self.frames_in = 0
+        self.frames_speech = 0
+        self.frames_skipped = 0
+        self.utterances = 0
+
+    # ===== frame features =====
+    def _features(self, buf):
+        x = np.frombuffer(buf, dtype=np.int16).astype(np.float32) / 32768.0
+        frames = x.reshape(-1, self.frame_len)
+        energy_db = 10.0 * np.log10(np.mean(frames * frames, axis=1) + 1e-12)
+        signs = np.signbit(frames)
+        zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+        return energy_db, zcr
+
+    def _is_speech(self, e_db, zcr):
+        if self._noise_db is None:
+            self._noise_db = min(e_db, self.energy_db - self.snr_db)
+        thr = max(self.energy_db, self._noise_db + self.snr_db)
+        speech = e_db > thr and (zcr < self.zcr_max or e_db > thr + self.snr_db)
+        if not speech:  # chỉ cập nhật nền nhiễu bằng frame không phải speech
+            self._noise_db += self.noise_alpha * (e_db - self._noise_db)
+        return speech
+
+    # ===== main API =====
+    def _start_utterance(self):
+        self.triggered = True
+        self.utterances += 1
+        self._silence_run = 0
+
+    def _end_utterance(self):
+        self.triggered = False
+        self._speech_run = self._utt_frames = 0
+
+    def feed(self, pcm):
+        self._last_feed = time.monotonic()
+        if not self.enabled:
+            return self._feed_passthrough(pcm)
+
+        buf = self._pending + pcm
+        n = len(buf) // self.frame_bytes
+        self._pending = buf[n * self.frame_bytes:]
+        if n == 0:
+            return []
+
+        events, out = [], []
+        energy_db, zcr = self._features(buf[:n * self.frame_bytes])
+        for i in range(n):
+            frame = buf[i * self.frame_bytes:(i + 1) * self.frame_bytes]
+            speech = self._is_speech(float(energy_db[i]), float(zcr[i]))
+            self.frames_in += 1
+
+            if not self.triggered:
+                self._preroll.append(frame)
+                self._speech_run = self._speech_run + 1 if speech else 0
+                if self._speech_run >= self.start_frames:
+                    # bắt đầu câu: đẩy cả phần preroll để không mất âm đầu
+                    self._start_utterance()
+                    self.frames_skipped -= len(self._preroll) - 1
+                    self.frames_speech += len(self._preroll)
+                    self._utt_frames = len(self._preroll)
+                    out.extend(self._preroll)
+                    self._preroll.clear()
+                else:
+                    self.frames_skipped += 1
+                continue
+
+            out.append(frame)
+            self.frames_speech += 1
+            self._utt_frames += 1
+            self._silence_run = 0 if speech else self._silence_run + 1
+            if self._silence_run >= self.hangover_frames or self._utt_frames >= self.max_frames:
+                events.append(("audio", b"".join(out)))
+                events.append(("end", None))
+                out = []
+                self._end_utterance()
+
+        if out:
+            events.append(("audio", b"".join(out)))
+        return events
+
+    def _feed_passthrough(self, pcm):
+        # VAD tắt: cả luồng là câu nói, cắt theo cửa sổ cố định max_utterance_s
+        if not pcm:
+            return []
+        if not self.triggered:
+            self._start_utterance()
+        n = (len(self._pending) + len(pcm)) // self.frame_bytes
+        self._pending = (self._pending + pcm)[n * self.frame_bytes:]
+        self.frames_in += n
+        self.frames_speech += n
+        self._utt_frames += n
+        events = [("audio", pcm)]
+        if self._utt_frames >= self.max_frames:
+            events.append(("end", None))
+            self._end_utterance()
+        return events
+
+    def poll(self, now=None):
+        """Chốt câu đang dở nếu luồng đã ngừng gửi quá idle_timeout_s"""
+        if not self.triggered or self.idle_timeout_s is None:
+            return []
+        now = time.monotonic() if now is None else now
+        if now - self._last_feed < self.idle_timeout_s:
+            return []
+        self._pending = b""
+        self._end_utterance()
+        return [("end", None)]
+
+    def reset(self):
+        self._pending = b""
+        self._preroll.clear()
+        self._speech_run = self._silence_run = self._utt_frames = 0
+        self.triggered = False
+
+    def stats(self):
+        return {
+            "frames_in": self.frames_in,
+            "frames_speech": self.frames_speech,
+            "frames_skipped": self.frames_skipped,
+            "utterances": self.utterances,
+            "noise_db": round(self._noise_db, 1) if self._noise_db is not None else None,
+        }
@@ -1,77 +1,177 @@
-# voice_service.py — Vosk STT + Gemini NLU + eSpeak-NG TTS
-import os, json, re, base64, queue, threading, soundfile as sf
+# voice_service.py — STT (Vosk/Whisper) + Gemini NLU + eSpeak-NG TTS
+import os, json, base64, time, signal, collections, threading, soundfile as sf
+from concurrent.futures import ThreadPoolExecutor
 import paho.mqtt.client as mqtt
-import google.generativeai as genai
-from vosk import Model, KaldiRecognizer
 import subprocess, tempfile
 import config_mqtt as cfg
+from vad import EnergyVAD
+from stt_backend import create_backend, DEVICE_PROMPT
+from nlu_client import GeminiNLU
+
+# ===== Audio queue =====
+class AudioRing:
+    """Hàng đợi vòng có giới hạn: khi đầy thì bỏ chunk cũ nhất (drop-oldest)
+    để độ trễ không tích lũy khi recognizer bị chậm."""
+
+    def __init__(self, maxlen):
+        self._q = collections.deque(maxlen=maxlen)
+        self._cv = threading.Condition()
+        self.dropped = 0
+        self.max_depth = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def put(self, item):
+        with self._cv:
+            if len(self._q) == self._q.maxlen:
+                self.dropped += 1
+            self._q.append((time.monotonic(), item))
+            self.max_depth = max(self.max_depth, len(self._q))
+            self._cv.notify()
+
+    def get(self, timeout=None):
+        """Lấy chunk cũ nhất; trả về None nếu hết `timeout` (s) mà hàng đợi vẫn rỗng"""
+        with self._cv:
+            if not self._cv.wait_for(lambda: self._q, timeout):
+                return None
+            ts, item = self._q.popleft()
+        self.last_lag = time.monotonic() - ts
+        self.max_lag = max(self.max_lag, self.last_lag)
+        return item
+
+    def stats(self):
+        return {
+            "depth": len(self._q),
+            "max_depth": self.max_depth,
+            "dropped": self.dropped,
+            "lag_ms": round(self.last_lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+        }
 
 # ===== INIT =====
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-model_path = "/home/pi/models/vosk-vi"
-vosk_model = Model(model_path)
-rec = KaldiRecognizer(vosk_model, 16000)
-audio_q = queue.Queue()
+audio_q = AudioRing(getattr(cfg, "AUDIO_QUEUE_MAX", 256))
+
+# NLU (gọi mạng) và TTS chạy trên executor riêng, STT không bao giờ phải chờ
+nlu_pool = ThreadPoolExecutor(max_workers=getattr(cfg, "NLU_WORKERS", 2), thread_name_prefix="nlu")
+tts_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tts")   # 1 worker: câu TTS không chen nhau
+
+# VAD: bỏ frame im lặng/nhiễu trước recognizer, cắt câu nói rõ ràng (mỗi panel một VAD)
+VAD_PARAMS = dict(
+    energy_db=getattr(cfg, "VAD_ENERGY_DB", -45.0),
+    snr_db=getattr(cfg, "VAD_SNR_DB", 9.0),
+    zcr_max=getattr(cfg, "VAD_ZCR_MAX", 0.35),
+    start_frames=getattr(cfg, "VAD_START_FRAMES", 3),
+    hangover_frames=getattr(cfg, "VAD_HANGOVER_FRAMES", 15),
+    max_utterance_s=getattr(cfg, "VAD_MAX_UTTERANCE_S", 15.0),
+    idle_timeout_s=getattr(cfg, "VAD_IDLE_TIMEOUT_S", 1.0),   # luồng ngừng gửi giữa câu → chốt câu
+    enabled=getattr(cfg, "VAD_ENABLED", True),
+)
+VAD_POLL_S = 0.2
+vads = {}
+
+def _vad_for(stream):
+    v = vads.get(stream)
+    if v is None:
+        v = vads[stream] = EnergyVAD(**VAD_PARAMS)
+    return v
+
+# ===== STT backend =====
+STT_BACKEND = getattr(cfg, "STT_BACKEND", "vosk")   # "vosk" | "whisper" | "whisper_server"
+if STT_BACKEND == "whisper_server":  # model dùng chung: python -m whisper.server --language vi
+    STT_KWARGS = dict(
+        url=getattr(cfg, "WHISPER_SERVER_URL", "http://127.0.0.1:8766"),
+        language=getattr(cfg, "WHISPER_LANGUAGE", "vi"),
+        initial_prompt=getattr(cfg, "WHISPER_PROMPT", DEVICE_PROMPT),
+    )
+elif STT_BACKEND == "whisper":
+    STT_KWARGS = dict(
+        model_name=getattr(cfg, "WHISPER_MODEL", "base"),
+        language=getattr(cfg, "WHISPER_LANGUAGE", "vi"),
+        initial_prompt=getattr(cfg, "WHISPER_PROMPT", DEVICE_PROMPT),
+        batch_window_s=getattr(cfg, "WHISPER_BATCH_WINDOW_S", 0.15),
+        max_batch=getattr(cfg, "WHISPER_MAX_BATCH", 8),
+        dynamic_ctx=getattr(cfg, "WHISPER_DYNAMIC_CTX", True),
+    )
+else:
+    STT_KWARGS = dict(model_path=getattr(cfg, "VOSK_MODEL_PATH", "/home/pi/models/vosk-vi"))
 
 # ===== MQTT setup =====
 client = mqtt.Client(client_id="voice_service", protocol=mqtt.MQTTv311)
 client.username_pw_set(cfg.USER, getattr(cfg, "PASSWORD", getattr(cfg, "PASS", "")))
-client.connect(cfg.BROKER, cfg.PORT, getattr(cfg, "KEEPALIVE", 60))
 
 TOPIC_AUDIO_UP = cfg.TOPIC_AUDIO_UP      # ESP32-UI → Pi (base64 PCM)
 TOPIC_TTS_TEXT = cfg.TOPIC_TTS_TEXT      # Pi ← text từ các service khác
 TOPIC_TTS_AUDIO = cfg.TOPIC_TTS_AUDIO    # Pi → ESP32-UI (base64 PCM TTS)
 TOPIC_CMD       = cfg.TOPIC_CMD          # publish điều khiển thiết bị
+AVAIL_TOPIC     = "devices/voice/availability"
 
 # ====== STT worker ======
+def on_stt_text(stream, text):
+    print(f"STT[{stream}]:", text)
+    nlu_pool.submit(handle_text, text)
+
+# ===== Model (tải trong init_models, không chạy khi import) =====
+nlu = None
+stt = None
+ready = threading.Event()
+
+def init_nlu():
+    global nlu
+    nlu = GeminiNLU(
+        model_name=getattr(cfg, "GEMINI_MODEL", "models/gemini-2.5-flash"),
+        timeout_s=getattr(cfg, "NLU_TIMEOUT_S", 4.0),
+        endpoint=getattr(cfg, "NLU_ENDPOINT", None),        # mock server khi test offline
+        local_first=getattr(cfg, "NLU_LOCAL_FIRST", False),
+    )
+
+def init_stt():
+    global stt
+    stt = create_backend(STT_BACKEND, on_stt_text, **STT_KWARGS)
+
+def init_models():
+    """Tải NLU (import genai) và STT (model Vosk/Whisper) song song; trả về thời gian từng phần (s)"""
+    def timed(fn):
+        t0 = time.monotonic()
+        fn()
+        return time.monotonic() - t0
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        f_nlu, f_stt = ex.submit(timed, init_nlu), ex.submit(timed, init_stt)
+        return {"nlu": f_nlu.result(), "stt": f_stt.result()}
+
+def _dispatch(stream, v, events):
+    for kind, data in events:
+        if kind == "audio":
+            stt.accept(stream, data)
+        else:  # VAD báo hết câu → backend chốt kết quả
+            stt.end_utterance(stream)
+            print(f"VAD[{stream}]:", v.stats(), "| Q:", audio_q.stats())
+
 def stt_worker():
     while True:
-        pcm = audio_q.get()
-        if rec.AcceptWaveform(pcm):
-            res = json.loads(rec.Result())
-            text = res.get("text", "").strip()
-            if text:
-                print("STT:", text)
-                handle_text(text)
+        item = audio_q.get(timeout=VAD_POLL_S)
+        if item is not None:
+            stream, pcm = item
+            v = _vad_for(stream)
+            _dispatch(stream, v, v.feed(pcm))
+        # panel ngừng gửi giữa câu: chốt câu sau idle_timeout_s
+        for stream, v in list(vads.items()):
+            _dispatch(stream, v, v.poll())
 
 # ====== NLU ======
 def handle_text(text):
     """Gửi text sang Gemini NLU và xử lý kết quả"""
     try:
-        prompt = f"""
-Hiểu lệnh tiếng Việt cho hệ thống nhà thông minh.
-Các thiết bị có thể điều khiển:
-- Đèn 1 (den1): ["đèn 1", "den 1", "den1", "đèn một", "đèn đầu"]
-- Đèn 2 (den2): ["đèn 2", "den 2", "den2", "đèn hai"]
-- Quạt 1 (quat1): ["quạt 1", "quat 1", "quat1", "quạt một"]
-- Quạt 2 (quat2): ["quạt 2", "quat 2", "quat2", "quạt hai"]
-- Tất cả (tatca): bật/tắt toàn bộ thiết bị.
-
-Trả về JSON đúng cấu trúc:
-{{"intent":"DEVICE_CONTROL|STATUS_QUERY|UNKNOWN",
-  "device":"den1|den2|quat1|quat2|tatca|null",
-  "action":"ON|OFF|QUERY|null",
-  "confidence":0.0}}
-
-Lệnh người dùng: {text}
-"""
-        resp = genai.GenerativeModel("models/gemini-2.5-flash").generate_content(prompt)
-        raw = resp.text.strip()
-        raw = re.sub(r"^```json", "", raw)
-        raw = re.sub(r"^```", "", raw)
-        raw = re.sub(r"```$", "", raw).strip()
-
-        data = json.loads(raw)
-        print("NLU:", data)
+        data = nlu.parse(text)
+        print("NLU:", data, "|", nlu.stats())
 
         if data.get("intent") == "DEVICE_CONTROL" and data.get("device"):
             client.publish(TOPIC_CMD, json.dumps(data), qos=1)
-            tts_say(f"Đã {data.get('action','')} {data.get('device','')}")
+            tts_pool.submit(tts_say, f"Đã {data.get('action','')} {data.get('device','')}")
         else:
-            tts_say("Không hiểu lệnh.")
+            tts_pool.submit(tts_say, "Không hiểu lệnh.")
     except Exception as e:
         print("NLU error:", e)
-        tts_say("Lỗi hiểu lệnh.")
+        tts_pool.submit(tts_say, "Lỗi hiểu lệnh.")
 
 # ====== TTS ======
 def tts_say(text):
@@ -90,25 +190,53 @@ def tts_say(text):
 # ===== MQTT callbacks =====
 def on_connect(c, u, f, rc):
     print("MQTT connected:", rc)
+    # Audio đến trước khi model sẵn sàng nằm chờ trong audio_q
     c.subscribe([(TOPIC_AUDIO_UP, 1), (TOPIC_TTS_TEXT, 1)])
+    c.publish(AVAIL_TOPIC, "online" if ready.is_set() else "starting", qos=1, retain=True)
 
 def on_message(c, u, msg):
-    if msg.topic == TOPIC_AUDIO_UP:
+    if mqtt.topic_matches_sub(TOPIC_AUDIO_UP, msg.topic):   # topic có thể dùng wildcard cho nhiều panel
         try:
             pcm = base64.b64decode(msg.payload)
-            audio_q.put(pcm)
+            audio_q.put((msg.topic, pcm))
         except Exception as e:
             print("Decode error:", e)
     elif msg.topic == TOPIC_TTS_TEXT:
         try:
             data = json.loads(msg.payload)
-            tts_say(data.get("text",""))
+            tts_pool.submit(tts_say, data.get("text",""))
         except Exception as e:
             print("TTS text error:", e)
 
+client.will_set(AVAIL_TOPIC, "offline", qos=1, retain=True)
 client.on_connect = on_connect
 client.on_message = on_message
 
+def cleanup(*_):
+    try:
+        client.publish(AVAIL_TOPIC, "offline", qos=1, retain=True)
+        client.loop_stop()
+        client.disconnect()
+    except Exception:
+        pass
+    os._exit(0)
+
 # ===== START SERVICE =====
-threading.Thread(target=stt_worker, daemon=True).start()
-client.loop_forever()
+def main():
+    t0 = time.monotonic()
+    signal.signal(signal.SIGINT, cleanup)
+    signal.signal(signal.SIGTERM, cleanup)
+    # Kết nối broker chạy nền trong loop thread, song song với tải model
+    client.connect_async(cfg.BROKER, cfg.PORT, getattr(cfg, "KEEPALIVE", 60))
+    client.loop_start()
+    times = init_models()
+    threading.Thread(target=stt_worker, daemon=True).start()
+    ready.set()
+    client.publish(AVAIL_TOPIC, "online", qos=1, retain=True)
+    print(f"voice_service ready in {(time.monotonic() - t0) * 1000:.0f} ms "
+          f"(nlu={times['nlu'] * 1000:.0f} ms, stt={times['stt'] * 1000:.0f} ms)", flush=True)
+    while True:
+        time.sleep(1)
+
+if __name__ == "__main__":
+    main()
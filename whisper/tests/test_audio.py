@@ -2,7 +2,13 @@ import os.path
 
 import numpy as np
 
-from whisper.audio import SAMPLE_RATE, load_audio, log_mel_spectrogram
+from whisper.audio import (
+    FRAMES_PER_SECOND,
+    SAMPLE_RATE,
+    audio_ctx_for,
+    load_audio,
+    log_mel_spectrogram,
+)
 
 
 def test_audio():
@@ -17,3 +23,12 @@ def test_audio():
 
     assert np.allclose(mel_from_audio, mel_from_file)
     assert mel_from_audio.max() - mel_from_audio.min() <= 2.0
+
+
+def test_audio_ctx_for():
+    # 2 seconds of audio + 1 second margin is below the 4-second floor
+    assert audio_ctx_for(2 * FRAMES_PER_SECOND) == 200
+    assert audio_ctx_for(10 * FRAMES_PER_SECOND) == 550
+    assert audio_ctx_for(10 * FRAMES_PER_SECOND, margin=0.0) == 500
+    assert audio_ctx_for(30 * FRAMES_PER_SECOND) == 1500
+    assert audio_ctx_for(29 * FRAMES_PER_SECOND, 1500) == 1500
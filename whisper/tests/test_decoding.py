@@ -0,0 +1,242 @@
+import pytest
+import torch
+
+import whisper
+
+
+@pytest.fixture(scope="module")
+def mel():
+    torch.manual_seed(0)
+    audio = torch.randn(3, 2 * whisper.audio.SAMPLE_RATE) * 0.1
+    return whisper.log_mel_spectrogram(whisper.pad_or_trim(audio))
+
+
+def decode(model, mel, **kwargs):
+    options = whisper.DecodingOptions(fp16=False, language="en", sample_len=24, **kwargs)
+    return whisper.decode(model, mel, options)
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"without_timestamps": True}])
+def test_static_kv_cache(model, mel, kwargs):
+    expected = decode(model, mel, **kwargs)
+    results = decode(model, mel, static_kv_cache=True, **kwargs)
+    for r, e in zip(results, expected):
+        assert r.tokens == e.tokens
+        assert r.avg_logprob == pytest.approx(e.avg_logprob, abs=1e-4)
+
+
+def test_static_kv_cache_beam_search(model, mel):
+    expected = decode(model, mel, beam_size=3)
+    results = decode(model, mel, beam_size=3, static_kv_cache=True)
+    for r, e in zip(results, expected):
+        assert r.tokens == e.tokens
+
+
+@pytest.mark.parametrize("kwargs", [{"beam_size": 3}, {"temperature": (0.0, 0.5)}])
+def test_shared_cross_attention(model, mel, kwargs):
+    torch.manual_seed(0)
+    results = decode(model, mel, **kwargs)
+    n_results = len(results) // len(mel)
+    for i in range(len(mel)):
+        torch.manual_seed(0)
+        expected = decode(model, mel[i : i + 1], **kwargs)
+        assert results[i * n_results].tokens == expected[0].tokens
+        assert results[i * n_results].audio_features.shape == (1500, 64)
+
+
+def test_beam_search_update():
+    class NoopInference(whisper.decoding.Inference):
+        def rearrange_kv_cache(self, source_indices):
+            self.source_indices = source_indices
+
+    eot, inference = 4, NoopInference()
+    decoder = whisper.decoding.BeamSearchDecoder(2, eot, inference)
+    tokens = torch.tensor([[0], [0]])
+    logits = torch.tensor([[3.0, 5.0, 2.0, 1.0, 4.0]]).repeat(2, 1)
+    sum_logprobs = torch.zeros(2)
+    logprobs = logits[0].log_softmax(dim=-1)
+
+    # identical beams are expanded once; EOT ranked above the second kept token finishes
+    tokens, completed = decoder.update(tokens, logits, sum_logprobs)
+    assert tokens.tolist() == [[0, 1], [0, 0]]
+    assert inference.source_indices == [0, 0]
+    assert sum_logprobs.tolist() == pytest.approx(logprobs[[1, 0]].tolist())
+    assert not completed
+
+    tokens = tokens.reshape(1, 2, -1)
+    sequences, scores = decoder.finalize(tokens, sum_logprobs.reshape(1, 2))
+    assert [s.tolist() for s in sequences[0]] == [[0, eot], [0, 1, eot]]
+    assert scores[0] == pytest.approx([logprobs[eot].item(), logprobs[1].item()])
+
+
+def test_timestamp_rules_incremental_state():
+    tokenizer = whisper.tokenizer.get_tokenizer(True, language="en")
+    timestamp_begin, sample_begin = tokenizer.timestamp_begin, 3
+    incremental = whisper.decoding.ApplyTimestampRules(tokenizer, sample_begin, 50)
+
+    generator = torch.Generator().manual_seed(0)
+    tokens = torch.zeros(4, sample_begin, dtype=torch.long)
+    for step in range(20):
+        logits = torch.randn(4, 51865, generator=generator)
+        logits[:, timestamp_begin:] += 4 * torch.randn(4, 1, generator=generator)
+        expected = logits.clone()
+
+        # a fresh filter derives its state from the whole token history
+        whisper.decoding.ApplyTimestampRules(tokenizer, sample_begin, 50).apply(
+            expected, tokens
+        )
+        incremental.apply(logits, tokens)
+        assert torch.equal(logits, expected)
+
+        next_tokens = logits.argmax(dim=-1, keepdim=True)
+        tokens = torch.cat([tokens, next_tokens], dim=-1)
+        if step % 5 == 4:
+            source_indices = torch.tensor([1, 1, 3, 0])
+            tokens = tokens[source_indices]
+            incremental.rearrange(source_indices)
+
+
+def test_compiled_suppression(model):
+    options = whisper.DecodingOptions(fp16=False, language="en")
+    task = whisper.decoding.DecodingTask(model, options)
+    tokenizer, sample_begin = task.tokenizer, task.sample_begin
+    filters = [
+        whisper.decoding.SuppressBlank(tokenizer, sample_begin),
+        whisper.decoding.SuppressTokens(task._get_suppress_tokens()),
+    ]
+    compiled = task.logit_filters[0]
+    assert isinstance(compiled, whisper.decoding.SuppressIndex)
+
+    for n_tokens in [sample_begin, sample_begin + 1]:
+        tokens = torch.zeros(2, n_tokens, dtype=torch.long)
+        logits = torch.randn(2, model.dims.n_vocab)
+        expected = logits.clone()
+        for logit_filter in filters:
+            logit_filter.apply(expected, tokens)
+        expected[:, tokenizer.no_timestamps] = -float("inf")
+        compiled.apply(logits, tokens)
+        assert torch.equal(logits, expected)
+
+
+def test_multiple_temperatures(model, mel):
+    expected = decode(model, mel[:1])
+    results = decode(model, mel[:1], temperature=(0.0, 0.5, 1.0))
+    assert [r.temperature for r in results] == [0.0, 0.5, 1.0]
+    assert results[0].tokens == expected[0].tokens
+    for result in results:
+        assert result.no_speech_prob == pytest.approx(expected[0].no_speech_prob)
+
+    results = decode(model, mel[:1], temperature=(0.5, 1.0), best_of=2)
+    assert [r.temperature for r in results] == [0.5, 1.0]
+
+    with pytest.raises(ValueError):
+        decode(model, mel[:1], temperature=(0.0, 0.5), beam_size=2)
+    with pytest.raises(ValueError, match="best_of"):
+        decode(model, mel[:1], temperature=(0.0, 0.5), best_of=2)
+
+
+def test_early_stop(model, mel):
+    results = decode(model, mel, early_stop_logprob=0.0, early_stop_len=4)
+    assert all(len(r.tokens) == 4 for r in results)
+
+    class EndFirst(whisper.decoding.LogitFilter):
+        """ends the first sequence after one token, with a log probability of 0"""
+
+        def __init__(self, sample_begin: int):
+            self.sample_begin = sample_begin
+
+        def apply(self, logits, tokens):
+            if tokens.shape[1] - self.sample_begin < 2:
+                logits[0, [hello, eot][tokens.shape[1] - self.sample_begin]] = 1e4
+
+    def decode_early_stop(**kwargs):
+        options = whisper.DecodingOptions(
+            fp16=False,
+            language="en",
+            sample_len=8,
+            without_timestamps=True,
+            early_stop_logprob=-1e-3,
+            early_stop_len=4,
+            **kwargs,
+        )
+        task = whisper.decoding.DecodingTask(model, options)
+        task.logit_filters.append(EndFirst(task.sample_begin))
+        return task.run(mel)
+
+    # the sequence that ended and was removed from the batch still counts
+    tokenizer = whisper.tokenizer.get_tokenizer(True)
+    hello, eot = tokenizer.encode(" hello")[0], tokenizer.eot
+    expected = decode_early_stop(compact_batch=False)
+    results = decode_early_stop()
+    assert [r.tokens for r in results] == [r.tokens for r in expected]
+    assert any(len(r.tokens) > 4 for r in results)
+
+
+def test_audio_ctx(model, mel):
+    # any context up to n_audio_ctx works, with language detection too
+    for audio_ctx in (1, model.dims.n_mels, 200):
+        options = whisper.DecodingOptions(fp16=False, sample_len=4, audio_ctx=audio_ctx)
+        assert whisper.decode(model, mel[:1], options)[0].language
+    for audio_ctx in (0, model.dims.n_audio_ctx + 1):
+        with pytest.raises(ValueError, match="audio_ctx"):
+            decode(model, mel, audio_ctx=audio_ctx)
+
+    # a mel of n_audio_state frames has the shape of features over n_mels positions
+    short_mel = mel[0, :, : model.dims.n_audio_state]
+    with pytest.raises(ValueError, match="encoded"):
+        whisper.detect_language(model, short_mel)
+    tokens, _ = whisper.detect_language(model, short_mel, encoded=False)
+    audio_features = model.encoder(short_mel[None])[0]
+    assert tokens == whisper.detect_language(model, audio_features, encoded=True)[0]
+
+
+@pytest.mark.parametrize(
+    "kwargs", [{}, {"static_kv_cache": True}, {"temperature": (0.0, 0.0)}]
+)
+def test_compact_batch(model, mel, kwargs):
+    class ForceEOT(whisper.decoding.LogitFilter):
+        """ends each sequence after the given number of sampled tokens"""
+
+        def __init__(self, sample_begin: int, lengths: torch.Tensor):
+            self.sample_begin = sample_begin
+            self.initial_lengths = lengths
+
+        def reset(self):
+            self.lengths = self.initial_lengths
+
+        def rearrange(self, source_indices):
+            self.lengths = self.lengths[source_indices]
+
+        def apply(self, logits, tokens):
+            ended = self.lengths == tokens.shape[1] - self.sample_begin
+            logits[ended, eot] = 1e4
+
+    def decode_with_lengths(**kwargs):
+        options = whisper.DecodingOptions(
+            fp16=False, language="en", sample_len=24, without_timestamps=True, **kwargs
+        )
+        task = whisper.decoding.DecodingTask(model, options)
+        task.logit_filters.append(ForceEOT(task.sample_begin, lengths))
+        torch.manual_seed(0)
+        return task.run(mel)
+
+    eot = whisper.tokenizer.get_tokenizer(True).eot
+    n_group = len(kwargs.get("temperature", (0.0,)))
+    lengths = torch.tensor([3, 20, 7, 12, 1, 5][: len(mel) * n_group])
+    expected = decode_with_lengths(compact_batch=False, **kwargs)
+    results = decode_with_lengths(**kwargs)
+    for r, e in zip(results, expected):
+        assert r.tokens == e.tokens
+        assert r.avg_logprob == pytest.approx(e.avg_logprob, abs=1e-4)
+    assert [len(r.tokens) for r in results] == lengths.tolist()
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"beam_size": 2, "static_kv_cache": True}])
+def test_prompt_per_audio(model, mel, kwargs):
+    options = whisper.DecodingOptions(fp16=False, language="en", sample_len=24, **kwargs)
+    prompts = [None, "hello there my friend", [1, 2, 3]]
+    results = whisper.decoding.DecodingTask(model, options, prompts).run(mel)
+    for i, prompt in enumerate(prompts):
+        expected = decode(model, mel[i : i + 1], prompt=prompt, **kwargs)
+        assert results[i].tokens == expected[0].tokens
+        assert results[i].avg_logprob == pytest.approx(expected[0].avg_logprob, abs=1e-4)
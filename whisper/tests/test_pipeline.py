@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+import whisper
+from whisper.pipeline import transcribe_files
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"condition_on_previous_text": False}])
+def test_transcribe_files(model, kwargs):
+    torch.manual_seed(0)
+    audios = [
+        torch.randn(seconds * whisper.audio.SAMPLE_RATE).numpy() * 0.1
+        for seconds in [70, 20, 45, 5]
+    ]
+    options = dict(
+        language="en",
+        fp16=False,
+        temperature=0.0,
+        logprob_threshold=None,
+        compression_ratio_threshold=None,
+        **kwargs,
+    )
+    expected = [whisper.transcribe(model, audio, **options) for audio in audios]
+
+    results = {}
+    for audio, future in transcribe_files(model, audios, batch_files=3, **options):
+        results[id(audio)] = future.result()
+    for audio, e in zip(audios, expected):
+        segments = results[id(audio)]["segments"]
+        assert [s["tokens"] for s in segments] == [s["tokens"] for s in e["segments"]]
+        assert [s["start"] for s in segments] == [s["start"] for s in e["segments"]]
+        assert [s["avg_logprob"] for s in segments] == pytest.approx(
+            [s["avg_logprob"] for s in e["segments"]], abs=1e-4
+        )
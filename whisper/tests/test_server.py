@@ -0,0 +1,101 @@
+import http.client
+import json
+from dataclasses import replace
+
+import pytest
+import torch
+
+import whisper
+from whisper.server import ContinuousBatchScheduler, serve
+
+
+def test_padded_decoder(model):
+    torch.manual_seed(0)
+    xa = torch.randn(2, 1500, 64)
+    tokens = torch.randint(0, 50000, (2, 6))
+    expected = model.decoder(tokens[1:, 2:], xa[1:])
+
+    # the second sequence is left-padded with two positions
+    padding = torch.zeros(2, 6, dtype=torch.bool)
+    padding[1, :2] = True
+    logits = model.decoder(tokens, xa, padding=padding)
+    assert torch.allclose(logits[1, 2:], expected[0], atol=1e-4)
+
+
+def test_continuous_batching(model):
+    options = whisper.DecodingOptions(fp16=False, language="en", sample_len=24)
+    prompts = [None, "hello there", None, "a b c d", "x", None]
+    torch.manual_seed(0)
+    audios = [torch.randn((1 + i % 3) * whisper.audio.SAMPLE_RATE) * 0.1 for i in range(6)]
+
+    scheduler = ContinuousBatchScheduler(model, max_batch=3, options=options)
+    futures = []
+    for i, (audio, prompt) in enumerate(zip(audios, prompts)):
+        futures.append(scheduler.submit(audio, prompt=prompt))
+        for _ in range(i % 3 + 1):  # requests join while others are being decoded
+            scheduler.step()
+    while scheduler.active or not scheduler.pending.empty():
+        scheduler.step()
+
+    for future, audio, prompt in zip(futures, audios, prompts):
+        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(audio))
+        expected = whisper.decode(
+            model, mel, replace(options, without_timestamps=True, prompt=prompt)
+        )
+        result = future.result()
+        assert result.tokens == expected.tokens
+        assert result.avg_logprob == pytest.approx(expected.avg_logprob, abs=1e-4)
+    assert scheduler.stats["completed"] == len(audios)
+
+    with pytest.raises(ValueError):
+        scheduler.submit(audios[0], beam_size=2)
+
+
+def test_failed_step(model):
+    options = whisper.DecodingOptions(fp16=False, language="en", sample_len=8)
+    scheduler = ContinuousBatchScheduler(model, options=options)
+    audio = torch.randn(whisper.audio.SAMPLE_RATE) * 0.1
+
+    def fail(*args):
+        raise RuntimeError("decoding failed")
+
+    # a failing step fails the requests in flight, and the scheduler keeps serving
+    scheduler.inference.add_sequences = fail
+    futures = [scheduler.submit(audio), scheduler.submit(audio)]
+    scheduler.start()
+    for future in futures:
+        with pytest.raises(RuntimeError, match="decoding failed"):
+            future.result(timeout=30)
+    del scheduler.inference.add_sequences
+    assert scheduler.submit(audio).result(timeout=30).tokens
+
+    # stopping cancels the requests that are not finished
+    scheduler.stop()
+    future = scheduler.submit(audio)
+    scheduler.stop()
+    assert future.cancelled()
+    assert scheduler.stats["failed"] == 2
+
+
+def test_http_bad_body(model):
+    options = whisper.DecodingOptions(fp16=False, language="en", sample_len=8)
+    scheduler = ContinuousBatchScheduler(model, options=options)
+    server = serve(scheduler, port=0, background=True)
+    try:
+        conn = http.client.HTTPConnection(*server.server_address, timeout=30)
+        for body in [b"", b"\x00\x01\x02"]:
+            conn.request("POST", "/transcribe", body)
+            response = conn.getresponse()
+            assert response.status == 400
+            assert "error" in json.loads(response.read())
+
+        # the connection is still usable
+        audio = (torch.randn(whisper.audio.SAMPLE_RATE) * 3000).short().numpy()
+        conn.request("POST", "/transcribe?language=en", audio.tobytes())
+        response = conn.getresponse()
+        assert response.status == 200
+        assert "text" in json.loads(response.read())
+    finally:
+        server.shutdown()
+        server.server_close()
+        scheduler.stop()
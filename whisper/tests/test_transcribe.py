@@ -1,4 +1,5 @@
 import os
+import sys
 
 import pytest
 import torch
@@ -40,3 +41,44 @@ def test_transcribe(model_name: str):
                 timing_checked = True
 
     assert timing_checked
+
+
+@pytest.mark.parametrize("dynamic_audio_ctx", [False, True])
+def test_audio_ctx_retry(model, monkeypatch, dynamic_audio_ctx: bool):
+    decoded, aligned = [], []
+
+    def decode(mel, options):
+        decoded.append((mel, options.audio_ctx))
+        return whisper.decode(model, mel, options)
+
+    def add_word_timestamps(*, segments, mel, **kwargs):
+        aligned.append(mel)
+        for segment in segments:
+            segment["words"] = []
+
+    monkeypatch.setattr(model, "decode", decode)
+    # the module is shadowed by the function in the package namespace
+    module = sys.modules["whisper.transcribe"]
+    monkeypatch.setattr(module, "add_word_timestamps", add_word_timestamps)
+
+    torch.manual_seed(0)
+    audio = torch.randn(2 * whisper.audio.SAMPLE_RATE) * 0.1
+    model.transcribe(
+        audio,
+        language="en",
+        fp16=False,
+        temperature=0.0,
+        logprob_threshold=0.0,  # every result needs a fallback
+        no_speech_threshold=None,
+        word_timestamps=True,
+        audio_ctx=1000,
+        dynamic_audio_ctx=dynamic_audio_ctx,
+    )
+
+    # one decoding per window with the explicit context, or the shortened one then a retry
+    expected = [200, 1000] if dynamic_audio_ctx else [1000]
+    assert [audio_ctx for _, audio_ctx in decoded] == expected * len(aligned)
+
+    # the words are aligned on the mel segment that was decoded last
+    retried = [mel for mel, audio_ctx in decoded if audio_ctx == 1000]
+    assert all(a is b for a, b in zip(aligned, retried))
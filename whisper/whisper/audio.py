@@ -88,6 +88,24 @@ def pad_or_trim(array, length: int = N_SAMPLES, *, axis: int = -1):
     return array
 
 
+def audio_ctx_for(
+    num_frames: int,
+    n_audio_ctx: int = N_FRAMES // 2,
+    *,
+    margin: float = 1.0,
+    min_ctx: int = 200,
+) -> int:
+    """
+    Number of encoder positions to use for audio spanning `num_frames` mel frames.
+
+    The context covers the audio plus `margin` seconds of trailing silence, and is never shorter
+    than `min_ctx` positions (4 seconds by default): much shorter contexts are too far from the
+    30-second windows the model was trained on and degrade the transcription.
+    """
+    ctx = (num_frames + 1) // 2 + round(margin * TOKENS_PER_SECOND)
+    return min(n_audio_ctx, max(min_ctx, ctx))
+
+
 @lru_cache(maxsize=None)
 def mel_filters(device, n_mels: int) -> torch.Tensor:
     """
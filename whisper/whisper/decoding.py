@@ -1,4 +1,5 @@
 from dataclasses import dataclass, field, replace
+from functools import lru_cache
 from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
@@ -7,7 +8,7 @@ import torch.nn.functional as F
 from torch import Tensor
 from torch.distributions import Categorical
 
-from .audio import CHUNK_LENGTH
+from .audio import CHUNK_LENGTH, pad_or_trim
 from .tokenizer import Tokenizer, get_tokenizer
 from .utils import compression_ratio
 
@@ -17,13 +18,20 @@ if TYPE_CHECKING:
 
 @torch.no_grad()
 def detect_language(
-    model: "Whisper", mel: Tensor, tokenizer: Tokenizer = None
+    model: "Whisper",
+    mel: Tensor,
+    tokenizer: Tokenizer = None,
+    *,
+    encoded: Optional[bool] = None,
 ) -> Tuple[Tensor, List[dict]]:
     """
     Detect the spoken language in the audio, and return them as list of strings, along with the ids
     of the most probable language tokens and the probability distribution over all language tokens.
     This is performed outside the main decode loop in order to not interfere with kv-caching.
 
+    `mel` is a mel spectrogram, or encoded audio features if `encoded`; by default, this
+    is guessed from its shape.
+
     Returns
     -------
     language_tokens : Tensor, shape = (n_audio,)
@@ -47,8 +55,17 @@ def detect_language(
     if single:
         mel = mel.unsqueeze(0)
 
-    # skip encoder forward pass if already-encoded audio features were given
-    if mel.shape[-2:] != (model.dims.n_audio_ctx, model.dims.n_audio_state):
+    # skip encoder forward pass if already-encoded audio features were given. These may
+    # span fewer than n_audio_ctx positions (see DecodingOptions.audio_ctx); over n_mels
+    # positions, they have the shape of a mel of n_audio_state frames
+    if encoded is None:
+        if mel.shape[-2:] == (model.dims.n_mels, model.dims.n_audio_state):
+            raise ValueError(
+                f"an input of shape {tuple(mel.shape[-2:])} may be a mel spectrogram "
+                "or audio features; pass encoded=True or False"
+            )
+        encoded = mel.shape[-2] != model.dims.n_mels
+    if not encoded:
         mel = model.encoder(mel)
 
     # forward pass using a single token, startoftranscript
@@ -56,17 +73,13 @@ def detect_language(
     x = torch.tensor([[tokenizer.sot]] * n_audio).to(mel.device)  # [n_audio, 1]
     logits = model.logits(x, mel)[:, 0]
 
-    # collect detected languages; suppress all non-language tokens
-    mask = torch.ones(logits.shape[-1], dtype=torch.bool)
-    mask[list(tokenizer.all_language_tokens)] = False
-    logits[:, mask] = -np.inf
-    language_tokens = logits.argmax(dim=-1)
-    language_token_probs = logits.softmax(dim=-1).cpu()
+    # collect detected languages; only the logits of the language tokens are considered
+    language_token_ids = token_index(tokenizer.all_language_tokens, logits.device)
+    language_logits = logits.index_select(-1, language_token_ids)
+    language_tokens = language_token_ids[language_logits.argmax(dim=-1)]
+    language_token_probs = language_logits.softmax(dim=-1).cpu().tolist()
     language_probs = [
-        {
-            c: language_token_probs[i, j].item()
-            for j, c in zip(tokenizer.all_language_tokens, tokenizer.all_language_codes)
-        }
+        dict(zip(tokenizer.all_language_codes, language_token_probs[i]))
         for i in range(n_audio)
     ]
 
@@ -85,8 +98,9 @@ class DecodingOptions:
     # language that the audio is in; uses detected language if None
     language: Optional[str] = None
 
-    # sampling-related options
-    temperature: float = 0.0
+    # sampling-related options; with a sequence of temperatures, each audio is decoded at all of
+    # them as a single batch, and one result is returned per audio and temperature
+    temperature: Union[float, Tuple[float, ...]] = 0.0
     sample_len: Optional[int] = None  # maximum number of tokens to sample
     best_of: Optional[int] = None  # number of independent sample trajectories, if t > 0
     beam_size: Optional[int] = None  # number of beams in beam search, if t == 0
@@ -110,8 +124,19 @@ class DecodingOptions:
     without_timestamps: bool = False  # use <|notimestamps|> to sample text tokens only
     max_initial_timestamp: Optional[float] = 1.0
 
+    # stop decoding once `early_stop_len` tokens are sampled if the average log probability of
+    # every sequence is below `early_stop_logprob`, e.g. to start the temperature fallback sooner
+    early_stop_logprob: Optional[float] = None
+    early_stop_len: int = 8
+
+    # number of encoder positions to use, up to n_audio_ctx; the mel is trimmed or padded to
+    # 2 * audio_ctx frames, which makes the encoder much cheaper for short audio
+    audio_ctx: Optional[int] = None
+
     # implementation details
     fp16: bool = True  # use fp16 for most of the calculation
+    static_kv_cache: bool = False  # preallocate the self-attention kv cache for n_text_ctx
+    compact_batch: bool = True  # remove finished audio from the batch, without beam search
 
 
 @dataclass(frozen=True)
@@ -136,44 +161,103 @@ class Inference:
         """Update the key-value cache according to the updated beams"""
         raise NotImplementedError
 
+    def compact_kv_cache(self, source_indices, audio_indices) -> None:
+        """Keep only the key-value cache of the given sequences and of the given audio"""
+        raise NotImplementedError
+
     def cleanup_caching(self) -> None:
         """Clean up any resources or hooks after decoding is finished"""
         pass
 
 
 class PyTorchInference(Inference):
-    def __init__(self, model: "Whisper", initial_token_length: int):
+    def __init__(
+        self, model: "Whisper", initial_token_length: int, static_cache: bool = False
+    ):
         self.model: "Whisper" = model
         self.initial_token_length = initial_token_length
+        self.static_cache = static_cache
         self.kv_cache = {}
+        self.kv_buffers = {}
         self.hooks = []
 
+        # left padding of the initial tokens of each sequence, when they differ in length
+        self.padding: Optional[Tensor] = None
+
         key_modules = [block.attn.key for block in self.model.decoder.blocks]
         value_modules = [block.attn.value for block in self.model.decoder.blocks]
         self.kv_modules = key_modules + value_modules
 
+        # the cross-attention cache has one entry per audio, shared by its group of sequences
+        cross_key_modules = [block.cross_attn.key for block in self.model.decoder.blocks]
+        cross_value_modules = [
+            block.cross_attn.value for block in self.model.decoder.blocks
+        ]
+        self.cross_kv_modules = cross_key_modules + cross_value_modules
+
     def logits(self, tokens: Tensor, audio_features: Tensor) -> Tensor:
         if not self.kv_cache:
-            self.kv_cache, self.hooks = self.model.install_kv_cache_hooks()
+            if self.static_cache:
+                self.kv_cache, self.hooks, self.kv_buffers = (
+                    self.model.install_static_kv_cache_hooks()
+                )
+            else:
+                self.kv_cache, self.hooks = self.model.install_kv_cache_hooks()
+
+        padding = None
+        if self.padding is not None:
+            # the tokens sampled after the initial ones are never padding
+            n_keys = tokens.shape[-1]
+            padding = F.pad(self.padding, (0, n_keys - self.padding.shape[1]))
 
         if tokens.shape[-1] > self.initial_token_length:
             # only need to use the last token except in the first forward pass
             tokens = tokens[:, -1:]
 
-        return self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
+        return self.model.decoder(
+            tokens, audio_features, kv_cache=self.kv_cache, padding=padding
+        )
 
     def cleanup_caching(self):
         for hook in self.hooks:
             hook.remove()
 
         self.kv_cache = {}
+        self.kv_buffers = {}
         self.hooks = []
 
     def rearrange_kv_cache(self, source_indices):
         if source_indices != list(range(len(source_indices))):
-            for module in self.kv_modules:
-                # update the key/value cache to contain the selected sequences
-                self.kv_cache[module] = self.kv_cache[module][source_indices].detach()
+            self._select_kv_cache(source_indices)
+
+    def compact_kv_cache(self, source_indices, audio_indices):
+        self._select_kv_cache(source_indices)
+        index = torch.as_tensor(audio_indices, device=self.model.device)
+        for module in self.cross_kv_modules:
+            if module in self.kv_cache:
+                self.kv_cache[module] = self.kv_cache[module][index]
+
+    def _select_kv_cache(self, source_indices):
+        if self.padding is not None:
+            self.padding = self.padding[source_indices]
+        if self.static_cache:
+            self._rearrange_static_kv_cache(source_indices)
+            return
+        for module in self.kv_modules:
+            # update the key/value cache to contain the selected sequences
+            self.kv_cache[module] = self.kv_cache[module][source_indices].detach()
+
+    def _rearrange_static_kv_cache(self, source_indices):
+        index = torch.as_tensor(source_indices, device=self.model.device)
+        n_batch = len(source_indices)
+        for module in self.kv_modules:
+            # select the sequences into the spare buffer, which becomes the one in use
+            current, spare = self.kv_buffers[module]
+            cache = self.kv_cache[module]
+            length = cache.shape[1]
+            torch.index_select(cache, 0, index, out=spare[:n_batch, :length])
+            self.kv_buffers[module] = [spare, current]
+            self.kv_cache[module] = spare[:n_batch, :length]
 
 
 class SequenceRanker:
@@ -270,14 +354,21 @@ class TokenDecoder:
 
 
 class GreedyDecoder(TokenDecoder):
-    def __init__(self, temperature: float, eot: int):
+    def __init__(self, temperature: Union[float, Tensor], eot: int):
+        # a tensor holds the temperature of each sequence in a group
         self.temperature = temperature
         self.eot = eot
 
     def update(
         self, tokens: Tensor, logits: Tensor, sum_logprobs: Tensor
     ) -> Tuple[Tensor, bool]:
-        if self.temperature == 0:
+        if isinstance(self.temperature, Tensor):
+            n_repeat = logits.shape[0] // self.temperature.shape[0]
+            temperature = self.temperature.to(logits.device).repeat(n_repeat)[:, None]
+            greedy = temperature == 0
+            sampled = Categorical(logits=logits / temperature.masked_fill(greedy, 1)).sample()
+            next_tokens = torch.where(greedy[:, 0], logits.argmax(dim=-1), sampled)
+        elif self.temperature == 0:
             next_tokens = logits.argmax(dim=-1)
         else:
             next_tokens = Categorical(logits=logits / self.temperature).sample()
@@ -305,20 +396,39 @@ class BeamSearchDecoder(TokenDecoder):
         eot: int,
         inference: Inference,
         patience: Optional[float] = None,
+        logit_filters: Sequence["LogitFilter"] = (),
     ):
         self.beam_size = beam_size
         self.eot = eot
         self.inference = inference
+        self.logit_filters = logit_filters
         self.patience = patience or 1.0
         self.max_candidates: int = round(beam_size * self.patience)
-        self.finished_sequences = None
+
+        # finished sequences of each audio, in the order they were added:
+        # tokens (n_audio, max_candidates, max_length) padded with EOT, their lengths,
+        # cumulative log probabilities, and the number of sequences per audio
+        self.finished_tokens: Optional[Tensor] = None
+        self.finished_lengths: Optional[Tensor] = None
+        self.finished_logprobs: Optional[Tensor] = None
+        self.finished_count: Optional[Tensor] = None
 
         assert (
             self.max_candidates > 0
         ), f"Invalid beam size ({beam_size}) or patience ({patience})"
 
     def reset(self):
-        self.finished_sequences = None
+        self.finished_tokens = None
+        self.finished_lengths = None
+        self.finished_logprobs = None
+        self.finished_count = None
+
+    def _init_finished(self, n_audio: int, device: torch.device):
+        shape = (n_audio, self.max_candidates)
+        self.finished_tokens = torch.full((*shape, 0), self.eot, device=device)
+        self.finished_lengths = torch.zeros(shape, dtype=torch.long, device=device)
+        self.finished_logprobs = torch.zeros(shape, device=device)
+        self.finished_count = torch.zeros(n_audio, dtype=torch.long, device=device)
 
     def update(
         self, tokens: Tensor, logits: Tensor, sum_logprobs: Tensor
@@ -326,82 +436,101 @@ class BeamSearchDecoder(TokenDecoder):
         if tokens.shape[0] % self.beam_size != 0:
             raise ValueError(f"{tokens.shape}[0] % {self.beam_size} != 0")
 
-        n_audio = tokens.shape[0] // self.beam_size
-        if self.finished_sequences is None:  # for the first update
-            self.finished_sequences = [{} for _ in range(n_audio)]
+        n_beam = self.beam_size
+        n_audio = tokens.shape[0] // n_beam
+        if self.finished_count is None:  # for the first update
+            self._init_finished(n_audio, tokens.device)
 
+        # STEP 1: calculate the cumulative log probabilities for possible candidates; a beam
+        # contributes at most beam_size unfinished candidates and one ending with EOT, so its
+        # best beam_size + 1 tokens are enough. Identical beams (e.g. right after the initial
+        # tokens are repeated) would produce the same candidates: only the first is expanded
         logprobs = F.log_softmax(logits.float(), dim=-1)
-        next_tokens, source_indices, finished_sequences = [], [], []
-        for i in range(n_audio):
-            scores, sources, finished = {}, {}, {}
-
-            # STEP 1: calculate the cumulative log probabilities for possible candidates
-            for j in range(self.beam_size):
-                idx = i * self.beam_size + j
-                prefix = tokens[idx].tolist()
-                for logprob, token in zip(*logprobs[idx].topk(self.beam_size + 1)):
-                    new_logprob = (sum_logprobs[idx] + logprob).item()
-                    sequence = tuple(prefix + [token.item()])
-                    scores[sequence] = new_logprob
-                    sources[sequence] = idx
-
-            # STEP 2: rank the candidates and keep the top beam_size sequences for each audio
-            saved = 0
-            for sequence in sorted(scores, key=scores.get, reverse=True):
-                if sequence[-1] == self.eot:
-                    finished[sequence] = scores[sequence]
-                else:
-                    sum_logprobs[len(next_tokens)] = scores[sequence]
-                    next_tokens.append(sequence)
-                    source_indices.append(sources[sequence])
-
-                    saved += 1
-                    if saved == self.beam_size:
-                        break
-
-            finished_sequences.append(finished)
-
-        tokens = torch.tensor(next_tokens, device=tokens.device)
-        self.inference.rearrange_kv_cache(source_indices)
-
-        # add newly finished sequences to self.finished_sequences
-        assert len(self.finished_sequences) == len(finished_sequences)
-        for previously_finished, newly_finished in zip(
-            self.finished_sequences, finished_sequences
-        ):
-            for seq in sorted(newly_finished, key=newly_finished.get, reverse=True):
-                if len(previously_finished) >= self.max_candidates:
-                    break  # the candidate list is full
-                previously_finished[seq] = newly_finished[seq]
+        beam_scores, beam_tokens = logprobs.topk(n_beam + 1, dim=-1)
+        beam_scores += sum_logprobs[:, None]
+        grouped = tokens.view(n_audio, n_beam, 1, -1)
+        same = (grouped == grouped.transpose(1, 2)).all(dim=-1)
+        duplicate = same.tril(diagonal=-1).any(dim=-1)
+        beam_scores[duplicate.flatten()] = -np.inf
+
+        # STEP 2: rank the candidates of each audio; the best 2 * beam_size always hold
+        # beam_size unfinished sequences
+        top_scores, top_indices = beam_scores.view(n_audio, -1).topk(2 * n_beam, dim=-1)
+        sources = top_indices // (n_beam + 1) + torch.arange(
+            0, n_audio * n_beam, n_beam, device=tokens.device
+        ).unsqueeze(1)
+        next_tokens = beam_tokens.view(n_audio, -1).gather(1, top_indices)
+        is_eot = next_tokens == self.eot
+        n_unfinished = (~is_eot).cumsum(dim=-1)
+
+        # keep the top beam_size unfinished sequences for each audio
+        keep = ~is_eot & (n_unfinished <= n_beam)
+        source_indices = sources[keep]
+        sum_logprobs.copy_(top_scores[keep])
+        previous_tokens = tokens
+        tokens = torch.cat([tokens[source_indices], next_tokens[keep][:, None]], dim=-1)
+        self.inference.rearrange_kv_cache(source_indices.tolist())
+        for logit_filter in self.logit_filters:
+            logit_filter.rearrange(source_indices)
+
+        # finished sequences ranked above the last kept one are added, best first,
+        # until each audio has max_candidates of them
+        finished = is_eot & (n_unfinished < n_beam)
+        slots = self.finished_count[:, None] + finished.cumsum(dim=-1) - 1
+        finished &= slots < self.max_candidates
+        audio_idx, candidate_idx = finished.nonzero(as_tuple=True)
+        if audio_idx.numel() > 0:
+            length = previous_tokens.shape[-1] + 1
+            if self.finished_tokens.shape[-1] < length:
+                padding = length - self.finished_tokens.shape[-1]
+                self.finished_tokens = F.pad(
+                    self.finished_tokens, (0, padding), value=self.eot
+                )
+            slot_idx = slots[audio_idx, candidate_idx]
+            source_idx = sources[audio_idx, candidate_idx]
+            self.finished_tokens[audio_idx, slot_idx, : length - 1] = previous_tokens[
+                source_idx
+            ]
+            self.finished_tokens[audio_idx, slot_idx, length - 1] = self.eot
+            self.finished_lengths[audio_idx, slot_idx] = length
+            self.finished_logprobs[audio_idx, slot_idx] = top_scores[
+                audio_idx, candidate_idx
+            ]
+            self.finished_count += finished.sum(dim=-1)
 
         # mark as completed if all audio has enough number of samples
-        completed = all(
-            len(sequences) >= self.max_candidates
-            for sequences in self.finished_sequences
-        )
+        completed = (self.finished_count >= self.max_candidates).all()
         return tokens, completed
 
     def finalize(self, preceding_tokens: Tensor, sum_logprobs: Tensor):
         # collect all finished sequences, including patience, and add unfinished ones if not enough
+        if self.finished_count is None:
+            self._init_finished(preceding_tokens.shape[0], preceding_tokens.device)
+
+        preceding_tokens = preceding_tokens.cpu()
         sum_logprobs = sum_logprobs.cpu()
-        for i, sequences in enumerate(self.finished_sequences):
-            if (
-                len(sequences) < self.beam_size
-            ):  # when not enough sequences are finished
-                for j in list(np.argsort(sum_logprobs[i]))[::-1]:
-                    sequence = preceding_tokens[i, j].tolist() + [self.eot]
-                    sequences[tuple(sequence)] = sum_logprobs[i][j].item()
+        finished_tokens = self.finished_tokens.cpu()
+        finished_lengths = self.finished_lengths.tolist()
+        finished_logprobs = self.finished_logprobs.tolist()
+        eot = torch.tensor([self.eot])
+
+        tokens: List[List[Tensor]] = []
+        logprobs: List[List[float]] = []
+        for i, count in enumerate(self.finished_count.tolist()):
+            sequences = [
+                finished_tokens[i, k, : finished_lengths[i][k]] for k in range(count)
+            ]
+            scores = finished_logprobs[i][:count]
+            if len(sequences) < self.beam_size:  # when not enough sequences are finished
+                for j in sum_logprobs[i].argsort(descending=True).tolist():
+                    sequences.append(torch.cat([preceding_tokens[i, j], eot]))
+                    scores.append(sum_logprobs[i, j].item())
                     if len(sequences) >= self.beam_size:
                         break
+            tokens.append(sequences)
+            logprobs.append(scores)
 
-        tokens: List[List[Tensor]] = [
-            [torch.tensor(seq) for seq in sequences.keys()]
-            for sequences in self.finished_sequences
-        ]
-        sum_logprobs: List[List[float]] = [
-            list(sequences.values()) for sequences in self.finished_sequences
-        ]
-        return tokens, sum_logprobs
+        return tokens, logprobs
 
 
 class LogitFilter:
@@ -419,23 +548,62 @@ class LogitFilter:
         """
         raise NotImplementedError
 
+    def reset(self) -> None:
+        """Initialize any stateful variables for decoding a new sequence"""
+
+    def rearrange(self, source_indices: Tensor) -> None:
+        """Update any per-sequence state according to the updated beams"""
+
+
+@lru_cache(maxsize=None)
+def token_index(tokens: Tuple[int], device: torch.device) -> Tensor:
+    """
+    The given token ids as a tensor on the device, cached so that each set of tokens is converted
+    and copied to the device only once instead of being indexed with a Python list at every step.
+    """
+    return torch.tensor(tokens, dtype=torch.long, device=device)
+
+
+def blank_tokens(tokenizer: Tokenizer) -> Tuple[int]:
+    """The tokens suppressed at the beginning of the sampling by SuppressBlank"""
+    return tuple(tokenizer.encode(" ") + [tokenizer.eot])
+
 
 class SuppressBlank(LogitFilter):
     def __init__(self, tokenizer: Tokenizer, sample_begin: int):
         self.tokenizer = tokenizer
         self.sample_begin = sample_begin
+        self.suppress_tokens = blank_tokens(tokenizer)
 
     def apply(self, logits: Tensor, tokens: Tensor):
         if tokens.shape[1] == self.sample_begin:
-            logits[:, self.tokenizer.encode(" ") + [self.tokenizer.eot]] = -np.inf
+            index = token_index(self.suppress_tokens, logits.device)
+            logits.index_fill_(-1, index, -np.inf)
 
 
 class SuppressTokens(LogitFilter):
     def __init__(self, suppress_tokens: Sequence[int]):
-        self.suppress_tokens = list(suppress_tokens)
+        self.suppress_tokens = tuple(sorted(set(suppress_tokens)))
 
     def apply(self, logits: Tensor, tokens: Tensor):
-        logits[:, self.suppress_tokens] = -np.inf
+        index = token_index(self.suppress_tokens, logits.device)
+        logits.index_fill_(-1, index, -np.inf)
+
+
+class SuppressIndex(LogitFilter):
+    """
+    Suppresses precomputed token indices with a single index_fill_ per step; `initial_index` is
+    used instead of `index` at the beginning of the sampling.
+    """
+
+    def __init__(self, index: Tensor, initial_index: Tensor, sample_begin: int):
+        self.index = index
+        self.initial_index = initial_index
+        self.sample_begin = sample_begin
+
+    def apply(self, logits: Tensor, tokens: Tensor):
+        initial = tokens.shape[1] == self.sample_begin
+        logits.index_fill_(-1, self.initial_index if initial else self.index, -np.inf)
 
 
 class ApplyTimestampRules(LogitFilter):
@@ -444,44 +612,78 @@ class ApplyTimestampRules(LogitFilter):
         tokenizer: Tokenizer,
         sample_begin: int,
         max_initial_timestamp_index: Optional[int],
+        suppress_no_timestamps: bool = True,
     ):
         self.tokenizer = tokenizer
         self.sample_begin = sample_begin
         self.max_initial_timestamp_index = max_initial_timestamp_index
+        self.suppress_no_timestamps = suppress_no_timestamps
+        self.reset()
 
-    def apply(self, logits: Tensor, tokens: Tensor):
-        # suppress <|notimestamps|> which is handled by without_timestamps
-        if self.tokenizer.no_timestamps is not None:
-            logits[:, self.tokenizer.no_timestamps] = -np.inf
+    def reset(self):
+        # per-sequence state, updated with each sampled token instead of rescanning them:
+        # the last sampled timestamp token (timestamp_begin - 1 if none yet), whether the last
+        # and the penultimate sampled tokens were timestamps, and the number of tokens seen
+        self.last_timestamp: Optional[Tensor] = None
+        self.last_was_timestamp: Optional[Tensor] = None
+        self.penultimate_was_timestamp: Optional[Tensor] = None
+        self.n_seen: int = 0
+
+    def rearrange(self, source_indices: Tensor):
+        if self.last_timestamp is not None:
+            self.last_timestamp = self.last_timestamp[source_indices]
+            self.last_was_timestamp = self.last_was_timestamp[source_indices]
+            self.penultimate_was_timestamp = self.penultimate_was_timestamp[
+                source_indices
+            ]
 
-        # timestamps have to appear in pairs, except directly before EOT; mask logits accordingly
-        for k in range(tokens.shape[0]):
-            sampled_tokens = tokens[k, self.sample_begin :]
-            seq = [t for t in sampled_tokens.tolist()]
-            last_was_timestamp = (
-                len(seq) >= 1 and seq[-1] >= self.tokenizer.timestamp_begin
+    def _update_state(self, tokens: Tensor):
+        timestamp_begin = self.tokenizer.timestamp_begin
+        if self.last_timestamp is None or tokens.shape[1] == self.sample_begin:
+            n_batch = tokens.shape[0]
+            self.last_timestamp = torch.full(
+                (n_batch,), timestamp_begin - 1, device=tokens.device
             )
-            penultimate_was_timestamp = (
-                len(seq) < 2 or seq[-2] >= self.tokenizer.timestamp_begin
+            self.last_was_timestamp = torch.zeros(
+                n_batch, dtype=torch.bool, device=tokens.device
             )
+            self.penultimate_was_timestamp = self.last_was_timestamp.clone()
+            self.n_seen = self.sample_begin
 
-            if last_was_timestamp:
-                if penultimate_was_timestamp:  # has to be non-timestamp
-                    logits[k, self.tokenizer.timestamp_begin :] = -np.inf
-                else:  # cannot be normal text tokens
-                    logits[k, : self.tokenizer.eot] = -np.inf
+        for token in tokens[:, self.n_seen :].unbind(dim=1):
+            is_timestamp = token >= timestamp_begin
+            self.penultimate_was_timestamp = self.last_was_timestamp
+            self.last_was_timestamp = is_timestamp
+            self.last_timestamp = torch.where(is_timestamp, token, self.last_timestamp)
+        self.n_seen = tokens.shape[1]
 
-            timestamps = sampled_tokens[
-                sampled_tokens.ge(self.tokenizer.timestamp_begin)
-            ]
-            if timestamps.numel() > 0:
-                # timestamps shouldn't decrease; forbid timestamp tokens smaller than the last
-                # also force each segment to have a nonzero length, to prevent infinite looping
-                if last_was_timestamp and not penultimate_was_timestamp:
-                    timestamp_last = timestamps[-1]
-                else:
-                    timestamp_last = timestamps[-1] + 1
-                logits[k, self.tokenizer.timestamp_begin : timestamp_last] = -np.inf
+    def apply(self, logits: Tensor, tokens: Tensor):
+        # suppress <|notimestamps|> which is handled by without_timestamps
+        if self.suppress_no_timestamps and self.tokenizer.no_timestamps is not None:
+            logits[:, self.tokenizer.no_timestamps] = -np.inf
+
+        self._update_state(tokens)
+        timestamp_begin = self.tokenizer.timestamp_begin
+        timestamp_logits = logits[:, timestamp_begin:]
+        last_was_timestamp = self.last_was_timestamp
+        penultimate_was_timestamp = self.penultimate_was_timestamp
+        if tokens.shape[1] - self.sample_begin < 2:
+            penultimate_was_timestamp = torch.ones_like(penultimate_was_timestamp)
+
+        # timestamps have to appear in pairs, except directly before EOT; mask logits accordingly
+        pair_ended = last_was_timestamp & penultimate_was_timestamp  # has to be non-timestamp
+        pair_open = last_was_timestamp & ~penultimate_was_timestamp  # cannot be normal text
+        timestamp_logits.masked_fill_(pair_ended[:, None], -np.inf)
+
+        # timestamps shouldn't decrease; forbid timestamp tokens smaller than the last
+        # also force each segment to have a nonzero length, to prevent infinite looping
+        timestamp_last = self.last_timestamp + (~pair_open).long()
+        timestamp_tokens = torch.arange(
+            timestamp_begin, logits.shape[-1], device=logits.device
+        )
+        timestamp_logits.masked_fill_(
+            timestamp_tokens[None, :] < timestamp_last[:, None], -np.inf
+        )
 
         if tokens.shape[1] == self.sample_begin:
             # suppress generating non-timestamp tokens at the beginning
@@ -494,15 +696,19 @@ class ApplyTimestampRules(LogitFilter):
                 )
                 logits[:, last_allowed + 1 :] = -np.inf
 
-        # if sum of probability over timestamps is above any other token, sample timestamp
-        logprobs = F.log_softmax(logits.float(), dim=-1)
-        for k in range(tokens.shape[0]):
-            timestamp_logprob = logprobs[k, self.tokenizer.timestamp_begin :].logsumexp(
-                dim=-1
-            )
-            max_text_token_logprob = logprobs[k, : self.tokenizer.timestamp_begin].max()
-            if timestamp_logprob > max_text_token_logprob:
-                logits[k, : self.tokenizer.timestamp_begin] = -np.inf
+        # if sum of probability over timestamps is above any other token, sample timestamp;
+        # the log-softmax normalizer cancels out, so the logits are compared directly
+        eot = self.tokenizer.eot
+        timestamp_logsumexp = timestamp_logits.float().logsumexp(dim=-1)
+        max_text_token_logit = torch.maximum(
+            logits[:, :eot].float().amax(dim=-1).masked_fill(pair_open, -np.inf),
+            logits[:, eot:timestamp_begin].float().amax(dim=-1),
+        )
+        sample_timestamp = timestamp_logsumexp > max_text_token_logit
+
+        # the text logits are only written once, for both the pair rule and the rule above
+        logits[:, :eot].masked_fill_((pair_open | sample_timestamp)[:, None], -np.inf)
+        logits[:, eot:timestamp_begin].masked_fill_(sample_timestamp[:, None], -np.inf)
 
 
 class DecodingTask:
@@ -511,7 +717,12 @@ class DecodingTask:
     decoder: TokenDecoder
     logit_filters: List[LogitFilter]
 
-    def __init__(self, model: "Whisper", options: DecodingOptions):
+    def __init__(
+        self,
+        model: "Whisper",
+        options: DecodingOptions,
+        prompts: Optional[Sequence[Optional[Union[str, List[int]]]]] = None,
+    ):
         self.model = model
 
         language = options.language or "en"
@@ -524,38 +735,96 @@ class DecodingTask:
         self.tokenizer: Tokenizer = tokenizer
         self.options: DecodingOptions = self._verify_options(options)
 
-        self.n_group: int = options.beam_size or options.best_of or 1
+        self.temperatures: Tuple[float] = (
+            tuple(options.temperature)
+            if isinstance(options.temperature, (tuple, list))
+            else (options.temperature,)
+        )
+        self.n_samples: int = options.beam_size or options.best_of or 1
+        self.n_group: int = self.n_samples * len(self.temperatures)
         self.n_ctx: int = model.dims.n_text_ctx
+        self.audio_ctx: int = (
+            model.dims.n_audio_ctx if options.audio_ctx is None else options.audio_ctx
+        )
+        if not 1 <= self.audio_ctx <= model.dims.n_audio_ctx:
+            raise ValueError(
+                f"audio_ctx should be between 1 and {model.dims.n_audio_ctx}"
+            )
         self.sample_len: int = options.sample_len or model.dims.n_text_ctx // 2
 
         self.sot_sequence: Tuple[int] = tokenizer.sot_sequence
         if self.options.without_timestamps:
             self.sot_sequence = tokenizer.sot_sequence_including_notimestamps
 
-        self.initial_tokens: Tuple[int] = self._get_initial_tokens()
+        self.initial_tokens: Tuple[int] = self._get_initial_tokens(options.prompt)
         self.sample_begin: int = len(self.initial_tokens)
         self.sot_index: int = self.initial_tokens.index(tokenizer.sot)
 
+        # with a prompt for each audio, in place of options.prompt, the initial tokens of the
+        # shorter prompts are left-padded, so that every sequence samples from sample_begin
+        self.padded_initial_tokens: Optional[Tensor] = None
+        self.padding: Optional[Tensor] = None
+        if prompts is not None:
+            rows = [self._get_initial_tokens(prompt) for prompt in prompts]
+            n_tokens = max(map(len, rows))
+            self.padded_initial_tokens = torch.tensor(
+                [(tokenizer.sot_prev,) * (n_tokens - len(row)) + row for row in rows]
+            )
+            self.padding = torch.tensor(
+                [[i < n_tokens - len(row) for i in range(n_tokens)] for row in rows]
+            )
+            self.sot_index += n_tokens - self.sample_begin
+            self.sample_begin = n_tokens
+
         # inference: implements the forward pass through the decoder, including kv caching
-        self.inference = PyTorchInference(model, len(self.initial_tokens))
+        self.inference = PyTorchInference(
+            model, self.sample_begin, options.static_kv_cache
+        )
 
         # sequence ranker: implements how to rank a group of sampled sequences
         self.sequence_ranker = MaximumLikelihoodRanker(options.length_penalty)
 
+        # logit filters: applies various rules to suppress or penalize certain tokens
+        self.logit_filters = []
+
         # decoder: implements how to select the next tokens, given the autoregressive distribution
         if options.beam_size is not None:
             self.decoder = BeamSearchDecoder(
-                options.beam_size, tokenizer.eot, self.inference, options.patience
+                options.beam_size,
+                tokenizer.eot,
+                self.inference,
+                options.patience,
+                self.logit_filters,
+            )
+        elif len(self.temperatures) > 1:
+            temperatures = torch.tensor(self.temperatures)
+            self.decoder = GreedyDecoder(
+                temperatures.repeat_interleave(self.n_samples), tokenizer.eot
             )
         else:
-            self.decoder = GreedyDecoder(options.temperature, tokenizer.eot)
+            self.decoder = GreedyDecoder(self.temperatures[0], tokenizer.eot)
 
-        # logit filters: applies various rules to suppress or penalize certain tokens
-        self.logit_filters = []
+        # the static suppressions (blank, suppress_tokens and <|notimestamps|>) are compiled
+        # into precomputed device indices, so that they cost a single index_fill_ per step
+        suppress_tokens, initial_suppress_tokens = [], []
         if self.options.suppress_blank:
-            self.logit_filters.append(SuppressBlank(self.tokenizer, self.sample_begin))
+            initial_suppress_tokens.extend(blank_tokens(self.tokenizer))
         if self.options.suppress_tokens:
-            self.logit_filters.append(SuppressTokens(self._get_suppress_tokens()))
+            suppress_tokens.extend(self._get_suppress_tokens())
+        if not options.without_timestamps and tokenizer.no_timestamps is not None:
+            suppress_tokens.append(tokenizer.no_timestamps)
+        if suppress_tokens or initial_suppress_tokens:
+            suppress_tokens = tuple(sorted(set(suppress_tokens)))
+            initial_suppress_tokens = tuple(
+                sorted(set(suppress_tokens + tuple(initial_suppress_tokens)))
+            )
+            self.logit_filters.append(
+                SuppressIndex(
+                    token_index(suppress_tokens, model.device),
+                    token_index(initial_suppress_tokens, model.device),
+                    self.sample_begin,
+                )
+            )
         if not options.without_timestamps:
             precision = CHUNK_LENGTH / model.dims.n_audio_ctx  # usually 0.02 seconds
             max_initial_timestamp_index = None
@@ -565,7 +834,10 @@ class DecodingTask:
                 )
             self.logit_filters.append(
                 ApplyTimestampRules(
-                    tokenizer, self.sample_begin, max_initial_timestamp_index
+                    tokenizer,
+                    self.sample_begin,
+                    max_initial_timestamp_index,
+                    suppress_no_timestamps=False,
                 )
             )
 
@@ -575,6 +847,13 @@ class DecodingTask:
         if options.temperature == 0:
             if options.best_of is not None:
                 raise ValueError("best_of with greedy sampling (T=0) is not compatible")
+        if isinstance(options.temperature, (tuple, list)):
+            if len(options.temperature) == 0:
+                raise ValueError("at least one temperature should be given")
+            if options.beam_size is not None:
+                raise ValueError("beam_size can't be used with multiple temperatures")
+            if 0 in options.temperature and options.best_of is not None:
+                raise ValueError("best_of with greedy sampling (T=0) is not compatible")
         if options.patience is not None and options.beam_size is None:
             raise ValueError("patience requires beam_size to be given")
         if options.length_penalty is not None and not (
@@ -584,7 +863,9 @@ class DecodingTask:
 
         return options
 
-    def _get_initial_tokens(self) -> Tuple[int]:
+    def _get_initial_tokens(
+        self, prompt: Optional[Union[str, List[int]]]
+    ) -> Tuple[int]:
         tokens = list(self.sot_sequence)
 
         if prefix := self.options.prefix:
@@ -598,7 +879,7 @@ class DecodingTask:
                 prefix_tokens = prefix_tokens[-max_prefix_len:]
             tokens = tokens + prefix_tokens
 
-        if prompt := self.options.prompt:
+        if prompt:
             prompt_tokens = (
                 self.tokenizer.encode(" " + prompt.strip())
                 if isinstance(prompt, str)
@@ -645,13 +926,12 @@ class DecodingTask:
         if self.options.fp16:
             mel = mel.half()
 
-        if mel.shape[-2:] == (
-            self.model.dims.n_audio_ctx,
-            self.model.dims.n_audio_state,
-        ):
+        if mel.shape[-2:] == (self.audio_ctx, self.model.dims.n_audio_state):
             # encoded audio features are given; skip audio encoding
             audio_features = mel
         else:
+            if self.options.audio_ctx is not None:
+                mel = pad_or_trim(mel, 2 * self.audio_ctx)
             audio_features = self.model.encoder(mel)
 
         if audio_features.dtype != (
@@ -669,7 +949,7 @@ class DecodingTask:
 
         if self.options.language is None or self.options.task == "lang_id":
             lang_tokens, lang_probs = self.model.detect_language(
-                audio_features, self.tokenizer
+                audio_features, self.tokenizer, encoded=True
             )
             languages = [max(probs, key=probs.get) for probs in lang_probs]
             if self.options.language is None:
@@ -682,6 +962,20 @@ class DecodingTask:
         sum_logprobs: Tensor = torch.zeros(n_batch, device=audio_features.device)
         no_speech_probs = [np.nan] * n_batch
 
+        # without beam search, the audio whose sequences have all ended are removed from the
+        # batch; their results are written into these, and `rows` indexes the remaining ones
+        compact = (
+            self.options.compact_batch
+            and self.options.beam_size is None
+            and n_batch > self.n_group
+        )
+        if compact:
+            all_tokens = tokens.new_full(
+                (n_batch, tokens.shape[1] + self.sample_len), self.tokenizer.eot
+            )
+            all_sum_logprobs = torch.zeros_like(sum_logprobs)
+            rows = torch.arange(n_batch, device=audio_features.device)
+
         try:
             for i in range(self.sample_len):
                 logits = self.inference.logits(tokens, audio_features)
@@ -704,19 +998,65 @@ class DecodingTask:
 
                 if completed or tokens.shape[-1] > self.n_ctx:
                     break
+
+                if (
+                    i + 1 == self.options.early_stop_len
+                    and self.options.early_stop_logprob is not None
+                ):
+                    if compact:  # include the sequences already removed from the batch
+                        sum_logprobs_all = all_sum_logprobs.clone()
+                        sum_logprobs_all[rows] = sum_logprobs
+                    else:
+                        sum_logprobs_all = sum_logprobs
+                    avg_logprobs = sum_logprobs_all / (i + 1)
+                    if (avg_logprobs < self.options.early_stop_logprob).all():
+                        break
+
+                if compact:
+                    finished = tokens[:, -1] == self.tokenizer.eot
+                    finished_audio = finished.view(-1, self.n_group).all(dim=-1)
+                    if finished_audio.any():
+                        done = finished_audio.repeat_interleave(self.n_group)
+                        all_tokens[rows[done], : tokens.shape[1]] = tokens[done]
+                        all_sum_logprobs[rows[done]] = sum_logprobs[done]
+
+                        keep = (~done).nonzero().squeeze(1)
+                        audio_indices = (~finished_audio).nonzero().squeeze(1)
+                        tokens, sum_logprobs = tokens[keep], sum_logprobs[keep]
+                        rows, audio_features = rows[keep], audio_features[audio_indices]
+                        self.inference.compact_kv_cache(
+                            keep.tolist(), audio_indices.tolist()
+                        )
+                        for logit_filter in self.logit_filters:
+                            logit_filter.rearrange(keep)
         finally:
             self.inference.cleanup_caching()
 
+        if compact:
+            all_tokens[rows, : tokens.shape[1]] = tokens
+            all_sum_logprobs[rows] = sum_logprobs
+            tokens, sum_logprobs = all_tokens[:, : tokens.shape[1]], all_sum_logprobs
+
         return tokens, sum_logprobs, no_speech_probs
 
     @torch.no_grad()
     def run(self, mel: Tensor) -> List[DecodingResult]:
         self.decoder.reset()
+        for logit_filter in self.logit_filters:
+            logit_filter.reset()
         tokenizer: Tokenizer = self.tokenizer
         n_audio: int = mel.shape[0]
 
         audio_features: Tensor = self._get_audio_features(mel)  # encoder forward pass
-        tokens: Tensor = torch.tensor([self.initial_tokens]).repeat(n_audio, 1)
+        if self.padded_initial_tokens is None:
+            tokens: Tensor = torch.tensor([self.initial_tokens]).repeat(n_audio, 1)
+        elif len(self.padded_initial_tokens) == n_audio:
+            tokens: Tensor = self.padded_initial_tokens.clone()
+            self.inference.padding = self.padding.repeat_interleave(
+                self.n_group, dim=0
+            ).to(audio_features.device)
+        else:
+            raise ValueError(f"{n_audio} audio were given for {len(self.padding)} prompts")
 
         # detect language if requested, overwriting the language token
         languages, language_probs = self._detect_language(audio_features, tokens)
@@ -730,19 +1070,27 @@ class DecodingTask:
                 )
             ]
 
-        # repeat text tensors by the group size, for beam search or best-of-n sampling
+        # repeat text tensors by the group size, for beam search or best-of-n sampling; the audio
+        # features are not repeated, as the cross-attention is shared by the sequences of a group
         tokens = tokens.repeat_interleave(self.n_group, dim=0).to(audio_features.device)
 
         # call the main sampling loop
         tokens, sum_logprobs, no_speech_probs = self._main_loop(audio_features, tokens)
 
-        # reshape the tensors to have (n_audio, n_group) as the first two dimensions
-        audio_features = audio_features[:: self.n_group]
         no_speech_probs = no_speech_probs[:: self.n_group]
         assert audio_features.shape[0] == len(no_speech_probs) == n_audio
 
-        tokens = tokens.reshape(n_audio, self.n_group, -1)
-        sum_logprobs = sum_logprobs.reshape(n_audio, self.n_group)
+        # reshape the tensors to have (n_audio * n_temperatures, n_samples) as the first two
+        # dimensions; each temperature has its own group of samples to rank, and its own result
+        n_temperatures = len(self.temperatures)
+        if n_temperatures > 1:
+            audio_features = [f for f in audio_features for _ in self.temperatures]
+            languages = [lang for lang in languages for _ in self.temperatures]
+            no_speech_probs = [p for p in no_speech_probs for _ in self.temperatures]
+        temperatures = self.temperatures * n_audio
+
+        tokens = tokens.reshape(n_audio * n_temperatures, self.n_samples, -1)
+        sum_logprobs = sum_logprobs.reshape(n_audio * n_temperatures, self.n_samples)
 
         # get the final candidates for each group, and slice between the first sampled token and EOT
         tokens, sum_logprobs = self.decoder.finalize(tokens, sum_logprobs)
@@ -768,6 +1116,7 @@ class DecodingTask:
             audio_features,
             avg_logprobs,
             no_speech_probs,
+            temperatures,
         )
         if len(set(map(len, fields))) != 1:
             raise RuntimeError(f"inconsistent result lengths: {list(map(len, fields))}")
@@ -780,12 +1129,18 @@ class DecodingTask:
                 text=text,
                 avg_logprob=avg_logprob,
                 no_speech_prob=no_speech_prob,
-                temperature=self.options.temperature,
+                temperature=temperature,
                 compression_ratio=compression_ratio(text),
             )
-            for text, language, tokens, features, avg_logprob, no_speech_prob in zip(
-                *fields
-            )
+            for (
+                text,
+                language,
+                tokens,
+                features,
+                avg_logprob,
+                no_speech_prob,
+                temperature,
+            ) in zip(*fields)
         ]
 
 
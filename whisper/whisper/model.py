@@ -108,7 +108,20 @@ class MultiHeadAttention(nn.Module):
             k = kv_cache[self.key]
             v = kv_cache[self.value]
 
-        wv, qk = self.qkv_attention(q, k, v, mask)
+        if xa is not None and k.shape[0] != q.shape[0]:
+            # cross-attention for a group of sequences per audio (e.g. beams or best-of samples):
+            # the keys and values are calculated once per audio, and the queries of the group are
+            # folded into one sequence attending to them, instead of copying them for each member
+            n_batch, n_ctx, n_state = q.shape
+            q = q.reshape(k.shape[0], -1, n_state)
+            wv, qk = self.qkv_attention(q, k, v, mask)
+            wv = wv.reshape(n_batch, n_ctx, n_state)
+            if qk is not None:
+                n_group = n_batch // k.shape[0]
+                qk = qk.unflatten(2, (n_group, n_ctx)).transpose(1, 2)
+                qk = qk.reshape(n_batch, *qk.shape[2:])
+        else:
+            wv, qk = self.qkv_attention(q, k, v, mask)
         return self.out(wv), qk
 
     def qkv_attention(
@@ -121,14 +134,20 @@ class MultiHeadAttention(nn.Module):
         v = v.view(*v.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
 
         if SDPA_AVAILABLE and MultiHeadAttention.use_sdpa:
-            a = scaled_dot_product_attention(
-                q, k, v, is_causal=mask is not None and n_ctx > 1
-            )
+            if mask is not None and mask.ndim > 2:
+                # a mask for each sequence, e.g. with padding; see TextDecoder.forward
+                a = scaled_dot_product_attention(q, k, v, attn_mask=mask.to(q.dtype))
+            else:
+                a = scaled_dot_product_attention(
+                    q, k, v, is_causal=mask is not None and n_ctx > 1
+                )
             out = a.permute(0, 2, 1, 3).flatten(start_dim=2)
             qk = None
         else:
             qk = (q * scale) @ (k * scale).transpose(-1, -2)
-            if mask is not None:
+            if mask is not None and mask.ndim > 2:
+                qk = qk + mask
+            elif mask is not None:
                 qk = qk + mask[:n_ctx, :n_ctx]
             qk = qk.float()
 
@@ -187,15 +206,20 @@ class AudioEncoder(nn.Module):
 
     def forward(self, x: Tensor):
         """
-        x : torch.Tensor, shape = (batch_size, n_mels, n_ctx)
-            the mel spectrogram of the audio
+        x : torch.Tensor, shape = (batch_size, n_mels, n_frames)
+            the mel spectrogram of the audio; n_frames is usually 2 * n_ctx, or fewer frames
+            to run the encoder on a shorter audio context
         """
         x = F.gelu(self.conv1(x))
         x = F.gelu(self.conv2(x))
         x = x.permute(0, 2, 1)
 
-        assert x.shape[1:] == self.positional_embedding.shape, "incorrect audio shape"
-        x = (x + self.positional_embedding).to(x.dtype)
+        n_ctx = x.shape[1]
+        assert (
+            n_ctx <= self.positional_embedding.shape[0]
+            and x.shape[2] == self.positional_embedding.shape[1]
+        ), "incorrect audio shape"
+        x = (x + self.positional_embedding[:n_ctx]).to(x.dtype)
 
         for block in self.blocks:
             x = block(x)
@@ -224,22 +248,46 @@ class TextDecoder(nn.Module):
         mask = torch.empty(n_ctx, n_ctx).fill_(-np.inf).triu_(1)
         self.register_buffer("mask", mask, persistent=False)
 
-    def forward(self, x: Tensor, xa: Tensor, kv_cache: Optional[dict] = None):
+    def forward(
+        self,
+        x: Tensor,
+        xa: Tensor,
+        kv_cache: Optional[dict] = None,
+        padding: Optional[Tensor] = None,
+    ):
         """
         x : torch.LongTensor, shape = (batch_size, <= n_ctx)
             the text tokens
         xa : torch.Tensor, shape = (batch_size, n_audio_ctx, n_audio_state)
             the encoded audio features to be attended on
+        padding : torch.BoolTensor, shape = (batch_size, n_cached + x.shape[-1]), optional
+            True at the positions, cached or in `x`, that are left padding; this allows decoding
+            sequences of different lengths as one batch, right-aligned
         """
         offset = next(iter(kv_cache.values())).shape[1] if kv_cache else 0
-        x = (
-            self.token_embedding(x)
-            + self.positional_embedding[offset : offset + x.shape[-1]]
-        )
+        mask = self.mask
+        if padding is None:
+            positions = self.positional_embedding[offset : offset + x.shape[-1]]
+        else:
+            # positions are counted from the first non-padding token of each sequence
+            index = (~padding).cumsum(dim=-1)[:, offset:] - 1
+            positions = self.positional_embedding[index.clamp(min=0)]
+
+            # causal, and not attending to padding; except for each position to itself, so that
+            # the padding positions (whose outputs are unused) don't produce NaNs
+            n_ctx, n_keys = x.shape[-1], padding.shape[-1]
+            causal = torch.ones(n_ctx, n_keys, dtype=torch.bool, device=x.device)
+            causal = causal.triu(offset + 1)
+            itself = torch.ones_like(causal).tril(offset).triu(offset)
+            masked = (causal | padding[:, None, :]) & ~itself
+            mask = torch.zeros(masked.shape, device=x.device)
+            mask = mask.masked_fill(masked, -np.inf)[:, None]
+
+        x = self.token_embedding(x) + positions
         x = x.to(xa.dtype)
 
         for block in self.blocks:
-            x = block(x, xa, mask=self.mask, kv_cache=kv_cache)
+            x = block(x, xa, mask=mask, kv_cache=kv_cache)
 
         x = self.ln(x)
         logits = (
@@ -340,6 +388,54 @@ class Whisper(nn.Module):
         self.decoder.apply(install_hooks)
         return cache, hooks
 
+    def install_static_kv_cache_hooks(self):
+        """
+        Same as `install_kv_cache_hooks`, except that the self-attention keys and values are
+        written in place into tensors preallocated for `n_text_ctx` positions, instead of being
+        concatenated to the cache (and copied whole) at every generated token. The cache entries
+        are views of these tensors covering the positions decoded so far.
+
+        Each preallocated tensor comes with a spare one of the same shape, so that the cache can
+        be rearranged across the batch (e.g. for beam search) by selecting into the spare tensor
+        and swapping the two.
+
+        Returns
+        -------
+        cache : Dict[nn.Module, torch.Tensor]
+            A dictionary object mapping the key/value projection modules to its cache
+        hooks : List[RemovableHandle]
+            List of PyTorch RemovableHandle objects to stop the hooks to be called
+        buffers : Dict[nn.Module, List[torch.Tensor]]
+            The preallocated tensors of each self-attention key/value projection module, the one
+            in use first, allocated on the first forward pass
+        """
+        cache, buffers, hooks = {}, {}, []
+
+        def save_to_cache(module, _, output):
+            # cross attention: save as-is, calculated once
+            cache[module] = output
+            return output
+
+        def save_to_static_cache(module, _, output):
+            if module not in buffers:
+                shape = (output.shape[0], self.dims.n_text_ctx, output.shape[2])
+                buffers[module] = [output.new_empty(shape), output.new_empty(shape)]
+            offset = cache[module].shape[1] if module in cache else 0
+            end = offset + output.shape[1]
+            n_batch = output.shape[0]  # fewer than allocated, once finished rows are removed
+            buffer = buffers[module][0]
+            buffer[:n_batch, offset:end] = output
+            cache[module] = buffer[:n_batch, :end]
+            return cache[module]
+
+        for block in self.decoder.blocks:
+            for layer in (block.attn.key, block.attn.value):
+                hooks.append(layer.register_forward_hook(save_to_static_cache))
+            for layer in (block.cross_attn.key, block.cross_attn.value):
+                hooks.append(layer.register_forward_hook(save_to_cache))
+
+        return cache, hooks, buffers
+
     detect_language = detect_language_function
     transcribe = transcribe_function
     decode = decode_function
@@ -0,0 +1,191 @@
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from typing import TYPE_CHECKING, Iterator, List, Sequence, Tuple, Union
+
+import torch
+from torch import Tensor
+
+from .audio import N_SAMPLES, log_mel_spectrogram, pad_or_trim
+from .decoding import DecodingOptions, DecodingResult, DecodingTask
+from .transcribe import transcribe
+
+if TYPE_CHECKING:
+    from .model import Whisper
+
+
+@dataclass
+class Window:
+    mel: Tensor  # a mel window or its encoded audio features, with or without a batch dimension
+    options: DecodingOptions
+    future: Future = field(default_factory=Future)
+
+
+class WindowBatcher:
+    """
+    Decodes the windows of concurrent `transcribe` calls as batches. Each call runs in its own
+    thread within `client()`, and a batch is run once every such thread is waiting for a window:
+    the windows of the same length are encoded in one pass, and those with the same decoding
+    options, except for the prompt, are decoded by one `DecodingTask` with a prompt for each.
+    """
+
+    def __init__(self, model: "Whisper"):
+        self.model: "Whisper" = model
+        self.lock = threading.Lock()  # held while running the model
+        self.batches = 0
+        self.windows = 0
+
+        self._cond = threading.Condition()
+        self._waiting: List[Window] = []
+        self._clients = 0
+
+    @contextmanager
+    def client(self):
+        """Context manager within which a thread takes part in the batches"""
+        with self._cond:
+            self._clients += 1
+        try:
+            yield self
+        finally:
+            with self._cond:
+                self._clients -= 1
+                self._cond.notify_all()
+
+    def decode(
+        self, mel: Tensor, options: DecodingOptions
+    ) -> Union[DecodingResult, List[DecodingResult]]:
+        """Same as `whisper.decode`, but waits to decode the window along with the others"""
+        window = Window(mel, options)
+        with self._cond:
+            self._waiting.append(window)
+            while not window.future.done():
+                if len(self._waiting) >= self._clients:
+                    batch, self._waiting = self._waiting, []
+                    self._cond.release()
+                    try:
+                        self._run(batch)
+                    finally:
+                        self._cond.acquire()
+                        self._cond.notify_all()
+                else:
+                    self._cond.wait()
+        return window.future.result()
+
+    def _run(self, windows: List[Window]):
+        try:
+            with self.lock, torch.no_grad():
+                features = self._encode(windows)
+                self._decode(windows, features)
+        except Exception as e:
+            for window in windows:
+                if not window.future.done():
+                    window.future.set_exception(e)
+        self.batches += 1
+        self.windows += len(windows)
+
+    def _encode(self, windows: List[Window]) -> List[Tensor]:
+        dims = self.model.dims
+        features: List[Tensor] = [None] * len(windows)
+        to_encode = {}
+        for i, window in enumerate(windows):
+            mel = window.mel if window.mel.ndim == 3 else window.mel[None]
+            if window.options.fp16:
+                mel = mel.half()
+            audio_ctx = window.options.audio_ctx or dims.n_audio_ctx
+            if mel.shape[-2:] == (audio_ctx, dims.n_audio_state):
+                features[i] = mel  # already encoded, e.g. for the temperature fallback
+            else:
+                mel = pad_or_trim(mel, 2 * audio_ctx)
+                to_encode.setdefault((mel.shape[1:], mel.dtype), []).append((i, mel))
+
+        for group in to_encode.values():
+            mel = torch.cat([mel for _, mel in group])
+            audio_features = self.model.encoder(mel).split([len(m) for _, m in group])
+            for (i, _), audio_features in zip(group, audio_features):
+                features[i] = audio_features
+
+        return features
+
+    def _decode(self, windows: List[Window], features: List[Tensor]):
+        groups: List[Tuple[DecodingOptions, List[int]]] = []
+        for i, window in enumerate(windows):
+            options = replace(window.options, prompt=None)
+            for group_options, indices in groups:
+                if group_options == options:
+                    indices.append(i)
+                    break
+            else:
+                groups.append((options, [i]))
+
+        # the decoding stops once the longest sequence fills the text context; the prompts are
+        # decoded together only if it leaves every sequence at least as many tokens as alone
+        batches = []
+        for options, indices in groups:
+            task = DecodingTask(self.model, options)
+            max_length = task.n_ctx - task.sample_len + 1
+            by_length = {}
+            for i in indices:
+                length = len(task._get_initial_tokens(windows[i].options.prompt))
+                by_length.setdefault(max(length, max_length), []).append(i)
+            batches.extend((options, indices) for indices in by_length.values())
+
+        for options, indices in batches:
+            prompts = [
+                windows[i].options.prompt for i in indices for _ in features[i]
+            ]
+            if all(prompt == prompts[0] for prompt in prompts):
+                task = DecodingTask(self.model, replace(options, prompt=prompts[0]))
+            else:
+                task = DecodingTask(self.model, options, prompts)
+            results = task.run(torch.cat([features[i] for i in indices]))
+
+            # one result per audio and temperature, in the order of the windows
+            n_results = len(results) // len(prompts)
+            for i in indices:
+                n = len(features[i]) * n_results
+                result, results = results[:n], results[n:]
+                single = windows[i].mel.ndim == 2
+                windows[i].future.set_result(result[0] if single else result)
+
+
+def transcribe_files(
+    model: "Whisper",
+    paths: Sequence[str],
+    *,
+    batch_files: int = 4,
+    load_workers: int = 2,
+    **transcribe_options,
+) -> Iterator[Tuple[str, Future]]:
+    """
+    Transcribe the audio files in a pipeline: up to `batch_files` files are transcribed at once,
+    with their windows decoded as batches by a `WindowBatcher`, while `load_workers` threads
+    decode the following files with ffmpeg and compute their Mel spectrograms.
+
+    Yields each path along with the finished future of its `transcribe` result, in the order
+    that the files finish.
+    """
+    batcher = WindowBatcher(model)
+    n_mels = model.dims.n_mels
+    n_ahead = batch_files + load_workers  # files loaded or transcribed at any time
+
+    def transcribe_file(path: str, mel: Future) -> dict:
+        mel = mel.result()
+        with batcher.client():
+            return transcribe(
+                model, path, mel=mel, batcher=batcher, **transcribe_options
+            )
+
+    with ThreadPoolExecutor(load_workers) as loader, ThreadPoolExecutor(
+        batch_files
+    ) as workers:
+        paths, running = deque(paths), {}
+        while paths or running:
+            while paths and len(running) < n_ahead:
+                path = paths.popleft()
+                mel = loader.submit(log_mel_spectrogram, path, n_mels, N_SAMPLES)
+                running[workers.submit(transcribe_file, path, mel)] = path
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield running.pop(future), future
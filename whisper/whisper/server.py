@@ -0,0 +1,498 @@
+import argparse
+import json
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+from dataclasses import dataclass, field, replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Dict, List, Optional, Union
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+from .audio import N_SAMPLES, load_audio, log_mel_spectrogram, pad_or_trim
+from .decoding import (
+    DecodingOptions,
+    DecodingResult,
+    DecodingTask,
+    Inference,
+    detect_language,
+)
+from .tokenizer import LANGUAGES
+from .utils import compression_ratio
+
+if TYPE_CHECKING:
+    from .model import Whisper
+
+
+class ContinuousBatchInference(Inference):
+    """
+    Inference for a batch of sequences of different lengths, which join and leave the batch
+    independently. The self-attention key-value caches are right-aligned and left-padded, with
+    `lengths` holding the number of non-padding positions of each sequence.
+    """
+
+    def __init__(self, model: "Whisper"):
+        self.model: "Whisper" = model
+        self.kv_cache: Dict[torch.nn.Module, Tensor] = {}
+        self.lengths: Optional[Tensor] = None
+
+        blocks = self.model.decoder.blocks
+        self.kv_modules = [b.attn.key for b in blocks] + [b.attn.value for b in blocks]
+
+    @property
+    def n_ctx(self) -> int:
+        return self.kv_cache[self.kv_modules[0]].shape[1] if self.kv_cache else 0
+
+    def _forward(self, tokens: Tensor, audio_features: Tensor, cache: dict, padding: Tensor):
+        cache, hooks = self.model.install_kv_cache_hooks(cache)
+        try:
+            logits = self.model.decoder(tokens, audio_features, cache, padding)
+        finally:
+            for hook in hooks:
+                hook.remove()
+        return logits, cache
+
+    def logits(self, tokens: Tensor, audio_features: Tensor) -> Tensor:
+        """Decode one step of the sequences in the batch, given the last token of each"""
+        n_ctx = self.n_ctx + 1
+        positions = torch.arange(n_ctx, device=tokens.device)
+        padding = positions < (n_ctx - 1 - self.lengths)[:, None]
+        logits, self.kv_cache = self._forward(
+            tokens, audio_features, self.kv_cache, padding
+        )
+        self.lengths = self.lengths + 1
+        return logits
+
+    def add_sequences(self, tokens: List[List[int]], audio_features: Tensor) -> Tensor:
+        """
+        Run the first forward pass of new sequences, left-padded to the same length, and add them
+        at the end of the batch. Returns their logits, shape = (n_new, n_ctx, n_vocab).
+        """
+        device = audio_features.device
+        lengths = torch.tensor([len(t) for t in tokens], device=device)
+        n_ctx = max(map(len, tokens))
+        x = torch.tensor([[0] * (n_ctx - len(t)) + list(t) for t in tokens])
+        padding = torch.arange(n_ctx, device=device) < (n_ctx - lengths)[:, None]
+        logits, cache = self._forward(x.to(device), audio_features, {}, padding)
+
+        if not self.kv_cache:
+            self.kv_cache, self.lengths = cache, lengths
+            return logits
+
+        # left-pad the shorter of the two caches, so that both are right-aligned
+        n_ctx = max(self.n_ctx, n_ctx)
+        for module in self.kv_cache:
+            current, new = self.kv_cache[module], cache[module]
+            if module in self.kv_modules:
+                current = F.pad(current, (0, 0, n_ctx - current.shape[1], 0))
+                new = F.pad(new, (0, 0, n_ctx - new.shape[1], 0))
+            self.kv_cache[module] = torch.cat([current, new])
+        self.lengths = torch.cat([self.lengths, lengths])
+        return logits
+
+    def rearrange_kv_cache(self, source_indices) -> None:
+        """Keep the given sequences in the batch, removing the others"""
+        if len(source_indices) == 0:
+            return self.cleanup_caching()
+
+        index = torch.as_tensor(source_indices, device=self.lengths.device)
+        self.lengths = self.lengths[index]
+
+        # drop the positions that are now padding for all sequences
+        trim = self.n_ctx - int(self.lengths.max())
+        for module, cache in self.kv_cache.items():
+            cache = cache[index]
+            if module in self.kv_modules:
+                cache = cache[:, trim:]
+            self.kv_cache[module] = cache
+
+    def cleanup_caching(self) -> None:
+        self.kv_cache = {}
+        self.lengths = None
+
+
+@dataclass
+class TranscriptionRequest:
+    mel: Tensor
+    options: DecodingOptions
+    future: Future = field(default_factory=Future)
+
+    # set when the request joins the decode batch
+    task: Optional[DecodingTask] = None
+    tokens: List[int] = field(default_factory=list)
+    no_speech_prob: float = np.nan
+
+
+class ContinuousBatchScheduler:
+    """
+    Transcribes audio of up to 30 seconds from many concurrent clients with one resident model.
+
+    At each iteration, the requests that arrived since the previous one are encoded as one batch
+    and their decoding joins the in-flight decode batch, while the sequences that are finished
+    leave it; so that new requests don't wait for the longest in-flight one to finish. Decoding
+    is greedy, and `DecodingOptions` such as the language or the prompt can be set per request.
+    """
+
+    def __init__(
+        self,
+        model: "Whisper",
+        max_batch: int = 16,
+        options: Optional[DecodingOptions] = None,
+    ):
+        self.model = model
+        self.max_batch = max_batch
+        if options is None:
+            options = DecodingOptions(fp16=model.device.type != "cpu")
+        if options.language is None and not model.is_multilingual:
+            options = replace(options, language="en")
+        self.options = replace(options, without_timestamps=True)
+        self.n_frames = 2 * (self.options.audio_ctx or model.dims.n_audio_ctx)
+
+        self.inference = ContinuousBatchInference(model)
+        self.pending: "queue.Queue[TranscriptionRequest]" = queue.Queue()
+        self.active: List[TranscriptionRequest] = []
+        self.audio_features: Optional[Tensor] = None
+        self.sum_logprobs: Optional[Tensor] = None
+
+        self.iterations = 0
+        self.decoded_tokens = 0
+        self.completed = 0
+        self.failed = 0
+        self._admitting: List[TranscriptionRequest] = []
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, audio: Union[str, np.ndarray, Tensor], **options) -> Future:
+        """
+        Queue audio (a path or a 16 kHz waveform, up to 30 seconds) for transcription; the keyword
+        arguments override the `DecodingOptions` of the scheduler. Returns a Future that resolves
+        to a `DecodingResult`.
+        """
+        options = replace(self.options, **options)
+        if options.temperature != 0 or options.beam_size is not None:
+            raise ValueError("only greedy decoding is supported")
+        if not options.without_timestamps:
+            raise ValueError("timestamps are not supported")
+        if options.language is not None and options.language not in LANGUAGES:
+            raise ValueError(f"Unsupported language: {options.language}")
+        if options.audio_ctx != self.options.audio_ctx:
+            raise ValueError("audio_ctx is shared by all requests of a scheduler")
+
+        if isinstance(audio, str):
+            audio = load_audio(audio)
+        if audio.shape[-1] > N_SAMPLES:
+            raise ValueError("audio longer than 30 seconds is not supported")
+        mel = log_mel_spectrogram(pad_or_trim(audio), self.model.dims.n_mels)
+
+        request = TranscriptionRequest(pad_or_trim(mel, self.n_frames), options)
+        self.pending.put(request)
+        return request.future
+
+    def start(self) -> "ContinuousBatchScheduler":
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the scheduler thread, cancelling the requests that are not finished"""
+        self._stop.set()
+        self.pending.put(None)
+        if self._thread is not None:
+            self._thread.join()
+        self._abort()
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.step(block=not self.active)
+            except Exception as e:
+                # fail the requests in flight, rather than leaving their clients waiting
+                traceback.print_exc()
+                self._abort(e)
+
+    def _abort(self, exception: Optional[Exception] = None):
+        """
+        Fail the active and pending requests with `exception`, or cancel them without one, and
+        reset the decode batch
+        """
+        requests = self.active + self._admitting
+        while True:
+            try:
+                request = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                requests.append(request)
+
+        for request in requests:
+            if request.future.done():
+                continue
+            if exception is None:
+                request.future.cancel()
+            else:
+                request.future.set_exception(exception)
+                self.failed += 1
+
+        self.active, self._admitting = [], []
+        self.audio_features = self.sum_logprobs = None
+        self.inference.cleanup_caching()
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "iterations": self.iterations,
+            "decoded_tokens": self.decoded_tokens,
+            "mean_batch_size": self.decoded_tokens / max(self.iterations, 1),
+            "completed": self.completed,
+            "failed": self.failed,
+            "active": len(self.active),
+            "pending": self.pending.qsize(),
+        }
+
+    def _take_pending(self, block: bool) -> List[TranscriptionRequest]:
+        requests = []
+        while len(self.active) + len(requests) < self.max_batch:
+            try:
+                request = self.pending.get(block=block and not requests)
+            except queue.Empty:
+                break
+            if request is None:  # stop() was called
+                break
+            requests.append(request)
+        return requests
+
+    @torch.no_grad()
+    def step(self, block: bool = False):
+        """Run one iteration: admit the pending requests, and decode one token for all"""
+        logits = []
+        if self.active:
+            tokens = torch.tensor([[r.tokens[-1]] for r in self.active])
+            tokens = tokens.to(self.audio_features.device)
+            logits.append(self.inference.logits(tokens, self.audio_features)[:, -1])
+
+        if requests := self._take_pending(block):
+            self._admitting = requests
+            if (new_logits := self._admit(requests)) is not None:
+                logits.append(new_logits)
+            self._admitting = []
+
+        if logits:
+            self._update(torch.cat(logits))
+
+    def _admit(self, requests: List[TranscriptionRequest]) -> Optional[Tensor]:
+        mel = torch.stack([r.mel for r in requests]).to(self.model.device)
+        if self.options.fp16:
+            mel = mel.half()
+        audio_features = self.model.encoder(mel)  # one encoder pass for the new requests
+
+        # detect the language of the requests without one, in one batch as well
+        if undetected := [i for i, r in enumerate(requests) if r.options.language is None]:
+            _, probs = detect_language(
+                self.model, audio_features[undetected], encoded=True
+            )
+            for i, p in zip(undetected, probs):
+                language = max(p, key=p.get)
+                requests[i].options = replace(requests[i].options, language=language)
+
+        admitted = []
+        for i, request in enumerate(requests):
+            try:
+                request.task = DecodingTask(self.model, request.options)
+            except Exception as e:
+                request.future.set_exception(e)
+                continue
+            request.tokens = list(request.task.initial_tokens)
+            admitted.append(i)
+        if not admitted:
+            return None
+
+        requests = [requests[i] for i in admitted]
+        audio_features = audio_features[admitted]
+        logits = self.inference.add_sequences([r.tokens for r in requests], audio_features)
+
+        n_ctx = logits.shape[1]
+        for request, request_logits in zip(requests, logits):
+            no_speech = request.task.tokenizer.no_speech
+            if no_speech is not None:
+                sot_index = n_ctx - len(request.tokens) + request.task.sot_index
+                probs_at_sot = request_logits[sot_index].float().softmax(dim=-1)
+                request.no_speech_prob = probs_at_sot[no_speech].item()
+
+        self.active.extend(requests)
+        sum_logprobs = torch.zeros(len(requests), device=audio_features.device)
+        if self.audio_features is None:
+            self.audio_features, self.sum_logprobs = audio_features, sum_logprobs
+        else:
+            self.audio_features = torch.cat([self.audio_features, audio_features])
+            self.sum_logprobs = torch.cat([self.sum_logprobs, sum_logprobs])
+        return logits[:, -1]
+
+    def _update(self, logits: Tensor):
+        # apply the logit filters of each request, e.g. for the suppressed tokens
+        for i, request in enumerate(self.active):
+            tokens = torch.tensor([request.tokens], device=logits.device)
+            for logit_filter in request.task.logit_filters:
+                logit_filter.apply(logits[i : i + 1], tokens)
+
+        next_tokens = logits.argmax(dim=-1)
+        logprobs = F.log_softmax(logits.float(), dim=-1)
+        self.sum_logprobs += logprobs[torch.arange(len(next_tokens)), next_tokens]
+        self.iterations += 1
+        self.decoded_tokens += len(next_tokens)
+
+        keep, finished = [], []
+        for i, (request, token) in enumerate(zip(self.active, next_tokens.tolist())):
+            request.tokens.append(token)
+            task = request.task
+            n_sampled = len(request.tokens) - task.sample_begin
+            if (
+                token == task.tokenizer.eot
+                or n_sampled >= task.sample_len
+                or len(request.tokens) > task.n_ctx
+            ):
+                finished.append((request, self._result(request, i)))
+            else:
+                keep.append(i)
+
+        if len(keep) < len(self.active):
+            self.inference.rearrange_kv_cache(keep)
+            self.active = [self.active[i] for i in keep]
+            if keep:
+                self.audio_features = self.audio_features[keep]
+                self.sum_logprobs = self.sum_logprobs[keep]
+            else:
+                self.audio_features = self.sum_logprobs = None
+
+        for request, result in finished:
+            request.future.set_result(result)
+            self.completed += 1
+
+    def _result(self, request: TranscriptionRequest, index: int) -> DecodingResult:
+        tokenizer = request.task.tokenizer
+        tokens = request.tokens[request.task.sample_begin :]
+        if tokens[-1] == tokenizer.eot:
+            tokens = tokens[:-1]
+        text = tokenizer.decode(tokens).strip()
+        return DecodingResult(
+            audio_features=self.audio_features[index],
+            language=request.options.language,
+            tokens=tokens,
+            text=text,
+            avg_logprob=self.sum_logprobs[index].item() / (len(tokens) + 1),
+            no_speech_prob=request.no_speech_prob,
+            temperature=0.0,
+            compression_ratio=compression_ratio(text),
+        )
+
+
+class TranscriptionHandler(BaseHTTPRequestHandler):
+    """
+    POST /transcribe with a body of 16 kHz mono 16-bit PCM, and optionally the `language`, `task`
+    and `prompt` query parameters; returns the result as JSON. GET /stats returns the scheduler
+    statistics.
+    """
+
+    protocol_version = "HTTP/1.1"
+    scheduler: ContinuousBatchScheduler = None
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if url.path != "/transcribe":
+            return self._reply(404, {"error": f"unknown path {url.path}"})
+
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        options = {k: params[k] for k in ("language", "task", "prompt") if k in params}
+        try:
+            if not body or len(body) % 2:
+                raise ValueError("the body must be 16-bit PCM audio")
+            audio = np.frombuffer(body, np.int16).astype(np.float32) / 32768.0
+            result = self.scheduler.submit(audio, **options).result()
+        except ValueError as e:
+            return self._reply(400, {"error": str(e)})
+        except Exception as e:
+            return self._reply(500, {"error": str(e)})
+
+        self._reply(
+            200,
+            {
+                "text": result.text,
+                "language": result.language,
+                "tokens": result.tokens,
+                "avg_logprob": result.avg_logprob,
+                "no_speech_prob": result.no_speech_prob,
+                "compression_ratio": result.compression_ratio,
+            },
+        )
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/stats":
+            return self._reply(404, {"error": f"unknown path {self.path}"})
+        self._reply(200, self.scheduler.stats)
+
+    def _reply(self, code: int, payload: dict):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(
+    scheduler: ContinuousBatchScheduler,
+    host: str = "127.0.0.1",
+    port: int = 8766,
+    background: bool = False,
+) -> ThreadingHTTPServer:
+    """Start the scheduler, and serve it over HTTP; see `TranscriptionHandler`"""
+    handler = type("Handler", (TranscriptionHandler,), {"scheduler": scheduler})
+    server = ThreadingHTTPServer((host, port), handler)
+    scheduler.start()
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        server.serve_forever()
+    return server
+
+
+def cli():
+    from . import available_models, load_model
+
+    # fmt: off
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--model", default="turbo", type=str, help="name of the Whisper model to use")
+    parser.add_argument("--model_dir", type=str, default=None, help="the path to save model files; uses ~/.cache/whisper by default")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="device to use for PyTorch inference")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8766, help="port to listen on")
+    parser.add_argument("--max_batch", type=int, default=16, help="maximum number of requests decoded at once")
+    parser.add_argument("--language", type=str, default=None, choices=sorted(LANGUAGES), help="default language of the requests; detected when not given")
+    parser.add_argument("--audio_ctx", type=int, default=None, help="number of encoder positions to use for all requests, up to 1500 (30 seconds); shorter is faster for short audio")
+    # fmt: on
+    args = parser.parse_args().__dict__
+
+    model_name = args.pop("model")
+    if model_name not in available_models():
+        parser.error(f"unknown model {model_name}; available: {available_models()}")
+    model = load_model(model_name, device=args.pop("device"), download_root=args.pop("model_dir"))
+    options = DecodingOptions(
+        language=args.pop("language"),
+        audio_ctx=args.pop("audio_ctx"),
+        fp16=model.device.type != "cpu",
+    )
+    scheduler = ContinuousBatchScheduler(model, args.pop("max_batch"), options)
+    print(f"Serving {model_name} on http://{args['host']}:{args['port']}/transcribe")
+    serve(scheduler, args["host"], args["port"])
+
+
+if __name__ == "__main__":
+    cli()
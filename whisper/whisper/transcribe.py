@@ -2,7 +2,9 @@ import argparse
 import os
 import traceback
 import warnings
-from typing import TYPE_CHECKING, List, Optional, Tuple, Union
+from contextlib import nullcontext
+from dataclasses import replace
+from typing import TYPE_CHECKING, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import torch
@@ -14,6 +16,7 @@ from .audio import (
     N_FRAMES,
     N_SAMPLES,
     SAMPLE_RATE,
+    audio_ctx_for,
     log_mel_spectrogram,
     pad_or_trim,
 )
@@ -33,6 +36,7 @@ from .utils import (
 
 if TYPE_CHECKING:
     from .model import Whisper
+    from .pipeline import WindowBatcher
 
 
 def transcribe(
@@ -52,6 +56,10 @@ def transcribe(
     append_punctuations: str = "\"'.。,，!！?？:：”)]}、",
     clip_timestamps: Union[str, List[float]] = "0",
     hallucination_silence_threshold: Optional[float] = None,
+    dynamic_audio_ctx: bool = False,
+    temperature_fallback: str = "sequential",
+    mel: Optional[torch.Tensor] = None,
+    batcher: Optional["WindowBatcher"] = None,
     **decode_options,
 ):
     """
@@ -119,6 +127,28 @@ def transcribe(
         When word_timestamps is True, skip silent periods longer than this threshold (in seconds)
         when a possible hallucination is detected
 
+    dynamic_audio_ctx: bool
+        If True, a window holding less than 30 seconds of audio is encoded with a shorter audio
+        context sized to the audio (see `audio_ctx_for`), which is much faster for short clips
+        such as voice commands. A window whose decoding fails the thresholds above is decoded
+        again with the full context before falling back to higher temperatures.
+
+    temperature_fallback: str
+        How the fallback temperatures are decoded when the first temperature fails: "sequential"
+        decodes them one at a time until one passes; "parallel" decodes all of them as a single
+        batch, reusing the encoded audio, and keeps the first that passes; "speculative" does the
+        same, but also stops the first decoding early when the average log probability of its
+        first tokens is already below `logprob_threshold`.
+
+    mel: Optional[torch.Tensor]
+        The log-Mel spectrogram of the audio padded with 30 seconds of silence, as computed by
+        `log_mel_spectrogram(audio, model.dims.n_mels, padding=N_SAMPLES)`, if it was computed
+        ahead, e.g. while transcribing another file; the audio is not loaded again
+
+    batcher: Optional[WindowBatcher]
+        Decodes the windows along with those of other concurrent calls using the same batcher;
+        see `whisper.pipeline.WindowBatcher`
+
     Returns
     -------
     A dictionary containing the resulting text ("text") and segment-level details ("segments"), and
@@ -135,8 +165,13 @@ def transcribe(
     if dtype == torch.float32:
         decode_options["fp16"] = False
 
+    # the model is shared with the other calls using the batcher, which decode concurrently
+    decode = model.decode if batcher is None else batcher.decode
+    model_lock = nullcontext() if batcher is None else batcher.lock
+
     # Pad 30-seconds of silence to the input audio, for slicing
-    mel = log_mel_spectrogram(audio, model.dims.n_mels, padding=N_SAMPLES)
+    if mel is None:
+        mel = log_mel_spectrogram(audio, model.dims.n_mels, padding=N_SAMPLES)
     content_frames = mel.shape[-1] - N_FRAMES
     content_duration = float(content_frames * HOP_LENGTH / SAMPLE_RATE)
 
@@ -149,7 +184,8 @@ def transcribe(
                     "Detecting language using up to the first 30 seconds. Use `--language` to specify the language"
                 )
             mel_segment = pad_or_trim(mel, N_FRAMES).to(model.device).to(dtype)
-            _, probs = model.detect_language(mel_segment)
+            with model_lock:
+                _, probs = model.detect_language(mel_segment)
             decode_options["language"] = max(probs, key=probs.get)
             if verbose is not None:
                 print(
@@ -181,14 +217,53 @@ def transcribe(
     if word_timestamps and task == "translate":
         warnings.warn("Word-level timestamps on translations may not be reliable.")
 
-    def decode_with_fallback(segment: torch.Tensor) -> DecodingResult:
+    def needs_fallback(decode_result: DecodingResult) -> bool:
+        needs_fallback = False
+        if (
+            compression_ratio_threshold is not None
+            and decode_result.compression_ratio > compression_ratio_threshold
+        ):
+            needs_fallback = True  # too repetitive
+        if (
+            logprob_threshold is not None
+            and decode_result.avg_logprob < logprob_threshold
+        ):
+            needs_fallback = True  # average log probability is too low
+        if (
+            no_speech_threshold is not None
+            and decode_result.no_speech_prob > no_speech_threshold
+            and logprob_threshold is not None
+            and decode_result.avg_logprob < logprob_threshold
+        ):
+            needs_fallback = False  # silence
+        return needs_fallback
+
+    if temperature_fallback not in ("sequential", "parallel", "speculative"):
+        raise ValueError(f"Unsupported temperature_fallback: {temperature_fallback}")
+
+    def decode_with_fallback(
+        segment: torch.Tensor,
+    ) -> Tuple[DecodingResult, torch.Tensor]:
+        """Returns the result and the mel segment that it was decoded from"""
         temperatures = (
             [temperature] if isinstance(temperature, (int, float)) else temperature
         )
         decode_result = None
 
-        for t in temperatures:
+        for i, t in enumerate(temperatures):
+            if i > 0 and temperature_fallback != "sequential":
+                decode_result = decode_batched_fallback(
+                    decode_result.audio_features, temperatures[i:]
+                )
+                return decode_result, segment
+
             kwargs = {**decode_options}
+            if (
+                temperature_fallback == "speculative"
+                and logprob_threshold is not None
+                and i < len(temperatures) - 1
+            ):
+                kwargs["early_stop_logprob"] = logprob_threshold
             if t > 0:
                 # disable beam_size and patience when t > 0
                 kwargs.pop("beam_size", None)
@@ -198,30 +273,45 @@ def transcribe(
                 kwargs.pop("best_of", None)
 
             options = DecodingOptions(**kwargs, temperature=t)
-            decode_result = model.decode(segment, options)
+            decode_result = decode(segment, options)
 
-            needs_fallback = False
             if (
-                compression_ratio_threshold is not None
-                and decode_result.compression_ratio > compression_ratio_threshold
+                needs_fallback(decode_result)
+                and dynamic_audio_ctx
+                and options.audio_ctx is not None
+                and options.audio_ctx < max_audio_ctx
             ):
-                needs_fallback = True  # too repetitive
-            if (
-                logprob_threshold is not None
-                and decode_result.avg_logprob < logprob_threshold
-            ):
-                needs_fallback = True  # average log probability is too low
-            if (
-                no_speech_threshold is not None
-                and decode_result.no_speech_prob > no_speech_threshold
-                and logprob_threshold is not None
-                and decode_result.avg_logprob < logprob_threshold
-            ):
-                needs_fallback = False  # silence
-            if not needs_fallback:
+                # the shortened audio context may be at fault; retry with the context that was
+                # asked for, which the fallback temperatures use as well
+                segment = pad_or_trim(segment, 2 * max_audio_ctx)
+                if max_audio_ctx < model.dims.n_audio_ctx:
+                    decode_options["audio_ctx"] = max_audio_ctx
+                else:
+                    decode_options.pop("audio_ctx")
+                options = replace(options, audio_ctx=decode_options.get("audio_ctx"))
+                decode_result = decode(segment, options)
+
+            if not needs_fallback(decode_result):
                 break
 
-        return decode_result
+        return decode_result, segment
+
+    def decode_batched_fallback(
+        audio_features: torch.Tensor, temperatures: Sequence[float]
+    ) -> DecodingResult:
+        kwargs = {**decode_options}
+        kwargs.pop("beam_size", None)
+        kwargs.pop("patience", None)
+        if 0 in temperatures:
+            # disable best_of when any t == 0
+            kwargs.pop("best_of", None)
+        options = DecodingOptions(**kwargs, temperature=tuple(temperatures))
+        results = decode(audio_features[None], options)
+
+        # the first passing result, or the last one like the sequential fallback
+        return next((r for r in results if not needs_fallback(r)), results[-1])
+
+    max_audio_ctx = decode_options.pop("audio_ctx", None) or model.dims.n_audio_ctx
 
     clip_idx = 0
     seek = seek_clips[clip_idx][0]
@@ -283,7 +373,15 @@ def transcribe(
             segment_size = min(N_FRAMES, content_frames - seek, seek_clip_end - seek)
             mel_segment = mel[:, seek : seek + segment_size]
             segment_duration = segment_size * HOP_LENGTH / SAMPLE_RATE
-            mel_segment = pad_or_trim(mel_segment, N_FRAMES).to(model.device).to(dtype)
+            audio_ctx = max_audio_ctx
+            if dynamic_audio_ctx:
+                audio_ctx = min(audio_ctx, audio_ctx_for(segment_size, max_audio_ctx))
+            if audio_ctx < model.dims.n_audio_ctx:
+                decode_options["audio_ctx"] = audio_ctx
+            else:
+                decode_options.pop("audio_ctx", None)
+            mel_segment = pad_or_trim(mel_segment, 2 * audio_ctx)
+            mel_segment = mel_segment.to(model.device).to(dtype)
 
             if carry_initial_prompt:
                 nignored = max(len(initial_prompt_tokens), prompt_reset_since)
@@ -292,7 +390,9 @@ def transcribe(
             else:
                 decode_options["prompt"] = all_tokens[prompt_reset_since:]
 
-            result: DecodingResult = decode_with_fallback(mel_segment)
+            # word timestamps are aligned on the segment that was decoded, which is padded to
+            # the full context when the shortened one was retried
+            result, mel_segment = decode_with_fallback(mel_segment)
             tokens = torch.tensor(result.tokens)
 
             if no_speech_threshold is not None:
@@ -399,16 +499,17 @@ def transcribe(
                 seek += segment_size
 
             if word_timestamps:
-                add_word_timestamps(
-                    segments=current_segments,
-                    model=model,
-                    tokenizer=tokenizer,
-                    mel=mel_segment,
-                    num_frames=segment_size,
-                    prepend_punctuations=prepend_punctuations,
-                    append_punctuations=append_punctuations,
-                    last_speech_timestamp=last_speech_timestamp,
-                )
+                with model_lock:
+                    add_word_timestamps(
+                        segments=current_segments,
+                        model=model,
+                        tokenizer=tokenizer,
+                        mel=mel_segment,
+                        num_frames=segment_size,
+                        prepend_punctuations=prepend_punctuations,
+                        append_punctuations=append_punctuations,
+                        last_speech_timestamp=last_speech_timestamp,
+                    )
 
                 if not single_timestamp_ending:
                     last_word_end = get_end(current_segments)
@@ -564,6 +665,10 @@ def cli():
     parser.add_argument("--threads", type=optional_int, default=0, help="number of threads used by torch for CPU inference; supercedes MKL_NUM_THREADS/OMP_NUM_THREADS")
     parser.add_argument("--clip_timestamps", type=str, default="0", help="comma-separated list start,end,start,end,... timestamps (in seconds) of clips to process, where the last end timestamp defaults to the end of the file")
     parser.add_argument("--hallucination_silence_threshold", type=optional_float, help="(requires --word_timestamps True) skip silent periods longer than this threshold (in seconds) when a possible hallucination is detected")
+    parser.add_argument("--temperature_fallback", type=str, default="sequential", choices=["sequential", "parallel", "speculative"], help="decode the fallback temperatures one at a time, all at once in a batch, or all at once after stopping the first decoding early when its first tokens look unlikely")
+    parser.add_argument("--dynamic_audio_ctx", type=str2bool, default=False, help="encode audio shorter than 30 seconds with a shorter audio context, retrying with the full context when decoding fails; much faster for short clips")
+    parser.add_argument("--batch_files", type=int, default=0, help="number of files to transcribe at once, decoding their 30-second windows as batches while the following files are loaded; 0 transcribes one file at a time")
+    parser.add_argument("--load_workers", type=int, default=2, help="(requires --batch_files) number of threads decoding the following files with ffmpeg and computing their Mel spectrograms")
     # fmt: on
 
     args = parser.parse_args().__dict__
@@ -610,6 +715,31 @@ def cli():
     if args["max_words_per_line"] and args["max_line_width"]:
         warnings.warn("--max_words_per_line has no effect with --max_line_width")
     writer_args = {arg: args.pop(arg) for arg in word_options}
+    batch_files, load_workers = args.pop("batch_files"), args.pop("load_workers")
+    if batch_files > 0:
+        from .pipeline import transcribe_files
+
+        # the windows of the files being transcribed at once would be printed interleaved
+        verbose = args.pop("verbose")
+        results = transcribe_files(
+            model,
+            args.pop("audio"),
+            batch_files=batch_files,
+            load_workers=load_workers,
+            temperature=temperature,
+            verbose=None,
+            **args,
+        )
+        for audio_path, future in results:
+            try:
+                writer(future.result(), audio_path, **writer_args)
+                if verbose:
+                    print(f"Transcribed {audio_path}")
+            except Exception as e:
+                traceback.print_exc()
+                print(f"Skipping {audio_path} due to {type(e).__name__}: {str(e)}")
+        return
+
     for audio_path in args.pop("audio"):
         try:
             result = transcribe(model, audio_path, temperature=temperature, **args)